@@ -0,0 +1,83 @@
+"""Count the IOPub messages published while a widget is dragged, i.e. when the frontend
+sends a stream of comm messages that each trigger a state update from the kernel.
+
+    python benchmarks/bench_comm_status.py
+
+With messages paced every 0.5ms, each one is handled before the next one arrives, so by
+default the kernel still publishes a busy/idle pair around each message (600 IOPub messages
+for 200 comm messages). Busy/idle pairs are only merged for messages received in a burst
+(202 IOPub messages), while a cell is running, or not published with --no-comm-status
+(200 IOPub messages in all cases).
+"""
+
+import asyncio
+import time
+from collections import Counter
+
+from anyio import create_memory_object_stream
+
+from akernel.comm import Comm
+from akernel.kernel import PARENT_VAR, Kernel
+from akernel.message import deserialize, feed_identities
+
+
+DRAG_MESSAGES = 200
+# time in seconds between two messages sent by the frontend while dragging, or 0 for a burst
+# of messages all received at once
+DRAG_INTERVALS = (0.0005, 0)
+
+
+def create_comm_msg(comm_id, i):
+    return {
+        "header": {"msg_id": str(i), "session": "bench"},
+        "content": {"comm_id": comm_id, "data": {"method": "update", "state": {"value": i}}},
+    }
+
+
+async def drag(comm_status: bool, running_cell: bool, interval: float) -> Counter:
+    send_stream, receive_stream = create_memory_object_stream(max_buffer_size=float("inf"))
+    kernel = Kernel(None, None, None, None, None, None, send_stream, comm_status=comm_status)
+    PARENT_VAR.set(create_comm_msg("", -1))
+    comm = Comm(target_name="jupyter.widget")
+    # echo the new value back, like a widget with a dependent output
+    comm.on_msg(
+        lambda msg: comm.send({"method": "update", "state": msg["content"]["data"]["state"]})
+    )
+    receive_stream.receive_nowait()  # comm_open
+    if running_cell:
+        kernel.begin_activity()
+    for i in range(DRAG_MESSAGES):
+        kernel.comm_manager.comm_msg(None, None, create_comm_msg(comm.comm_id, i))
+        if interval:
+            await asyncio.sleep(interval)
+    while kernel.comm_manager.dispatchers:
+        await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    counter: Counter = Counter()
+    while True:
+        try:
+            msg_list = receive_stream.receive_nowait()
+        except Exception:
+            break
+        msg = deserialize(feed_identities(msg_list)[1])
+        counter[msg["msg_type"]] += 1
+    return counter
+
+
+async def main():
+    for interval in DRAG_INTERVALS:
+        for comm_status in (True, False):
+            for running_cell in (False, True):
+                t0 = time.perf_counter()
+                counter = await drag(comm_status, running_cell, interval)
+                t1 = time.perf_counter()
+                print(
+                    f"interval={interval * 1000:.1f}ms comm_status={comm_status!s:5} "
+                    f"running_cell={running_cell!s:5} "
+                    f"IOPub messages={sum(counter.values()):5} ({dict(counter)}) "
+                    f"in {(t1 - t0) * 1000:.0f}ms"
+                )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,42 @@
+"""Measure the latency of completion requests in a namespace of 100k names, and of the index
+update after a cell binding a few names.
+
+    python benchmarks/bench_completion.py
+"""
+
+import time
+
+from akernel.completion import CompletionIndex
+
+
+NAMES = 100_000
+REQUESTS = 1000
+
+
+def main():
+    namespace = {f"var_{i}": i for i in range(NAMES)}
+    namespace["os"] = __import__("os")
+    t0 = time.perf_counter()
+    index = CompletionIndex(namespace)
+    t1 = time.perf_counter()
+    print(f"index of {len(namespace)} names built in {(t1 - t0) * 1000:.1f}ms")
+
+    for code in ("var_4242", "var_42", "var_", "pri", "os.pa"):
+        t0 = time.perf_counter()
+        for _ in range(REQUESTS):
+            reply = index.complete(code, len(code))
+        t1 = time.perf_counter()
+        print(
+            f"{code!r:12} {len(reply['matches']):5} matches in {(t1 - t0) / REQUESTS * 1000:.3f}ms"
+        )
+
+    t0 = time.perf_counter()
+    for i in range(REQUESTS):
+        namespace[f"new_{i}"] = i
+        index.update([f"new_{i}"])
+    t1 = time.perf_counter()
+    print(f"index updated with a new name in {(t1 - t0) / REQUESTS * 1000:.3f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""Measure the cost of reporting errors, for a cell that raises a lot of exceptions (e.g. in a
+retry loop), each going through a few frames of library code.
+
+    python benchmarks/bench_traceback.py
+"""
+
+import asyncio
+import time
+from textwrap import dedent
+
+from akernel.execution import pre_execute
+from akernel.traceback import get_traceback
+
+
+ERRORS = 10000
+
+CODE = dedent(
+    """
+    import json
+
+    def parse(text):
+        return json.loads(text)
+
+    parse("{")
+    """
+).strip()
+
+
+async def main():
+    globals_ = {}
+    locals_ = {}
+    pre_execute(CODE, globals_, locals_, execution_count=1)
+    cell = locals_["__async_cell__"]
+    depth = 0
+    t0 = time.perf_counter()
+    for _ in range(ERRORS):
+        try:
+            await cell()
+        except Exception as e:
+            traceback = get_traceback(CODE, e, 1)
+            depth = (len(traceback) - 2) // 2
+    t1 = time.perf_counter()
+    print(
+        f"{ERRORS} errors ({depth} frames each) reported in {(t1 - t0) * 1000:.0f}ms "
+        f"({(t1 - t0) / ERRORS * 1e6:.1f}us per error)"
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,25 +1,137 @@
 from __future__ import annotations
 
 import json
-from typing import Optional, cast
+import os
+import time
+from enum import Enum
+from typing import List, Optional, cast
 
 import typer
 from anyio import create_memory_object_stream, create_task_group, run, sleep_forever
 
 from .connect import connect_channel
+from .history import get_history_path
 from .kernel import Kernel
 from .kernelspec import write_kernelspec
+from .message import feed_identities, unpack
+from .supervisor import Supervisor, Worker
+from .tracing import Tracer
 
 
 cli = typer.Typer()
 
 
+class CodeHash(str, Enum):
+    ast = "ast"
+    source = "source"
+
+
+class InputHash(str, Enum):
+    value = "value"
+    lineage = "lineage"
+
+
+class TraceFormat(str, Enum):
+    jsonl = "jsonl"
+    chrome = "chrome"
+
+
+CODE_HASH_OPTION = typer.Option(
+    CodeHash.ast,
+    "--code-hash",
+    help="How cell code is hashed, if mode is 'cache': 'ast' (ignores formatting, comments "
+    "and docstrings) or 'source' (strict).",
+)
+INPUT_HASH_OPTION = typer.Option(
+    InputHash.value,
+    "--input-hash",
+    help="How cell inputs are hashed, if mode is 'cache': 'value' (pickled values) or "
+    "'lineage' (cache keys of the cell executions that produced them).",
+)
+SESSION_MEMORY_OPTION = typer.Option(
+    None,
+    "--session-memory",
+    help="Memory budget in bytes of the session namespaces, if mode is 'multi'. The least "
+    "recently active sessions are spilled to disk above it.",
+)
+SESSION_IDLE_TIMEOUT_OPTION = typer.Option(
+    None,
+    "--session-idle-timeout",
+    help="Time in seconds after which an idle session is spilled to disk, if mode is 'multi'.",
+)
+STARTUP_OPTION = typer.Option(
+    None,
+    "--startup",
+    help="Path to a script that is run once at kernel startup, and whose namespace new "
+    "sessions start from.",
+)
+
+WORKERS_OPTION = typer.Option(
+    1,
+    "--workers",
+    help="Number of worker processes the sessions are distributed to, if mode is 'multi'.",
+)
+COMM_STATUS_OPTION = typer.Option(
+    True,
+    "--comm-status/--no-comm-status",
+    help="Publish the busy/idle status of the kernel when it handles comm messages. Only the "
+    "transitions are published, which saves messages for bursts of comm messages, but a "
+    "busy/idle pair is still published around each message when they are spaced out.",
+)
+CAPTURE_FD_OPTION = typer.Option(
+    False,
+    "--capture-fd/--no-capture-fd",
+    help="Send what is written to the file descriptors 1 and 2 (e.g. by C extensions or "
+    "subprocesses) to the output of the last started cell.",
+)
+HISTORY_OPTION = typer.Option(
+    False,
+    "--history/--no-history",
+    help="Record the code of the executed cells in the execution history, so that frontends "
+    "can search past cells.",
+)
+HISTORY_FILE_OPTION = typer.Option(
+    None,
+    "--history-file",
+    help="Path to the SQLite database of the execution history.",
+)
+TRACE_MEMORY_OPTION = typer.Option(
+    False,
+    "--trace-memory/--no-trace-memory",
+    help="Trace the memory allocations with tracemalloc, to report the peak memory allocated "
+    "by each cell in its metrics (slows down execution).",
+)
+TRACE_FILE_OPTION = typer.Option(
+    None,
+    "--trace-file",
+    help="Path to a file where the lifecycle of each message is traced, as spans.",
+)
+TRACE_FORMAT_OPTION = typer.Option(
+    TraceFormat.jsonl,
+    "--trace-format",
+    help="Format of the trace file: 'jsonl' (JSON lines) or 'chrome' (Chrome trace format).",
+)
+
+
 @cli.command()
 def install(
     mode: str = typer.Argument("", help="Mode of the kernel to install."),
     cache_dir: Optional[str] = typer.Option(
         None, "-c", help="Path to the cache directory, if mode is 'cache'."
     ),
+    code_hash: CodeHash = CODE_HASH_OPTION,
+    input_hash: InputHash = INPUT_HASH_OPTION,
+    session_memory: Optional[int] = SESSION_MEMORY_OPTION,
+    session_idle_timeout: Optional[float] = SESSION_IDLE_TIMEOUT_OPTION,
+    startup: Optional[str] = STARTUP_OPTION,
+    workers: int = WORKERS_OPTION,
+    comm_status: bool = COMM_STATUS_OPTION,
+    capture_fd: bool = CAPTURE_FD_OPTION,
+    history: bool = HISTORY_OPTION,
+    history_file: Optional[str] = HISTORY_FILE_OPTION,
+    trace_memory: bool = TRACE_MEMORY_OPTION,
+    trace_file: Optional[str] = TRACE_FILE_OPTION,
+    trace_format: TraceFormat = TRACE_FORMAT_OPTION,
 ):
     kernel_name = "akernel"
     if mode:
@@ -28,7 +140,32 @@ def install(
         mode = "-".join(modes)
         kernel_name += f"-{mode}"
     display_name = f"Python 3 ({kernel_name})"
-    write_kernelspec(kernel_name, mode, display_name, cache_dir)
+    extra_args = []
+    if session_memory is not None:
+        extra_args += ["--session-memory", str(session_memory)]
+    if session_idle_timeout is not None:
+        extra_args += ["--session-idle-timeout", str(session_idle_timeout)]
+    if startup is not None:
+        extra_args += ["--startup", os.path.abspath(startup)]
+    if workers > 1:
+        extra_args += ["--workers", str(workers)]
+    if not comm_status:
+        extra_args += ["--no-comm-status"]
+    if capture_fd:
+        extra_args += ["--capture-fd"]
+    if history:
+        extra_args += ["--history"]
+    if history_file is not None:
+        extra_args += ["--history-file", os.path.abspath(history_file)]
+    if trace_memory:
+        extra_args += ["--trace-memory"]
+    if trace_file is not None:
+        extra_args += ["--trace-file", os.path.abspath(trace_file)]
+    if trace_format != TraceFormat.jsonl:
+        extra_args += ["--trace-format", trace_format.value]
+    write_kernelspec(
+        kernel_name, mode, display_name, cache_dir, code_hash.value, input_hash.value, extra_args
+    )
 
 
 @cli.command()
@@ -37,14 +174,60 @@ def launch(
     cache_dir: Optional[str] = typer.Option(
         None, "-c", help="Path to the cache directory, if mode is 'cache'."
     ),
+    code_hash: CodeHash = CODE_HASH_OPTION,
+    input_hash: InputHash = INPUT_HASH_OPTION,
+    session_memory: Optional[int] = SESSION_MEMORY_OPTION,
+    session_idle_timeout: Optional[float] = SESSION_IDLE_TIMEOUT_OPTION,
+    startup: Optional[str] = STARTUP_OPTION,
+    workers: int = WORKERS_OPTION,
+    comm_status: bool = COMM_STATUS_OPTION,
+    capture_fd: bool = CAPTURE_FD_OPTION,
+    history: bool = HISTORY_OPTION,
+    history_file: Optional[str] = HISTORY_FILE_OPTION,
+    trace_memory: bool = TRACE_MEMORY_OPTION,
+    trace_file: Optional[str] = TRACE_FILE_OPTION,
+    trace_format: TraceFormat = TRACE_FORMAT_OPTION,
     connection_file: str = typer.Option(..., "-f", help="Path to the connection file."),
 ):
-    akernel = AKernel(mode, cache_dir, connection_file)
-    run(akernel.start)
+    kernel_options = dict(
+        code_hash=code_hash.value,
+        input_hash=input_hash.value,
+        session_memory=session_memory,
+        session_idle_timeout=session_idle_timeout,
+        startup=startup,
+        comm_status=comm_status,
+        capture_fd=capture_fd,
+        history_file=(history_file or get_history_path()) if history else None,
+        trace_memory=trace_memory,
+        trace_file=trace_file,
+        trace_format=trace_format.value,
+    )
+    if workers > 1:
+        if "multi" not in mode.split("-"):
+            raise typer.BadParameter("Workers are only supported in 'multi' mode.")
+        supervisor = Supervisor(mode, cache_dir, connection_file, workers, **kernel_options)
+        run(supervisor.start)
+    else:
+        akernel = AKernel(mode, cache_dir, connection_file, **kernel_options)
+        run(akernel.start)
+
+
+@cli.command(hidden=True)
+def worker(
+    mode: str = typer.Argument(..., help="Mode of the kernel."),
+    cache_dir: Optional[str] = typer.Option(None, "-c", help="Path to the cache directory."),
+    address: str = typer.Option(..., "--address", help="Address of the supervisor."),
+    identity: str = typer.Option(..., "--identity", help="Identity of the worker."),
+    options: str = typer.Option("{}", "--options", help="Kernel options, as JSON."),
+):
+    # the key is not passed on the command line, which is visible to other users
+    key = os.environ["AKERNEL_KEY"]
+    worker = Worker(mode, cache_dir, address, identity, key, **json.loads(options))
+    run(worker.start)
 
 
 class AKernel:
-    def __init__(self, mode, cache_dir, connection_file):
+    def __init__(self, mode, cache_dir, connection_file, **kernel_options):
         self._to_shell_send_stream, self._to_shell_receive_stream = create_memory_object_stream[list[bytes]]()
         self._from_shell_send_stream, self._from_shell_receive_stream = create_memory_object_stream[list[bytes]]()
         self._to_control_send_stream, self._to_control_receive_stream = create_memory_object_stream[list[bytes]]()
@@ -62,6 +245,7 @@ class AKernel:
             self._from_iopub_send_stream,
             mode,
             cache_dir,
+            **kernel_options,
         )
         with open(connection_file) as f:
             connection_cfg = json.load(f)
@@ -106,6 +290,8 @@ class AKernel:
     async def to_shell(self) -> None:
         while True:
             msg = await self.shell_channel.arecv_multipart().wait()
+            if self.kernel.tracer is not None:
+                self.kernel.tracer.received["shell"].append(time.perf_counter())
             await self._to_shell_send_stream.send(msg)
 
     async def from_shell(self) -> None:
@@ -115,6 +301,8 @@ class AKernel:
     async def to_control(self) -> None:
         while True:
             msg = await self.control_channel.arecv_multipart().wait()
+            if self.kernel.tracer is not None:
+                self.kernel.tracer.received["control"].append(time.perf_counter())
             await self._to_control_send_stream.send(msg)
 
     async def from_control(self) -> None:
@@ -124,6 +312,8 @@ class AKernel:
     async def to_stdin(self) -> None:
         while True:
             msg = await self.stdin_channel.arecv_multipart().wait()
+            if self.kernel.tracer is not None:
+                self.kernel.tracer.received["stdin"].append(time.perf_counter())
             await self._to_stdin_send_stream.send(msg)
 
     async def from_stdin(self) -> None:
@@ -132,7 +322,25 @@ class AKernel:
 
     async def from_iopub(self) -> None:
         async for msg in self._from_iopub_receive_stream:
+            t0 = time.perf_counter()
             await self.iopub_channel.asend_multipart(msg, copy=True).wait()
+            if self.kernel.tracer is not None:
+                trace_iopub(self.kernel.tracer, msg, t0)
+
+
+def trace_iopub(tracer: Tracer, msg: List[bytes], start: float) -> None:
+    # only parsed when tracing
+    _, msg_list = feed_identities(msg)
+    parent_header = unpack(msg_list[2])
+    if parent_header:
+        header = unpack(msg_list[1])
+        tracer.span(
+            "iopub_flush",
+            start,
+            time.perf_counter(),
+            parent_header,
+            {"iopub_msg_type": header["msg_type"]},
+        )
 
 
 if __name__ == "__main__":
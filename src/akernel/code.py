@@ -92,6 +92,30 @@ def get_return_body(val):
 body_globals_update_locals = ast.parse("globals().update(locals())").body
 
 
+def is_docstring(node) -> bool:
+    return (
+        isinstance(node, ast.Expr)
+        and isinstance(node.value, ast.Constant)
+        and isinstance(node.value.value, str)
+    )
+
+
+class DocstringRemover(ast.NodeTransformer):
+    def visit_Module(self, node):
+        # a lone string is the result of the cell, not a docstring
+        if len(node.body) > 1 and is_docstring(node.body[0]):
+            node.body = node.body[1:]
+        return self.generic_visit(node)
+
+    def visit_FunctionDef(self, node):
+        if is_docstring(node.body[0]):
+            node.body = node.body[1:] or [ast.Pass()]
+        return self.generic_visit(node)
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+    visit_ClassDef = visit_FunctionDef
+
+
 class Transform:
     def __init__(self, code: str, task_i: int | None = None, react: bool = False) -> None:
         self.gtree = ast.parse(code)
@@ -101,7 +125,32 @@ class Transform:
         c.visit(self.gtree)
         self.globals = set(c.globals)
         self.outputs = set(c.outputs)
+        self.mutated = set(c.mutated)
+        self.called = set(c.called)
         self.has_import = c.has_import
+        # only imports at the top-level of the cell can be re-executed on their own
+        self.imports = [
+            node for node in self.gtree.body if isinstance(node, (ast.Import, ast.ImportFrom))
+        ]
+        self.imported = {
+            (alias.asname or alias.name).split(".")[0]
+            for node in self.imports
+            for alias in node.names
+        }
+        # the names that the cell may bind in the global namespace
+        self.names = (
+            self.outputs
+            | self.imported
+            | {
+                node.name
+                for node in self.gtree.body
+                if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef))
+            }
+        )
+        self.cacheable_imports = c.import_nb == len(self.imports) and all(
+            isinstance(node, ast.Import) or (node.level == 0 and node.names[0].name != "*")
+            for node in self.imports
+        )
         self.last_statement = self.gtree.body[-1]
         if react:
             self.make_react()
@@ -145,14 +194,21 @@ class Transform:
     def get_code(self) -> str:
         return ast.unparse(self.gtree)
 
+    def get_normalized_code(self) -> str:
+        """Return a dump of the AST without docstrings, which doesn't depend on the formatting of
+        the code, its comments or the position of its nodes.
+        """
+        tree = DocstringRemover().visit(copy.deepcopy(self.gtree))
+        return ast.dump(tree, annotate_fields=False)
+
     def get_async_code(self) -> str:
         gtree = self.get_async_ast()
         return ast.unparse(gtree)
 
-    def get_async_bytecode(self) -> CodeType:
+    def get_async_bytecode(self, filename: str = "<string>") -> CodeType:
         tree = self.get_async_ast()
         #tree = gast.gast_to_ast(gtree)
-        bytecode = compile(tree, filename="<string>", mode="exec")
+        bytecode = compile(tree, filename=filename, mode="exec")
         return bytecode
 
     def make_react(self):
@@ -201,7 +257,12 @@ class GlobalUseCollector(gast.NodeVisitor):
     def __init__(self):
         self.globals = []
         self.outputs = []
+        # variables that may be mutated in place (not re-bound)
+        self.mutated = []
+        # the global names that are called, e.g. functions that may use other variables
+        self.called = []
         self.has_import = False
+        self.import_nb = 0
         # track context name and set of names marked as `global`
         self.context = [("global", ())]
 
@@ -236,24 +297,44 @@ class GlobalUseCollector(gast.NodeVisitor):
     def visit_Assign(self, node):
         ctx, g = self.context[-1]
         if ctx == "global":
-            self.outputs += [target.id for target in node.targets if isinstance(target, gast.Name)]
+            self.outputs += [target.id for target in node.targets if isinstance(target, ast.Name)]
         self.generic_visit(node)
 
     def visit_AugAssign(self, node):
         ctx, g = self.context[-1]
         if ctx == "global":
-            if isinstance(node.target, gast.Name):
+            if isinstance(node.target, ast.Name):
                 self.outputs.append(node.target.id)
         self.generic_visit(node)
 
-    def visit_Import(self, node):
-        ctx, g = self.context[-1]
-        if ctx == "global":
-            self.has_import = True
+    def visit_Attribute(self, node):
+        self._visit_mutation(node.value, not isinstance(node.ctx, ast.Load))
         self.generic_visit(node)
 
-    def visit_ImportFrom(self, node):
+    def visit_Subscript(self, node):
+        self._visit_mutation(node.value, not isinstance(node.ctx, ast.Load))
+        self.generic_visit(node)
+
+    def visit_Call(self, node):
+        # a method call may mutate its object
+        if isinstance(node.func, ast.Attribute):
+            self._visit_mutation(node.func.value, True)
+        elif isinstance(node.func, ast.Name):
+            ctx, g = self.context[-1]
+            if ctx == "global" or node.func.id in g:
+                self.called.append(node.func.id)
+        self.generic_visit(node)
+
+    def _visit_mutation(self, node, mutated):
+        ctx, g = self.context[-1]
+        if mutated and isinstance(node, ast.Name) and (ctx == "global" or node.id in g):
+            self.mutated.append(node.id)
+
+    def visit_Import(self, node):
         ctx, g = self.context[-1]
         if ctx == "global":
             self.has_import = True
+            self.import_nb += 1
         self.generic_visit(node)
+
+    visit_ImportFrom = visit_Import
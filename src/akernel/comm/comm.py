@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+import asyncio
+import inspect
 from typing import Any, Callable
 
 import comm
@@ -12,14 +14,27 @@ class Comm(comm.base_comm.BaseComm):
     comm_id: str
     topic: bytes
     parent_header: dict[str, Any]
+    coalesce_interval: float | None
+    _pending_update: dict[str, Any] | None
+    _flush_handle: asyncio.TimerHandle | None
 
     def __init__(self, **kwargs) -> None:
         from akernel.kernel import KERNEL, PARENT_VAR, Kernel
 
         self.kernel: Kernel = KERNEL
         self.parent_header = PARENT_VAR.get()["header"]
+        self.coalesce_interval = None
+        self._pending_update = None
+        self._flush_handle = None
         super().__init__(**kwargs)
 
+    def set_coalescing(self, interval: float | None) -> None:
+        """Merge the state updates published within interval seconds into one message, the
+        last value of a key winning. Coalescing is disabled with None.
+        """
+        self.flush()
+        self.coalesce_interval = interval
+
     def publish_msg(
         self,
         msg_type: str,
@@ -27,6 +42,75 @@ class Comm(comm.base_comm.BaseComm):
         metadata: dict[str, Any] | None = None,
         buffers: list[bytes] | None = None,
         **keys: Any,
+    ) -> None:
+        if (
+            self.coalesce_interval is not None
+            and msg_type == "comm_msg"
+            and data is not None
+            and data.get("method") == "update"
+            and self.coalesce_update(data, metadata, buffers or [], keys)
+        ):
+            return
+        # keep the order between the coalesced updates and the other messages
+        self.flush()
+        self.send_msg(msg_type, data, metadata, buffers or [], **keys)
+
+    def coalesce_update(
+        self,
+        data: dict[str, Any],
+        metadata: dict[str, Any] | None,
+        buffers: list[bytes],
+        keys: dict[str, Any],
+    ) -> bool:
+        pending = self._pending_update
+        if pending is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                # no event loop to flush the update later
+                return False
+            assert self.coalesce_interval is not None
+            self._flush_handle = loop.call_later(self.coalesce_interval, self.flush)
+            pending = self._pending_update = {"state": {}, "buffers": {}}
+        state = data.get("state", {})
+        buffer_paths = [tuple(path) for path in data.get("buffer_paths", [])]
+        # a key that is updated replaces its previous value, binary parts included
+        updated = set(state) | {path[0] for path in buffer_paths}
+        for path in [path for path in pending["buffers"] if path[0] in updated]:
+            del pending["buffers"][path]
+        for key in updated - set(state):
+            pending["state"].pop(key, None)
+        pending["state"].update(state)
+        pending["buffers"].update(zip(buffer_paths, buffers))
+        pending["metadata"] = metadata
+        pending["keys"] = keys
+        return True
+
+    def flush(self) -> None:
+        """Publish the pending coalesced state update, if any."""
+        pending = self._pending_update
+        if pending is None:
+            return
+        self._pending_update = None
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        buffer_paths = list(pending["buffers"])
+        data = {
+            "method": "update",
+            "state": pending["state"],
+            "buffer_paths": [list(path) for path in buffer_paths],
+        }
+        buffers = [pending["buffers"][path] for path in buffer_paths]
+        self.send_msg("comm_msg", data, pending["metadata"], buffers, **pending["keys"])
+
+    def send_msg(
+        self,
+        msg_type: str,
+        data: dict[str, Any] | None,
+        metadata: dict[str, Any] | None,
+        buffers: list[bytes],
+        **keys: Any,
     ) -> None:
         msg = create_message(
             msg_type,
@@ -39,25 +123,47 @@ class Comm(comm.base_comm.BaseComm):
         to_send = serialize(msg, self.kernel.key)
         self.kernel.from_iopub_send_stream.send_nowait(to_send)
 
+    def send_status(self, msg: dict[str, Any], execution_state: str) -> None:
+        msg2 = create_message(
+            "status",
+            parent_header=msg["header"],
+            content={"execution_state": execution_state},
+        )
+        to_send = serialize(msg2, self.kernel.key)
+        self.kernel.from_iopub_send_stream.send_nowait(to_send)
+
+    def begin_activity(self, msg: dict[str, Any]) -> None:
+        # only publish the status if the kernel was idle
+        if self.kernel.begin_activity() and self.kernel.comm_status:
+            self.send_status(msg, "busy")
+
+    def end_activity(self, msg: dict[str, Any]) -> None:
+        if self.kernel.end_activity() and self.kernel.comm_status:
+            self.send_status(msg, "idle")
+
     def handle_msg(self, msg: dict[str, Any]) -> None:
         if self._msg_callback:
-            self.kernel.execution_state = "busy"
-            msg2 = create_message(
-                "status",
-                parent_header=msg["header"],
-                content={"execution_state": self.kernel.execution_state},
-            )
-            to_send = serialize(msg2, self.kernel.key)
-            self.kernel.from_iopub_send_stream.send_nowait(to_send)
-            self._msg_callback(msg)
-            self.kernel.execution_state = "idle"
-            msg2 = create_message(
-                "status",
-                parent_header=msg["header"],
-                content={"execution_state": self.kernel.execution_state},
-            )
-            to_send = serialize(msg2, self.kernel.key)
-            self.kernel.from_iopub_send_stream.send_nowait(to_send)
+            self.begin_activity(msg)
+            try:
+                self._msg_callback(msg)
+            finally:
+                self.end_activity(msg)
+
+    async def ahandle_msg(self, msg: dict[str, Any]) -> None:
+        """Handle a comm message in its own task, the callback can be a coroutine function.
+        The activity of the kernel is accounted for by the comm manager.
+        """
+        from akernel.kernel import PARENT_VAR
+
+        if self._msg_callback:
+            # outputs of the callback are sent to the comm message
+            PARENT_VAR.set(msg)
+            try:
+                result = self._msg_callback(msg)
+                if inspect.isawaitable(result):
+                    await result
+            finally:
+                self.kernel.flush_output(msg["header"]["msg_id"])
 
 
 comm.create_comm = Comm
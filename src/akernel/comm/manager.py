@@ -1,23 +1,158 @@
-from typing import Dict, Callable, cast
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import logging
+from collections import deque
+from typing import Any, Deque, Dict, Callable, Set, Tuple, cast
 
 import comm
 
 from .comm import Comm
 
 
+logger = logging.getLogger("Comm")
+
+
 class CommManager(comm.CommManager):
     comms: dict[str, comm.base_comm.BaseComm]
     targets: Dict[str, Callable]
+    max_concurrency: int
+    concurrency: Dict[str, int]
+    pending: Dict[str, Deque[Tuple[Comm, Dict[str, Any]]]]
+    semaphores: Dict[str, asyncio.Semaphore]
+    dispatchers: Dict[str, asyncio.Task]
+    handlers: Set[asyncio.Task]
+    target_comms: Dict[str, Set[str]]
 
-    def __init__(self) -> None:
+    def __init__(self, max_concurrency: int = 1) -> None:
         super().__init__()
         from akernel.kernel import KERNEL, Kernel
 
         self.kernel: Kernel = KERNEL
+        self.max_concurrency = max_concurrency
+        self.concurrency = {}
+        self.pending = {}
+        self.semaphores = {}
+        self.dispatchers = {}
+        # the tasks handling messages, which must be referenced until they are done
+        self.handlers = set()
+        self.target_comms = {}
 
     def register_comm(self, comm: comm.base_comm.BaseComm) -> str:
         comm = cast(Comm, comm)
         comm_id = comm.comm_id
         comm.kernel = self.kernel
         self.comms[comm_id] = comm
+        if comm.target_name not in self.target_comms:
+            self.target_comms[comm.target_name] = set()
+        self.target_comms[comm.target_name].add(comm_id)
         return comm_id
+
+    def unregister_comm(self, comm: comm.base_comm.BaseComm) -> None:
+        super().unregister_comm(comm)
+        comm_ids = self.target_comms.get(comm.target_name, set())
+        comm_ids.discard(comm.comm_id)
+        if not comm_ids:
+            self.target_comms.pop(comm.target_name, None)
+        # the dispatcher of the comm shares this queue, it will find it empty
+        pending = self.pending.pop(comm.comm_id, deque())
+        while pending:
+            comm_, msg = pending.popleft()
+            comm_.end_activity(msg)
+        self.semaphores.pop(comm.comm_id, None)
+        self.concurrency.pop(comm.comm_id, None)
+
+    def get_comm_info(self, target_name: str | None = None) -> Dict[str, Dict[str, str]]:
+        """Return the open comms, optionally only the ones of a target."""
+        if target_name is None:
+            return {
+                comm_id: {"target_name": target_name}
+                for target_name, comm_ids in self.target_comms.items()
+                for comm_id in comm_ids
+            }
+        return {
+            comm_id: {"target_name": target_name}
+            for comm_id in self.target_comms.get(target_name, ())
+        }
+
+    def comm_open(self, stream, ident, msg) -> None:  # type: ignore[no-untyped-def]
+        from akernel.kernel import PARENT_VAR
+
+        def comm_open() -> None:
+            # the comm is created with the frontend request as parent
+            PARENT_VAR.set(msg)
+            super(CommManager, self).comm_open(stream, ident, msg)
+
+        contextvars.copy_context().run(comm_open)
+
+    def comm_close(self, stream, ident, msg) -> None:  # type: ignore[no-untyped-def]
+        comm_id = msg["content"]["comm_id"]
+        comm = self.get_comm(comm_id)
+        if comm is None:
+            return
+
+        comm._closed = True
+        self.unregister_comm(comm)
+        try:
+            comm.handle_close(msg)
+        except Exception:
+            logger.error("Exception in comm_close for %s", comm_id, exc_info=True)
+
+    def set_max_concurrency(self, comm_id: str, max_concurrency: int) -> None:
+        """Set how many messages of a comm can be handled at the same time. Messages are
+        always handled in the order they were received, but with a limit greater than 1 a
+        message can be handled before the previous one is done.
+        """
+        self.concurrency[comm_id] = max_concurrency
+        self.semaphores.pop(comm_id, None)
+
+    def comm_msg(self, stream, ident, msg) -> None:  # type: ignore[no-untyped-def]
+        # don't block the shell channel: messages are handled in tasks
+        comm_id = msg["content"]["comm_id"]
+        comm = cast(Comm, self.get_comm(comm_id))
+        if comm is None:
+            return
+
+        # the kernel is busy until the message is handled, a burst of messages only
+        # results in one busy/idle transition
+        comm.begin_activity(msg)
+        if comm_id not in self.pending:
+            self.pending[comm_id] = deque()
+        self.pending[comm_id].append((comm, msg))
+        if comm_id not in self.dispatchers:
+            self.dispatchers[comm_id] = asyncio.create_task(self.dispatch(comm_id))
+
+    async def dispatch(self, comm_id: str) -> None:
+        try:
+            if comm_id not in self.semaphores:
+                max_concurrency = self.concurrency.get(comm_id, self.max_concurrency)
+                self.semaphores[comm_id] = asyncio.Semaphore(max_concurrency)
+            semaphore = self.semaphores[comm_id]
+            pending = self.pending.get(comm_id, deque())
+            while pending:
+                comm, msg = pending.popleft()
+                # the semaphore is fair, so messages start being handled in order
+                await semaphore.acquire()
+                task = asyncio.create_task(self.handle_msg(comm, msg, semaphore))
+                self.handlers.add(task)
+                task.add_done_callback(self.handler_done)
+        finally:
+            del self.dispatchers[comm_id]
+
+    def handler_done(self, task: asyncio.Task) -> None:
+        self.handlers.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Exception in comm message handler", exc_info=task.exception())
+
+    async def handle_msg(
+        self, comm: Comm, msg: Dict[str, Any], semaphore: asyncio.Semaphore
+    ) -> None:
+        try:
+            if not comm._closed:
+                await comm.ahandle_msg(msg)
+        except Exception:
+            logger.error("Exception in comm_msg for %s", comm.comm_id, exc_info=True)
+        finally:
+            semaphore.release()
+            comm.end_activity(msg)
@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import builtins
+import keyword
+import re
+from bisect import bisect_left, insort
+from types import ModuleType
+from typing import Any, Dict, Iterable, List, Tuple
+
+
+# maximum number of completions returned for a request
+MAX_COMPLETIONS = 1000
+# the dotted name before the cursor
+NAME_RE = re.compile(r"[^\W\d][\w.]*$|$")
+STATIC_NAMES = sorted(set(keyword.kwlist) | set(keyword.softkwlist) | set(dir(builtins)))
+
+
+def lookup(namespace: Dict[str, Any], path: List[str]) -> Any:
+    """Return the object at a dotted path, looking up attributes but without evaluating calls
+    or subscripts. Raises an exception if it is not found.
+    """
+    if path[0] in namespace:
+        obj = namespace[path[0]]
+    else:
+        obj = getattr(builtins, path[0])
+    for name in path[1:]:
+        obj = getattr(obj, name)
+    return obj
+
+
+def get_prefixed(names: List[str], prefix: str, limit: int = MAX_COMPLETIONS) -> List[str]:
+    """Return the names of a sorted list that start with prefix."""
+    matches: List[str] = []
+    for i in range(bisect_left(names, prefix), len(names)):
+        name = names[i]
+        if not name.startswith(prefix) or len(matches) == limit:
+            break
+        matches.append(name)
+    return matches
+
+
+class CompletionIndex:
+    """The sorted names of a namespace, which is searched by prefix. It is updated with the
+    names bound by each cell, rather than listing the namespace for each completion.
+    """
+
+    def __init__(self, namespace: Dict[str, Any]) -> None:
+        self.namespace = namespace
+        self.rebuild()
+        # attribute names of modules, by module name
+        self.module_names: Dict[str, Tuple[int, List[str]]] = {}
+
+    def rebuild(self) -> None:
+        self.names = sorted(name for name in self.namespace if isinstance(name, str))
+
+    def update(self, names: Iterable[str]) -> None:
+        """Update the index with names that may have been bound or deleted."""
+        for name in names:
+            i = bisect_left(self.names, name)
+            present = i < len(self.names) and self.names[i] == name
+            if name in self.namespace and not present:
+                insort(self.names, name)
+            elif name not in self.namespace and present:
+                del self.names[i]
+        self.check()
+
+    def check(self) -> None:
+        if len(self.names) != len(self.namespace):
+            # names bound in another way, e.g. by a loop, or by calling exec()
+            self.rebuild()
+
+    def get_attribute_names(self, obj: Any) -> List[str]:
+        if isinstance(obj, ModuleType):
+            # modules can be big and their content rarely changes
+            size = len(obj.__dict__)
+            cached = self.module_names.get(obj.__name__)
+            if cached is None or cached[0] != size:
+                cached = self.module_names[obj.__name__] = (size, sorted(dir(obj)))
+            return cached[1]
+        return sorted(dir(obj))
+
+    def complete(self, code: str, cursor_pos: int) -> Dict[str, Any]:
+        match = NAME_RE.search(code, 0, cursor_pos)
+        assert match is not None
+        *path, prefix = match.group().split(".")
+        cursor_start = cursor_pos - len(prefix)
+        if path:
+            try:
+                names = self.get_attribute_names(lookup(self.namespace, path))
+            except Exception:
+                names = []
+            matches = get_prefixed(names, prefix)
+            if not prefix:
+                # private attributes only if asked for
+                matches = [name for name in matches if not name.startswith("_")]
+        elif prefix:
+            self.check()
+            matches = get_prefixed(self.names, prefix) + get_prefixed(STATIC_NAMES, prefix)
+            matches = sorted(set(matches))[:MAX_COMPLETIONS]
+        else:
+            matches = []
+        return {
+            "matches": matches,
+            "cursor_start": cursor_start,
+            "cursor_end": cursor_pos,
+            "metadata": {},
+            "status": "ok",
+        }
@@ -1,19 +1,281 @@
+from __future__ import annotations
+
+import asyncio
+import base64
+import reprlib
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Any, Callable, Dict, Set, Tuple
+
+from ..execution import record_output
+from ..memory import estimate_size
 from ..message import create_message, serialize
 
 
-def display(*args, raw: bool = False) -> None:
-    from akernel.kernel import KERNEL, PARENT_VAR
+# minimum time in seconds between two updates of the same display, updates in between are
+# coalesced (only the last one is sent)
+UPDATE_DISPLAY_INTERVAL = 0.05
+# time at which each display was last updated
+_last_updates: Dict[str, float] = {}
+# the latest update of a display which was too recent to be sent, and its parent header
+_pending_updates: Dict[str, Tuple[Dict[str, Any], Dict[str, Any]]] = {}
+# the rich representations of an object, by method
+REPR_METHODS = {
+    "_repr_html_": "text/html",
+    "_repr_markdown_": "text/markdown",
+    "_repr_svg_": "image/svg+xml",
+    "_repr_png_": "image/png",
+    "_repr_jpeg_": "image/jpeg",
+    "_repr_latex_": "text/latex",
+    "_repr_json_": "application/json",
+}
+# maximum size in characters of the plain text representation of an object
+MAX_TEXT_SIZE = 100_000
+# objects bigger than this (in bytes) are rendered in a thread
+RENDER_INLINE_SIZE = 100_000
+# objects whose type took longer than this (in seconds) to render are then rendered in a thread
+RENDER_INLINE_TIME = 0.1
+# time in seconds after which the rendering of an object is given up
+RENDER_TIMEOUT = 5
+# maximum number of threads rendering objects, the renderings that timed out can still use them
+RENDER_THREADS = 4
+
+# the types which are slow to render
+_slow_types: Set[type] = set()
+_render_executor = ThreadPoolExecutor(RENDER_THREADS, thread_name_prefix="render")
+
+
+class TextRepr(reprlib.Repr):
+    """Like repr(), but bounded in size: long containers and strings are abbreviated, and
+    deeply nested containers are elided.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.maxlevel = 6
+        self.maxtuple = self.maxlist = self.maxarray = 1000
+        self.maxdict = self.maxset = self.maxfrozenset = self.maxdeque = 1000
+        self.maxstring = self.maxlong = self.maxother = MAX_TEXT_SIZE
+
+    def repr_int(self, x, level) -> str:
+        try:
+            return super().repr_int(x, level)
+        except ValueError:
+            # exceeds the limit for integer string conversion
+            return f"<int with {x.bit_length()} bits>"
+
+    def repr_dict(self, x, level) -> str:
+        # keep the insertion order, like repr()
+        if not x:
+            return "{}"
+        if level <= 0:
+            return "{...}"
+        pieces = [
+            f"{self.repr1(key, level - 1)}: {self.repr1(value, level - 1)}"
+            for key, value in islice(x.items(), self.maxdict)
+        ]
+        if len(x) > self.maxdict:
+            pieces.append("...")
+        return "{" + ", ".join(pieces) + "}"
+
+
+text_repr = TextRepr()
+
+
+class DisplayHandle:
+    """A handle on a displayed object, which can be updated in place."""
+
+    def __init__(self, display_id: str | None = None) -> None:
+        if display_id is None:
+            display_id = uuid.uuid4().hex
+        self.display_id = display_id
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} display_id={self.display_id}>"
+
+    def display(self, obj, **kwargs) -> None:
+        display(obj, display_id=self.display_id, **kwargs)
+
+    def update(self, obj, **kwargs) -> None:
+        update_display(obj, display_id=self.display_id, **kwargs)
+
+
+def get_mimebundle(obj, formatters: Dict[type, Callable] | None = None) -> Dict[str, Any]:
+    for cls in type(obj).__mro__ if formatters else ():
+        if cls in formatters:  # type: ignore[operator]
+            try:
+                data = formatters[cls](obj)  # type: ignore[index]
+            except Exception:
+                break
+            if isinstance(data, str):
+                data = {"text/plain": data}
+            return data
+    if getattr(obj, "_repr_mimebundle_", None) is not None:
+        try:
+            data = obj._repr_mimebundle_()
+        except Exception:
+            # fall back to the other representations
+            pass
+        else:
+            if isinstance(data, tuple):
+                # (data, metadata)
+                data = data[0]
+            return data
+    data = {"text/plain": text_repr.repr(obj)}
+    for method, mime_type in REPR_METHODS.items():
+        repr_method = getattr(obj, method, None)
+        if not callable(repr_method):
+            continue
+        try:
+            value = repr_method()
+        except Exception:
+            continue
+        if value is None:
+            continue
+        # binary payloads are encoded when they are sent
+        data[mime_type] = value
+    return data
+
+
+async def render(
+    obj, formatters: Dict[type, Callable] | None = None, timeout: float = RENDER_TIMEOUT
+) -> Dict[str, Any]:
+    """Return the MIME bundle of an object. Big objects, and objects of a type that was
+    already slow to render, are rendered in a thread, so that the event loop is not blocked,
+    and if it takes more than timeout seconds a placeholder is returned.
+    """
+    type_ = type(obj)
+    if type_ not in _slow_types and estimate_size(obj) < RENDER_INLINE_SIZE:
+        t0 = time.perf_counter()
+        data = get_mimebundle(obj, formatters)
+        if time.perf_counter() - t0 > RENDER_INLINE_TIME and type_.__module__ != "builtins":
+            _slow_types.add(type_)
+        return data
+    loop = asyncio.get_running_loop()
+    try:
+        return await asyncio.wait_for(
+            loop.run_in_executor(_render_executor, get_mimebundle, obj, formatters), timeout
+        )
+    except asyncio.TimeoutError:
+        # a running thread cannot be stopped, but the cell is not held up by it
+        return {"text/plain": f"<{type_.__name__} object, rendering timed out>"}
+
+
+def encode_data(content: Dict[str, Any]) -> Dict[str, Any]:
+    """Base64-encode the binary MIME payloads (e.g. image/png) of the data of a display
+    message, which are kept as bytes until then (e.g. in the cache).
+    """
+    data = content.get("data")
+    if not isinstance(data, dict) or not any(
+        isinstance(value, (bytes, bytearray, memoryview)) for value in data.values()
+    ):
+        return content
+    data = {
+        mime_type: (
+            base64.b64encode(value).decode()
+            if isinstance(value, (bytes, bytearray, memoryview))
+            else value
+        )
+        for mime_type, value in data.items()
+    }
+    return dict(content, data=data)
+
+
+def send(msg_type: str, content: Dict[str, Any], parent_header: Dict[str, Any]) -> None:
+    from akernel.kernel import KERNEL
 
-    parent_header = PARENT_VAR.get()["header"]
-    data = args[0]
     msg = create_message(
-        "display_data",
-        content=dict(data=data, transient={}, metadata={}),
-        parent_header=parent_header,
+        msg_type, content=encode_data(content), metadata={}, parent_header=parent_header
     )
     to_send = serialize(msg, KERNEL.key)
     KERNEL.from_iopub_send_stream.send_nowait(to_send)
 
 
-def clear_output() -> None:
-    pass
+def display(
+    *objs,
+    raw: bool = False,
+    display_id: str | bool | None = None,
+    update: bool = False,
+    metadata: Dict[str, Any] | None = None,
+) -> DisplayHandle | None:
+    from akernel.kernel import KERNEL, PARENT_VAR
+
+    parent_header = PARENT_VAR.get()["header"]
+    if display_id is True:
+        display_id = uuid.uuid4().hex
+    if update and not display_id:
+        raise TypeError("display_id required for update")
+    transient = {} if not display_id else {"display_id": display_id}
+    for obj in objs:
+        data = obj if raw else get_mimebundle(obj, KERNEL.formatters)
+        content = dict(data=data, transient=transient, metadata=metadata or {})
+        if update:
+            assert isinstance(display_id, str)
+            update_display_data(display_id, content, parent_header)
+        else:
+            if display_id:
+                # the previous updates must not overwrite the new output
+                flush_update(display_id)
+            record_output("display_data", content)
+            send("display_data", content, parent_header)
+    if display_id:
+        assert isinstance(display_id, str)
+        return DisplayHandle(display_id)
+    return None
+
+
+def update_display(obj, *, display_id: str, **kwargs) -> None:
+    display(obj, display_id=display_id, update=True, **kwargs)
+
+
+def update_display_data(
+    display_id: str, content: Dict[str, Any], parent_header: Dict[str, Any]
+) -> None:
+    now = time.monotonic()
+    if display_id in _pending_updates:
+        # a flush is already scheduled, only the last update will be sent
+        _pending_updates[display_id] = (content, parent_header)
+        return
+    elapsed = now - _last_updates.get(display_id, -UPDATE_DISPLAY_INTERVAL)
+    if elapsed >= UPDATE_DISPLAY_INTERVAL:
+        _send_update(display_id, content, parent_header)
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        _send_update(display_id, content, parent_header)
+        return
+    _pending_updates[display_id] = (content, parent_header)
+    loop.call_later(UPDATE_DISPLAY_INTERVAL - elapsed, flush_update, display_id)
+
+
+def flush_update(display_id: str) -> None:
+    if display_id in _pending_updates:
+        content, parent_header = _pending_updates.pop(display_id)
+        _send_update(display_id, content, parent_header)
+
+
+def _send_update(display_id: str, content: Dict[str, Any], parent_header: Dict[str, Any]) -> None:
+    now = time.monotonic()
+    if len(_last_updates) > 1000:
+        # forget about the displays that are not updated anymore
+        for key, last_update in list(_last_updates.items()):
+            if now - last_update >= UPDATE_DISPLAY_INTERVAL:
+                del _last_updates[key]
+    _last_updates[display_id] = now
+    record_output("update_display_data", content)
+    send("update_display_data", content, parent_header)
+
+
+def clear_output(wait: bool = False) -> None:
+    """Clear the output of the cell, or with wait=True when the next output is displayed
+    (which avoids flickering).
+    """
+    from akernel.kernel import PARENT_VAR
+
+    parent_header = PARENT_VAR.get()["header"]
+    content = {"wait": wait}
+    record_output("clear_output", content)
+    send("clear_output", content, parent_header)
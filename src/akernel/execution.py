@@ -1,13 +1,358 @@
 from __future__ import annotations
 
+import ast
 import hashlib
+import importlib.metadata
+import importlib.util
+import os
 import pickle
-from typing import List, Dict, Tuple, Any
+import sys
+import time
+import types
+from contextvars import ContextVar
+from functools import lru_cache
+from typing import Callable, List, Dict, Set, Tuple, Any
 
 from colorama import Fore, Style  # type: ignore
 
 from .code import Transform
-from .traceback import get_traceback
+from .traceback import get_cell_filename, get_traceback, register_cell
+
+
+CELL_OUTPUTS_VAR: ContextVar[CellOutputs | None] = ContextVar("cell_outputs", default=None)
+
+
+class CellOutputs:
+    """The stream and display messages of a cell execution, captured to be cached."""
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.size = 0
+        self.truncated = False
+        self.clear_on_next = False
+        self.messages: List[Tuple[str, Dict[str, Any]]] = []
+
+    def add(self, msg_type: str, content: Dict[str, Any]) -> None:
+        if msg_type == "clear_output":
+            if content["wait"]:
+                self.clear_on_next = True
+            else:
+                self.clear()
+            return
+        if self.clear_on_next:
+            self.clear()
+        if self.truncated:
+            return
+        if msg_type == "stream":
+            size = len(content["text"])
+        else:
+            size = sum(
+                len(v) if isinstance(v, (str, bytes)) else len(str(v))
+                for v in content["data"].values()
+            )
+        self.size += size
+        if self.size > self.max_size:
+            self.truncated = True
+            return
+        if msg_type == "stream" and self.messages:
+            # merge consecutive writes to the same stream
+            last_type, last_content = self.messages[-1]
+            if last_type == "stream" and last_content["name"] == content["name"]:
+                last_content["text"] += content["text"]
+                return
+        self.messages.append((msg_type, dict(content)))
+
+    def clear(self) -> None:
+        # only the outputs after a clear are replayed
+        self.messages = []
+        self.size = 0
+        self.truncated = False
+        self.clear_on_next = False
+
+    def get(self) -> List[Tuple[str, Dict[str, Any]]]:
+        if self.truncated:
+            text = f"[output truncated to {self.max_size} bytes in cache]\n"
+            return self.messages + [("stream", {"name": "stderr", "text": text})]
+        return self.messages
+
+
+def record_output(msg_type: str, content: Dict[str, Any]) -> None:
+    cell_outputs = CELL_OUTPUTS_VAR.get()
+    if cell_outputs is not None:
+        cell_outputs.add(msg_type, content)
+
+
+class CachedOutput:
+    """A reference to a cell output in the cache, which is only loaded when it is first used,
+    or when the next cell that is not cached runs.
+    """
+
+    __slots__ = ("_cache", "_key", "_value")
+
+    def __init__(self, cache: Dict[str, Any], key: str) -> None:
+        self._cache: Dict[str, Any] | None = cache
+        self._key = key
+        self._value = None
+
+    def _load(self) -> Any:
+        if self._cache is not None:
+            self._value = self._cache[self._key]
+            self._cache = None
+        return self._value
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._load(), name)
+
+    def __call__(self, *args, **kwargs) -> Any:
+        return self._load()(*args, **kwargs)
+
+
+def _forward(name: str):
+    def method(self, *args):
+        return getattr(self._load(), name)(*args)
+
+    method.__name__ = name
+    return method
+
+
+# special methods are looked up on the type, so they must be forwarded explicitly
+for _name in (
+    "__repr__",
+    "__str__",
+    "__format__",
+    "__bool__",
+    "__len__",
+    "__iter__",
+    "__reversed__",
+    "__contains__",
+    "__getitem__",
+    "__setitem__",
+    "__delitem__",
+    "__eq__",
+    "__ne__",
+    "__lt__",
+    "__le__",
+    "__gt__",
+    "__ge__",
+    "__hash__",
+    "__add__",
+    "__radd__",
+    "__sub__",
+    "__rsub__",
+    "__mul__",
+    "__rmul__",
+    "__matmul__",
+    "__rmatmul__",
+    "__truediv__",
+    "__rtruediv__",
+    "__floordiv__",
+    "__rfloordiv__",
+    "__mod__",
+    "__rmod__",
+    "__pow__",
+    "__rpow__",
+    "__and__",
+    "__rand__",
+    "__or__",
+    "__ror__",
+    "__xor__",
+    "__rxor__",
+    "__neg__",
+    "__pos__",
+    "__abs__",
+    "__invert__",
+    "__index__",
+    "__int__",
+    "__float__",
+    "__enter__",
+    "__exit__",
+):
+    setattr(CachedOutput, _name, _forward(_name))
+
+
+def load_cached_output(value: Any) -> Any:
+    """Return the value of a cached output, or the value itself if it is not one."""
+    return value._load() if isinstance(value, CachedOutput) else value
+
+
+def load_cached_outputs(
+    names, globals_: Dict[str, Any], lineage: Dict[str, Tuple[str, Any]] | None = None
+) -> None:
+    for name in names:
+        value = globals_.get(name)
+        if isinstance(value, CachedOutput):
+            globals_[name] = value._load()
+            if lineage is not None and name in lineage and lineage[name][1] is value:
+                lineage[name] = (lineage[name][0], globals_[name])
+
+
+def load_cell_globals(
+    globals_: Dict[str, Any], lineage: Dict[str, Tuple[str, Any]] | None = None
+) -> None:
+    """Load all the cached outputs of a namespace, before a cell runs: it can use them
+    indirectly (e.g. through a function), and a reference is not a drop-in replacement for them
+    (e.g. for type() or json.dumps()).
+    """
+    load_cached_outputs(list(globals_), globals_, lineage)
+
+
+def update_lineage(
+    lineage: Dict[str, Tuple[str, Any]], hash: str, names, globals_: Dict[str, Any]
+) -> None:
+    for name in names:
+        if name in globals_:
+            value = globals_[name]
+            if not isinstance(value, types.ModuleType):
+                # the variable is tagged with the cache key of the cell execution that produced it
+                lineage[name] = (hash + name, value)
+
+
+@lru_cache(maxsize=None)
+def get_distribution_version(name: str) -> str | None:
+    try:
+        return importlib.metadata.version(name)
+    except (importlib.metadata.PackageNotFoundError, ValueError):
+        return None
+
+
+def get_module_spec(name: str):
+    module = sys.modules.get(name)
+    if module is not None:
+        return module.__spec__
+    try:
+        return importlib.util.find_spec(name)
+    except (ImportError, ValueError):
+        return None
+
+
+def get_module_fingerprint(name: str, spec) -> str:
+    """Identify the version of a module that an import statement would bind."""
+    version = getattr(sys.modules.get(name), "__version__", None)
+    if version is None:
+        version = get_distribution_version(name.split(".")[0])
+    origin = spec.origin
+    mtime = None
+    if origin is not None and os.path.isfile(origin):
+        mtime = os.stat(origin).st_mtime_ns
+    return f"{name}:{version}:{origin}:{mtime}"
+
+
+def get_imports_fingerprint(imports: List[ast.Import | ast.ImportFrom]) -> str:
+    names = []
+    for node in imports:
+        if isinstance(node, ast.ImportFrom):
+            assert node.module is not None
+            names.append(node.module)
+            spec = get_module_spec(node.module)
+            if spec is not None and spec.submodule_search_locations is not None:
+                # the imported names of a package may be submodules
+                names += [f"{node.module}.{alias.name}" for alias in node.names]
+        else:
+            names += [alias.name for alias in node.names]
+    fingerprints = []
+    for name in names:
+        spec = get_module_spec(name)
+        fingerprints.append(f"{name}:None" if spec is None else get_module_fingerprint(name, spec))
+    return "\n".join(fingerprints)
+
+
+def invalidate_lineage(
+    lineage: Dict[str, Tuple[str, Any]] | None, cache_info: Dict[str, Any]
+) -> None:
+    if lineage is not None and "outputs" in cache_info:
+        for name in cache_info["outputs"] | cache_info["mutated"]:
+            lineage.pop(name, None)
+
+
+def get_input_key(
+    name: str, globals_: Dict[str, Any], lineage: Dict[str, Tuple[str, Any]] | None
+) -> bytes | None:
+    value = globals_[name]
+    if lineage is not None and name in lineage:
+        key, obj = lineage[name]
+        if obj is value:
+            return key.encode()
+        # the variable was re-bound outside of a tracked cell execution
+        del lineage[name]
+    try:
+        return pickle.dumps(value)
+    except Exception:
+        # FIXME
+        # cannot pickle inputs, let's abort caching
+        return None
+
+
+def get_digest(value: Any, pickled: bytes | None = None) -> bytes | None:
+    try:
+        return hashlib.sha256(pickle.dumps(value) if pickled is None else pickled).digest()
+    except Exception:
+        # cannot compare it, it will be considered as mutated
+        return None
+
+
+def get_user_codes(value: Any, globals_: Dict[str, Any]) -> List[types.CodeType]:
+    if isinstance(value, types.FunctionType):
+        return [value.__code__] if value.__globals__ is globals_ else []
+    if isinstance(value, type):
+        # instantiating a class runs its methods
+        codes = []
+        for attr in vars(value).values():
+            # unwrap static and class methods
+            attr = getattr(attr, "__func__", attr)
+            if isinstance(attr, types.FunctionType) and attr.__globals__ is globals_:
+                codes.append(attr.__code__)
+        return codes
+    return []
+
+
+def get_digests(
+    names: Set[str], globals_: Dict[str, Any], pickled: Dict[str, bytes]
+) -> Dict[str, bytes | None]:
+    """Fingerprint the variables that a cell may mutate in place, before it runs: only the
+    ones that it actually mutates are cached."""
+    return {
+        k: get_digest(globals_[k], pickled.get(k))
+        for k in names
+        if k in globals_ and not isinstance(globals_[k], types.ModuleType)
+    }
+
+
+def get_called_globals(called: Set[str], globals_: Dict[str, Any]) -> Set[str]:
+    """Return the global variables that the user-defined functions and classes called by a
+    cell refer to, directly or through the functions they call: they may be read or mutated
+    in place, e.g. `def f(): x.append(1)`."""
+    names: Set[str] = set()
+    todo = [globals_[k] for k in called if k in globals_]
+    seen: Set[int] = set()
+    while todo:
+        value = todo.pop()
+        if id(value) in seen:
+            continue
+        seen.add(id(value))
+        codes = get_user_codes(value, globals_)
+        while codes:
+            code = codes.pop()
+            # nested functions, comprehensions...
+            codes.extend(c for c in code.co_consts if isinstance(c, types.CodeType))
+            for name in code.co_names:
+                if name in globals_ and name not in names:
+                    names.add(name)
+                    todo.append(globals_[name])
+    return names
+
+
+def run_imports(imports: List[ast.Import | ast.ImportFrom], globals_: Dict[str, Any]) -> bool:
+    """Execute only the import statements of a cached cell, to re-bind the imported names."""
+    if not imports:
+        return True
+    body: List[ast.stmt] = list(imports)
+    module = ast.Module(body=body, type_ignores=[])
+    try:
+        exec(compile(module, filename="<string>", mode="exec"), globals_)
+    except Exception:
+        # let the cell run and report the error
+        return False
+    return True
 
 
 def pre_execute(
@@ -18,15 +363,31 @@ def pre_execute(
     execution_count: int = 0,
     react: bool = False,
     cache: Dict[str, Any] | None = None,
+    code_hash: str = "ast",
+    lineage: Dict[str, Tuple[str, Any]] | None = None,
+    trace: Callable[[str, float, float], None] | None = None,
 ) -> Tuple[List[str], SyntaxError | None, Dict[str, Any]]:
     traceback = []
     exception = None
     cache_info: Dict[str, Any] = {"cached": False}
 
     try:
+        t0 = time.perf_counter()
         transform = Transform(code, task_i, react)
-        async_bytecode = transform.get_async_bytecode()
+        if cache is not None and code_hash == "ast":
+            # must be done before the AST is transformed for async execution
+            code_to_hash = transform.get_normalized_code()
+        else:
+            code_to_hash = code
+        t1 = time.perf_counter()
+        # the cell is only registered if it runs
+        cell_filename = get_cell_filename()
+        async_bytecode = transform.get_async_bytecode(cell_filename)
         exec(async_bytecode, globals_, locals_)
+        if trace is not None:
+            trace("transform", t0, t1)
+            # including the transformation of the AST for async execution
+            trace("compile", t1, time.perf_counter())
     except SyntaxError as e:
         exception = e
         filename = exception.filename
@@ -46,56 +407,100 @@ def pre_execute(
             f"{Fore.RED}{type(exception).__name__}{Style.RESET_ALL}: {exception.args[0]}",
         ]
     else:
-        if cache is not None:
-            inputs = transform.globals - transform.outputs
+        # calls to user-defined functions may use and mutate any global variable they refer to
+        called_globals = get_called_globals(transform.called, globals_)
+        mutated = transform.mutated | {
+            k
+            for k in called_globals
+            if not isinstance(globals_[k], (types.ModuleType, types.FunctionType, type))
+        }
+        cache_info["names"] = transform.names
+        cache_info["mutated"] = mutated
+        if cache is None:
+            register_cell(cell_filename, code, execution_count)
+        else:
+            inputs = (transform.globals | called_globals) - transform.outputs - transform.imported
             outputs = transform.outputs
+            # the inputs are hashed from their value, unless their lineage is known
+            load_cached_outputs(
+                [
+                    k
+                    for k in inputs
+                    if lineage is None or k not in lineage or lineage[k][1] is not globals_.get(k)
+                ],
+                globals_,
+                lineage,
+            )
             # print(f"Inputs = {inputs}")
             # print(f"Outputs = {outputs}")
             sha = hashlib.sha256()
-            sha.update(code.encode())
-            for k in inputs:
-                try:
-                    sha.update(pickle.dumps(globals_[k]))
-                except Exception:
-                    # FIXME
-                    # cannot pickle inputs, let's abort caching
-                    # return traceback, exception, cache_info
-                    pass
+            sha.update(code_to_hash.encode())
+            if transform.cacheable_imports:
+                # the cell depends on the version of the modules it imports
+                sha.update(get_imports_fingerprint(transform.imports).encode())
+            pickled: Dict[str, bytes] = {}
+            # sorted, so that the hash doesn't depend on the process
+            for k in sorted(inputs):
+                if k in globals_:
+                    # with lineage, inputs are identified by the cell execution that produced
+                    # them, otherwise by their value
+                    input_key = get_input_key(k, globals_, lineage)
+                    if input_key is not None:
+                        sha.update(k.encode())
+                        sha.update(input_key)
+                        if lineage is None:
+                            pickled[k] = input_key
 
             hash = sha.hexdigest()
-            if transform.has_import:
-                # cells that have 'import' must always be executed
+            if transform.has_import and not transform.cacheable_imports:
+                # cells that have nested or relative imports must always be executed
+                register_cell(cell_filename, code, execution_count)
+                load_cell_globals(globals_, lineage)
                 cache_info = {
                     "cached": False,
                     "hash": hash,
                     "outputs": outputs,
+                    "mutated": mutated,
+                    "digests": get_digests(mutated, globals_, pickled),
+                    "names": transform.names,
                 }
                 return traceback, exception, cache_info
 
             # let's see if we have a cache for these particular inputs
             for k in cache.keys():
                 if k.startswith(hash):
+                    if not run_imports(transform.imports, globals_):
+                        break
                     # this cell was cached, no need to run it
-                    # let's just load the outputs
+                    # let's just reference the outputs, they will be loaded when a cell runs
                     # print("Execution cached")
                     name_i = len(hash)
                     for k in cache.keys():
                         if k.startswith(hash):
                             name = k[name_i:]
-                            if name != "__akernel_cell_result__":
-                                globals_[name] = cache[k]
-                                # print(f"Retrieving {name} = {globals_[name]}")
+                            if not name.startswith("__akernel_cell_"):
+                                globals_[name] = CachedOutput(cache, k)
+                    if lineage is not None:
+                        update_lineage(lineage, hash, outputs | mutated, globals_)
+                    iopub_key = f"{hash}__akernel_cell_iopub__"
                     cache_info = {
                         "cached": True,
                         "result": cache[f"{hash}__akernel_cell_result__"],
+                        "iopub": cache[iopub_key] if iopub_key in cache else [],
+                        "names": transform.names,
                     }
                     return traceback, exception, cache_info
 
             # this cell was not cached
+            register_cell(cell_filename, code, execution_count)
+            load_cell_globals(globals_, lineage)
             cache_info = {
                 "cached": False,
                 "hash": hash,
                 "outputs": outputs,
+                "mutated": mutated,
+                "digests": get_digests(mutated, globals_, pickled),
+                "names": transform.names,
             }
 
     return traceback, exception, cache_info
@@ -106,14 +511,24 @@ def cache_execution(
     cache_info: Dict[str, Any],
     globals_: Dict[str, Any],
     result: Any,
+    cell_outputs: CellOutputs | None = None,
+    lineage: Dict[str, Tuple[str, Any]] | None = None,
 ):
     if cache is not None:
         # this cell execution was not cached, let's cache it
         assert not cache_info["cached"]
         hash = cache_info["hash"]
+        if lineage is not None:
+            update_lineage(lineage, hash, cache_info["outputs"] | cache_info["mutated"], globals_)
         cache_error = False
-        # let's store the outputs
-        for k in cache_info["outputs"]:
+        # let's store the outputs, and the variables that were actually mutated in place, which
+        # must be restored too if the cell execution is served from the cache
+        outputs = cache_info["outputs"] | {
+            k
+            for k, digest in cache_info["digests"].items()
+            if k in globals_ and (digest is None or get_digest(globals_[k]) != digest)
+        }
+        for k in outputs:
             try:
                 cache[hash + k] = globals_[k]
                 # print(f"Caching {k} = {globals_[k]}")
@@ -121,11 +536,15 @@ def cache_execution(
                 cache_error = True
                 break
         if cache_error:
-            for k in cache_info["outputs"]:
+            for k in outputs:
                 try:
                     del cache[hash + k]
                 except Exception:
                     break
+            # the outputs cannot be restored, the cell will have to run again
+            return
+        if cell_outputs is not None:
+            cache[f"{hash}__akernel_cell_iopub__"] = cell_outputs.get()
         cache[f"{hash}__akernel_cell_result__"] = result
 
 
@@ -136,11 +555,14 @@ async def execute(
     locals_: Dict[str, Any],
     react: bool = False,
     cache: Dict[str, Any] | None = None,
+    cache_output_size: int = 2**20,
+    code_hash: str = "ast",
+    lineage: Dict[str, Tuple[str, Any]] | None = None,
 ) -> Tuple[Any, List[str], bool]:
     result = None
     interrupted = False
     traceback, exception, cache_info = pre_execute(
-        code, globals_, locals_, react=react, cache=cache
+        code, globals_, locals_, react=react, cache=cache, code_hash=code_hash, lineage=lineage
     )
     if traceback:
         return result, traceback, interrupted
@@ -148,13 +570,18 @@ async def execute(
     if cache_info["cached"]:
         result = cache_info["result"]
     else:
+        cell_outputs = None if cache is None else CellOutputs(cache_output_size)
+        CELL_OUTPUTS_VAR.set(cell_outputs)
         try:
             result = await locals_["__async_cell__"]()
         except KeyboardInterrupt:
             interrupted = True
         except Exception as e:
             traceback = get_traceback(code, e)
+            invalidate_lineage(lineage, cache_info)
         else:
-            cache_execution(cache, cache_info, globals_, result)
+            cache_execution(cache, cache_info, globals_, result, cell_outputs, lineage)
+        finally:
+            CELL_OUTPUTS_VAR.set(None)
 
     return result, traceback, interrupted
@@ -0,0 +1,232 @@
+from __future__ import annotations
+
+import logging
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+
+
+logger = logging.getLogger("History")
+
+# time in seconds during which history entries are batched before being written
+HISTORY_BATCH_INTERVAL = 0.1
+# maximum number of entries kept for each session, the oldest ones are deleted
+HISTORY_SESSION_SIZE = 10000
+# maximum number of the most recent entries scanned by a search, which cannot use an index
+HISTORY_SEARCH_SIZE = 100_000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT UNIQUE NOT NULL
+);
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session INTEGER NOT NULL,
+    execution_count INTEGER NOT NULL,
+    code TEXT NOT NULL,
+    status TEXT NOT NULL,
+    duration REAL NOT NULL,
+    time REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS history_session ON history (session, execution_count);
+"""
+
+
+def get_data_dir() -> str:
+    """Return the user's Jupyter data directory, which is writable even if akernel is
+    installed system-wide.
+    """
+    if os.environ.get("JUPYTER_DATA_DIR"):
+        return os.environ["JUPYTER_DATA_DIR"]
+    home = os.path.expanduser("~")
+    if sys.platform == "darwin":
+        return os.path.join(home, "Library", "Jupyter")
+    if sys.platform == "win32":
+        return os.path.join(os.environ.get("APPDATA", home), "jupyter")
+    return os.path.join(
+        os.environ.get("XDG_DATA_HOME") or os.path.join(home, ".local", "share"), "jupyter"
+    )
+
+
+def get_history_path() -> str:
+    return os.path.join(get_data_dir(), "akernel", "history.sqlite")
+
+
+def open_history(path: str) -> HistoryStore | None:
+    """Open the history database, or return None if it cannot be used (e.g. read-only file
+    system), in which case the history is not recorded.
+    """
+    try:
+        return HistoryStore(path)
+    except (OSError, sqlite3.Error):
+        logger.warning(
+            "Cannot open the history database %s, history is disabled", path, exc_info=True
+        )
+        return None
+
+
+def connect(path: str) -> sqlite3.Connection:
+    # several kernels (or worker processes) can use the same database
+    connection = sqlite3.connect(path, timeout=10)
+    connection.execute("PRAGMA journal_mode=WAL")
+    return connection
+
+
+class HistoryStore:
+    """The history of the execution requests, in an SQLite database. Entries are written in
+    batches by a background thread, and read in a thread too, so that the event loop never
+    waits for the database.
+    """
+
+    def __init__(self, path: str, session_size: int = HISTORY_SESSION_SIZE) -> None:
+        self.path = path
+        self.session_size = session_size
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with connect(path) as connection:
+            connection.executescript(SCHEMA)
+        connection.close()
+        self.queue: queue.Queue[Tuple[str, int, str, str, float, float] | None] = queue.Queue()
+        self.thread = threading.Thread(target=self.write, daemon=True)
+        self.thread.start()
+
+    def record(
+        self, session: str, execution_count: int, code: str, status: str, duration: float
+    ) -> None:
+        self.queue.put((session, execution_count, code, status, duration, time.time()))
+
+    def close(self) -> None:
+        self.queue.put(None)
+        self.thread.join()
+
+    def flush(self) -> None:
+        """Wait until the recorded entries are written."""
+        self.queue.join()
+
+    def write(self) -> None:
+        connection = connect(self.path)
+        session_ids: Dict[str, int] = {}
+        stop = False
+        while not stop:
+            entries = [self.queue.get()]
+            deadline = time.monotonic() + HISTORY_BATCH_INTERVAL
+            while entries[-1] is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    entries.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            if entries[-1] is None:
+                stop = True
+            rows = []
+            for entry in entries:
+                if entry is None:
+                    continue
+                session, *values = entry
+                if session not in session_ids:
+                    connection.execute(
+                        "INSERT OR IGNORE INTO sessions (name) VALUES (?)", (session,)
+                    )
+                    session_ids[session] = connection.execute(
+                        "SELECT id FROM sessions WHERE name = ?", (session,)
+                    ).fetchone()[0]
+                rows.append((session_ids[session], *values))
+            with connection:
+                connection.executemany(
+                    "INSERT INTO history (session, execution_count, code, status, duration, time) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+                for session_id in {row[0] for row in rows}:
+                    # bound the size of the session
+                    connection.execute(
+                        "DELETE FROM history WHERE session = ? AND id <= ("
+                        "SELECT id FROM history WHERE session = ? ORDER BY id DESC "
+                        "LIMIT 1 OFFSET ?)",
+                        (session_id, session_id, self.session_size),
+                    )
+            for _ in entries:
+                self.queue.task_done()
+        connection.close()
+
+    def get_history(
+        self,
+        session: str,
+        hist_access_type: str,
+        session_number: int = 0,
+        start: int = 0,
+        stop: int | None = None,
+        n: int | None = None,
+        pattern: str = "*",
+        unique: bool = False,
+        all_sessions: bool = True,
+        search_size: int = HISTORY_SEARCH_SIZE,
+    ) -> List[Tuple[int, int, str]]:
+        """Return the (session number, execution count, code) entries of a history_request.
+        Sessions are numbered in the order they were first recorded. In a range, session
+        number 0 is the current session, and negative numbers are counted back from it.
+        If all_sessions is False, only the current session can be looked at. A search is
+        linear, it only looks at the last search_size entries.
+        """
+        self.flush()
+        connection = connect(self.path)
+        try:
+            row = connection.execute(
+                "SELECT id FROM sessions WHERE name = ?", (session,)
+            ).fetchone()
+            session_id = -1 if row is None else row[0]
+            query = "SELECT session, execution_count, code FROM history"
+            params: List[Any] = []
+            if hist_access_type == "range":
+                if not all_sessions and session_number != 0:
+                    return []
+                if session_number <= 0:
+                    if session_number < 0:
+                        row = connection.execute(
+                            "SELECT id FROM sessions WHERE id < ? ORDER BY id DESC "
+                            "LIMIT 1 OFFSET ?",
+                            (session_id, -session_number - 1),
+                        ).fetchone()
+                        session_id = -1 if row is None else row[0]
+                else:
+                    session_id = session_number
+                query += " WHERE session = ? AND execution_count >= ?"
+                params += [session_id, start]
+                if stop is not None:
+                    query += " AND execution_count < ?"
+                    params.append(stop)
+                return connection.execute(query + " ORDER BY id", params).fetchall()
+            conditions = []
+            if not all_sessions:
+                conditions.append("session = ?")
+                params.append(session_id)
+            if hist_access_type == "search":
+                # the range of the primary key is scanned before matching the pattern
+                conditions.append("id > (SELECT MAX(id) FROM history) - ?")
+                conditions.append("code GLOB ?")
+                params += [search_size, pattern]
+            elif hist_access_type != "tail":
+                return []
+            if unique:
+                # the most recent entry of each code
+                query = (
+                    "SELECT session, execution_count, code FROM history WHERE id IN ("
+                    "SELECT MAX(id) FROM history"
+                    + (f" WHERE {' AND '.join(conditions)}" if conditions else "")
+                    + " GROUP BY code)"
+                )
+            elif conditions:
+                query += f" WHERE {' AND '.join(conditions)}"
+            query += " ORDER BY id DESC"
+            if n is not None:
+                query += " LIMIT ?"
+                params.append(n)
+            return connection.execute(query, params).fetchall()[::-1]
+        finally:
+            connection.close()
@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import inspect
+import re
+from typing import Any, Dict, Iterable, List, Tuple
+
+from .completion import lookup
+from .display.display import text_repr
+from .execution import load_cached_output
+from .memory import estimate_size
+
+
+# the dotted name before the cursor, and the rest of the name after it
+NAME_BEFORE_RE = re.compile(r"[^\W\d][\w.]*$")
+NAME_AFTER_RE = re.compile(r"\w*")
+# maximum size in characters of the string form of an inspected object
+MAX_STRING_FORM_SIZE = 1000
+
+
+def get_name_at(code: str, cursor_pos: int) -> str:
+    before = NAME_BEFORE_RE.search(code, 0, cursor_pos)
+    after = NAME_AFTER_RE.match(code, cursor_pos)
+    assert after is not None
+    return ((before.group() if before else "") + after.group()).strip(".")
+
+
+def inspect_object(
+    namespace: Dict[str, Any], code: str, cursor_pos: int, detail_level: int = 0
+) -> Dict[str, Any]:
+    """Return the content of the inspect_reply for the name at the cursor: its signature, type,
+    string form, file and docstring, and also its source if detail_level is 1.
+    """
+    name = get_name_at(code, cursor_pos)
+    try:
+        obj = load_cached_output(lookup(namespace, name.split(".")))
+    except Exception:
+        return {"status": "ok", "found": False, "data": {}, "metadata": {}}
+    info: List[Tuple[str, str]] = []
+    if callable(obj):
+        try:
+            info.append(("Signature", f"{name}{inspect.signature(obj)}"))
+        except (TypeError, ValueError):
+            pass
+    info.append(("Type", type(obj).__name__))
+    if not callable(obj) and not inspect.ismodule(obj):
+        string_form = text_repr.repr(obj)
+        if len(string_form) > MAX_STRING_FORM_SIZE:
+            string_form = string_form[:MAX_STRING_FORM_SIZE] + "..."
+        info.append(("String form", string_form))
+    try:
+        info.append(("File", inspect.getfile(obj)))
+    except TypeError:
+        pass
+    info.append(("Docstring", inspect.getdoc(obj) or "<no docstring>"))
+    if detail_level > 0:
+        try:
+            # the source of the functions defined in cells is in linecache too
+            info.append(("Source", inspect.getsource(obj)))
+        except (OSError, TypeError):
+            pass
+    text = "\n".join(f"{key}: {value}" for key, value in info)
+    return {"status": "ok", "found": True, "data": {"text/plain": text}, "metadata": {}}
+
+
+def summarize(name: str, value: Any) -> Dict[str, Any]:
+    summary: Dict[str, Any] = {
+        "name": name,
+        "type": type(value).__name__,
+        # in bounded time, even for huge containers
+        "size": estimate_size(value),
+    }
+    try:
+        shape = getattr(value, "shape", None)
+        if isinstance(shape, tuple) and all(isinstance(i, int) for i in shape):
+            summary["shape"] = list(shape)
+        elif not isinstance(value, type):
+            summary["len"] = len(value)
+    except Exception:
+        pass
+    return summary
+
+
+class VariableSummaries:
+    """The summaries of the variables of a namespace, for a variable explorer. They are computed
+    when they are requested, and cached until the variable is re-bound or mutated by a cell.
+    """
+
+    def __init__(self, namespace: Dict[str, Any]) -> None:
+        self.namespace = namespace
+        # the ID of the summarized value and its summary, by name
+        self.summaries: Dict[str, Tuple[int, Dict[str, Any]]] = {}
+
+    def invalidate(self, names: Iterable[str]) -> None:
+        for name in names:
+            self.summaries.pop(name, None)
+
+    def get(self, name: str) -> Dict[str, Any]:
+        # the outputs of a cached cell are summarized from their value in the cache
+        value = load_cached_output(self.namespace[name])
+        cached = self.summaries.get(name)
+        # a variable can also be re-bound outside of a cell, e.g. by a function
+        if cached is None or cached[0] != id(value):
+            cached = self.summaries[name] = (id(value), summarize(name, value))
+        return cached[1]
+
+    def get_page(self, names: List[str], start: int, limit: int) -> Dict[str, Any]:
+        return {
+            "variables": [self.get(name) for name in names[start : start + limit]],
+            "total": len(names),
+        }
@@ -1,22 +1,44 @@
 from __future__ import annotations
 
 import asyncio
+import contextlib
+import os
 import sys
 import platform
-import json
+import tempfile
+import threading
+import time
+import tracemalloc
+from functools import partial
+from collections import deque
 from io import StringIO
 from contextvars import ContextVar
-from typing import Dict, Any, List, Union, Awaitable, cast
+from typing import Deque, Dict, Any, List, Tuple, Awaitable, Callable
 
-from anyio import Event, create_task_group, sleep
+from anyio import Event, Lock, create_task_group, sleep, to_thread
 import comm  # type: ignore
 from akernel.comm.manager import CommManager
 from akernel.display import display
 import akernel.IPython
 from akernel.IPython import core
-from .message import create_message, feed_identities, deserialize, serialize
-from .execution import pre_execute, cache_execution
-from .traceback import get_traceback
+from .message import SENT_MESSAGES, create_message, feed_identities, deserialize, serialize
+from .completion import CompletionIndex
+from .history import HistoryStore, open_history
+from .inspection import VariableSummaries, inspect_object
+from .execution import (
+    CELL_OUTPUTS_VAR,
+    CellOutputs,
+    pre_execute,
+    cache_execution,
+    invalidate_lineage,
+    record_output,
+)
+from .memory import estimate_size
+from .metrics import CellMetrics, IOPubStream, KernelMetrics, run_metered
+from .output import FdCapture, OutStream
+from .session import get_spill_path, restore_namespace, spill_namespace
+from .traceback import get_evalue, get_traceback
+from .tracing import Tracer
 from . import __version__
 
 
@@ -25,6 +47,9 @@ IDENTS_VAR: ContextVar = ContextVar("idents")
 
 KERNEL: "Kernel"
 
+# how often (in seconds) idle sessions are looked for, in multi-kernel mode
+SESSION_EVICTION_INTERVAL = 1
+
 
 sys.modules["IPython.display"] = display
 sys.modules["IPython"] = akernel.IPython
@@ -37,18 +62,50 @@ class Kernel:
     key: str
     comm_manager: CommManager
     kernel_mode: str
-    cell_done: Dict[int, Event]
     running_cells: Dict[int, asyncio.Task]
     task_i: int
-    execution_count: int
     execution_state: str
+    activity: int
+    comm_status: bool
+    capture_fd: bool
+    fd_captures: List[FdCapture]
+    history_file: str | None
+    history: HistoryStore | None
+    trace_memory: bool
+    last_parent_header: Dict[str, Any] | None
+    loop: asyncio.AbstractEventLoop | None
+    thread_id: int | None
+    execution_count: Dict[str, int]
+    execution_queues: Dict[str, Deque[Tuple[List[bytes], Dict[str, Any]]]]
+    ready_sessions: Deque[str]
+    aborted_executions: Deque[Tuple[List[bytes], Dict[str, Any]]]
+    session_weights: Dict[str, int]
+    session_running: Dict[str, int]
+    session_tasks: Dict[str, List[int]]
+    session_done: Dict[str, asyncio.Event]
     globals: Dict[str, Dict[str, Any]]
     locals: Dict[str, Dict[str, Any]]
+    lineage: Dict[str, Dict[str, Tuple[str, Any]]]
     _multi_kernel: bool | None
     _cache_kernel: bool | None
     _react_kernel: bool | None
     kernel_initialized: set[str]
+    last_activity: Dict[str, float]
+    session_size: Dict[str, Tuple[int, float]]
+    spilled: Dict[str, Dict[str, Any]]
+    spill_lock: Lock
+    cell_namespace: Dict[int, str]
     cache: Dict[str, Any] | None
+    template: Dict[str, Any] | None
+    input_requests: Dict[str, asyncio.Future]
+    formatters: Dict[type, Callable[[Any], Any]]
+    completion_indexes: Dict[str, CompletionIndex]
+    variable_summaries: Dict[str, VariableSummaries]
+    cell_metrics: Dict[str, CellMetrics]
+    metrics: KernelMetrics
+    trace_file: str | None
+    trace_format: str
+    tracer: Tracer | None
 
     def __init__(
         self,
@@ -61,10 +118,24 @@ class Kernel:
         from_iopub_send_stream,
         kernel_mode: str = "",
         cache_dir: str | None = None,
+        cache_output_size: int = 2**20,
+        code_hash: str = "ast",
+        input_hash: str = "value",
+        session_memory: int | None = None,
+        session_idle_timeout: float | None = None,
+        spill_dir: str | None = None,
+        startup: str | None = None,
+        comm_concurrency: int = 1,
+        comm_status: bool = True,
+        capture_fd: bool = False,
+        history_file: str | None = None,
+        trace_memory: bool = False,
+        trace_file: str | None = None,
+        trace_format: str = "jsonl",
     ):
         global KERNEL
         KERNEL = self
-        self.comm_manager = CommManager()
+        self.comm_manager = CommManager(comm_concurrency)
         comm.get_comm_manager = lambda: self.comm_manager
 
         self.to_shell_receive_stream = to_shell_receive_stream
@@ -73,10 +144,23 @@ class Kernel:
         self.from_control_send_stream = from_control_send_stream
         self.to_stdin_receive_stream = to_stdin_receive_stream
         self.from_stdin_send_stream = from_stdin_send_stream
-        self.from_iopub_send_stream = from_iopub_send_stream
+        # the metrics of the execution requests, by message ID
+        self.cell_metrics = {}
+        self.metrics = KernelMetrics()
+        self.from_iopub_send_stream = IOPubStream(
+            from_iopub_send_stream, PARENT_VAR, self.cell_metrics
+        )
 
         self.kernel_mode = kernel_mode
         self.cache_dir = cache_dir
+        self.cache_output_size = cache_output_size
+        self.code_hash = code_hash
+        self.input_hash = input_hash
+        self.session_memory = session_memory
+        self.session_idle_timeout = session_idle_timeout
+        self.spill_dir = spill_dir
+        self.startup = startup
+        self.template = None
         self._concurrent_kernel = None
         self._multi_kernel = None
         self._cache_kernel = None
@@ -84,12 +168,38 @@ class Kernel:
         self.kernel_initialized = set()
         self.globals = {}
         self.locals = {}
+        self.lineage = {}
+        self.last_activity = {}
+        self.session_size = {}
+        self.spilled = {}
+        # sessions are spilled and restored one at a time, in a thread
+        self.spill_lock = Lock()
+        self.cell_namespace = {}
         self._chain_execution = not self.concurrent_kernel
-        self.cell_done = {}
         self.running_cells = {}
         self.task_i = 0
-        self.execution_count = 1
         self.execution_state = "starting"
+        self.activity = 0
+        self.comm_status = comm_status
+        self.capture_fd = capture_fd
+        self.fd_captures = []
+        self.history_file = history_file
+        self.history = None
+        self.trace_memory = trace_memory
+        self.trace_file = trace_file
+        self.trace_format = trace_format
+        self.tracer = None
+        self.last_parent_header = None
+        self.loop = None
+        self.thread_id = None
+        self.execution_count = {}
+        self.execution_queues = {}
+        self.ready_sessions = deque()
+        self.aborted_executions = deque()
+        self.session_weights = {}
+        self.session_running = {}
+        self.session_tasks = {}
+        self.session_done = {}
         self.restart = False
         self.interrupted = False
         self.msg_cnt = 0
@@ -101,6 +211,12 @@ class Kernel:
             self.cache = None
         self.stop_event = Event()
         self.key = "0"
+        self.dispatch_event = asyncio.Event()
+        # input requests waiting for their reply, by message ID
+        self.input_requests = {}
+        self.formatters = {}
+        self.completion_indexes = {}
+        self.variable_summaries = {}
 
     def chain_execution(self) -> None:
         self._chain_execution = True
@@ -132,41 +248,299 @@ class Kernel:
             self._react_kernel = "react" in self.kernel_mode
         return self._react_kernel
 
-    def init_kernel(self, namespace):
+    async def restore_session(self, namespace: str) -> None:
+        """Initialize a session, reading its variables in a thread if it was spilled, so that
+        the other sessions don't wait for it.
+        """
+        if namespace in self.spilled:
+            async with self.spill_lock:
+                # it could have been restored or closed while waiting for the lock
+                if namespace in self.spilled:
+                    assert self.spill_dir is not None
+                    path = get_spill_path(self.spill_dir, namespace)
+                    restored = await to_thread.run_sync(restore_namespace, path)
+                    if namespace in self.spilled:
+                        self.init_kernel(namespace, restored)
+        self.init_kernel(namespace)
+
+    def init_kernel(self, namespace, restored: Dict[str, Any] | None = None):
+        self.last_activity[namespace] = time.monotonic()
         if namespace in self.kernel_initialized:
             return
 
-        self.globals[namespace] = {
-            "ainput": self.ainput,
-            "asyncio": asyncio,
-            "print": self.print,
-            "__task__": self.task,
-            "__chain_execution__": self.chain_execution,
-            "__unchain_execution__": self.unchain_execution,
-            "_": None,
-        }
         self.locals[namespace] = {}
-        if self.react_kernel:
-            code = (
-                "import ipyx, ipywidgets;globals().update({'ipyx': ipyx, 'ipywidgets': ipywidgets})"
-            )
-            exec(code, self.globals[namespace], self.locals[namespace])
+        self.lineage[namespace] = {}
+        if namespace in self.spilled:
+            # the namespace was evicted from memory, let's restore it in the same dictionary,
+            # which is the globals of the functions that were kept in memory
+            assert self.spill_dir is not None
+            if restored is None:
+                restored = restore_namespace(get_spill_path(self.spill_dir, namespace))
+            globals_ = self.spilled.pop(namespace)
+            kept = dict(globals_)
+            globals_.clear()
+            globals_.update(self.get_template())
+            globals_.update(restored)
+            globals_.update(kept)
+            self.globals[namespace] = globals_
+        else:
+            # shallow copy, the template objects are shared between sessions
+            self.globals[namespace] = dict(self.get_template())
 
         self.kernel_initialized.add(namespace)
 
+    def get_template(self) -> Dict[str, Any]:
+        """Return the namespace which new sessions are initialized from. It is created once,
+        by importing the modules and running the startup script.
+        """
+        if self.template is None:
+            template = {
+                "ainput": self.ainput,
+                "asyncio": asyncio,
+                "print": self.print,
+                "__task__": self.task,
+                "__register_formatter__": self.register_formatter,
+                "__chain_execution__": self.chain_execution,
+                "__unchain_execution__": self.unchain_execution,
+                "_": None,
+            }
+            if self.react_kernel:
+                code = "import ipyx, ipywidgets"
+                exec(code, template)
+            if self.startup is not None:
+                with open(self.startup) as f:
+                    code = f.read()
+                exec(compile(code, self.startup, "exec"), template)
+            self.template = template
+        return self.template
+
+    def is_template_object(self, name: str, value: Any) -> bool:
+        return name in self.get_template() and self.get_template()[name] is value
+
+    def is_idle(self, namespace: str) -> bool:
+        return not self.session_running.get(namespace) and not self.execution_queues.get(namespace)
+
+    async def spill_session(self, namespace: str) -> None:
+        async with self.spill_lock:
+            # it could have become active while waiting for the lock
+            if namespace not in self.kernel_initialized or not self.is_idle(namespace):
+                return
+            if self.spill_dir is None:
+                self.spill_dir = tempfile.mkdtemp(prefix="akernel-sessions-")
+            path = get_spill_path(self.spill_dir, namespace)
+            globals_ = self.globals.pop(namespace)
+            # from now on, the session has to be restored before it is used again, which waits
+            # for the lock
+            self.spilled[namespace] = globals_
+            self.completion_indexes.pop(namespace, None)
+            self.variable_summaries.pop(namespace, None)
+            del self.locals[namespace]
+            del self.lineage[namespace]
+            self.session_size.pop(namespace, None)
+            self.kernel_initialized.remove(namespace)
+            kept = await to_thread.run_sync(
+                spill_namespace,
+                path,
+                {
+                    k: v
+                    for k, v in globals_.items()
+                    # these will be re-created when the namespace is restored
+                    if k != "__builtins__" and not self.is_template_object(k, v)
+                },
+            )
+            if self.spilled.get(namespace) is not globals_:
+                # the session was closed while it was spilled
+                os.remove(path)
+                return
+            # the dictionary is kept, but only with the variables that were not spilled, so
+            # that the spilled values are released
+            globals_.clear()
+            globals_.update(kept)
+
+    def close_session(self, namespace: str) -> None:
+        for task_i, cell_namespace in list(self.cell_namespace.items()):
+            if cell_namespace == namespace:
+                # the cell doesn't count in the session anymore when it finishes
+                del self.cell_namespace[task_i]
+                if task_i in self.running_cells:
+                    self.running_cells.pop(task_i).cancel()
+        if namespace in self.execution_queues:
+            self.aborted_executions.extend(self.execution_queues.pop(namespace))
+            if namespace in self.ready_sessions:
+                self.ready_sessions.remove(namespace)
+            self.dispatch_event.set()
+        self.execution_count.pop(namespace, None)
+        self.session_weights.pop(namespace, None)
+        self.session_running.pop(namespace, None)
+        self.session_tasks.pop(namespace, None)
+        self.session_done.pop(namespace, None)
+        if namespace in self.spilled:
+            assert self.spill_dir is not None
+            # it may not be written yet, or already read
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(get_spill_path(self.spill_dir, namespace))
+            del self.spilled[namespace]
+        if namespace in self.kernel_initialized:
+            del self.globals[namespace]
+            del self.locals[namespace]
+            del self.lineage[namespace]
+            self.kernel_initialized.remove(namespace)
+        self.last_activity.pop(namespace, None)
+        self.session_size.pop(namespace, None)
+        self.completion_indexes.pop(namespace, None)
+        self.variable_summaries.pop(namespace, None)
+
+    async def evict_sessions(self) -> None:
+        now = time.monotonic()
+        idle = [namespace for namespace in self.kernel_initialized if self.is_idle(namespace)]
+        # least recently active first
+        idle.sort(key=lambda namespace: self.last_activity[namespace])
+        if self.session_idle_timeout is not None:
+            for namespace in list(idle):
+                if now - self.last_activity[namespace] < self.session_idle_timeout:
+                    break
+                await self.spill_session(namespace)
+                idle.remove(namespace)
+        if self.session_memory is not None:
+            total_size = 0
+            for namespace in self.kernel_initialized:
+                size, estimated_at = self.session_size.get(namespace, (0, -1.0))
+                if estimated_at < self.last_activity[namespace]:
+                    # the namespace may have changed since its size was estimated
+                    size = sum(
+                        estimate_size(v)
+                        for k, v in self.globals[namespace].items()
+                        # the template is shared between sessions
+                        if not self.is_template_object(k, v)
+                    )
+                    self.session_size[namespace] = (size, now)
+                total_size += size
+            for namespace in idle:
+                if total_size <= self.session_memory:
+                    break
+                total_size -= self.session_size[namespace][0]
+                await self.spill_session(namespace)
+
+    async def evict_idle_sessions(self) -> None:
+        while True:
+            await sleep(SESSION_EVICTION_INTERVAL)
+            await self.evict_sessions()
+
+    def get_completion_index(self, namespace: str) -> CompletionIndex:
+        self.init_kernel(namespace)
+        index = self.completion_indexes.get(namespace)
+        if index is None or index.namespace is not self.globals[namespace]:
+            # the namespace was re-created, e.g. restored after being spilled
+            index = self.completion_indexes[namespace] = CompletionIndex(self.globals[namespace])
+        return index
+
+    def get_variables(self, namespace: str, start: int = 0, limit: int = 100) -> Dict[str, Any]:
+        """Return a page of the summaries of the user variables of a session."""
+        index = self.get_completion_index(namespace)
+        index.check()
+        globals_ = self.globals[namespace]
+        names = [
+            name
+            for name in index.names
+            if not name.startswith("_") and not self.is_template_object(name, globals_[name])
+        ]
+        summaries = self.variable_summaries.get(namespace)
+        if summaries is None or summaries.namespace is not globals_:
+            summaries = self.variable_summaries[namespace] = VariableSummaries(globals_)
+        return summaries.get_page(names, start, limit)
+
+    def update_indexes(self, namespace: str, cache_info: Dict[str, Any]) -> None:
+        # the indexes are only maintained once they have been requested
+        globals_ = self.globals.get(namespace)
+        index = self.completion_indexes.get(namespace)
+        if index is not None and index.namespace is globals_:
+            index.update(cache_info.get("names", ()))
+        summaries = self.variable_summaries.get(namespace)
+        if summaries is not None and summaries.namespace is globals_:
+            summaries.invalidate(cache_info.get("names", set()) | cache_info.get("mutated", set()))
+
     def get_namespace(self, parent_header) -> str:
         if self.multi_kernel:
             return parent_header["session"]
 
         return "namespace"
 
+    def get_lineage(self, namespace: str) -> Dict[str, Tuple[str, Any]] | None:
+        if self.input_hash == "lineage":
+            return self.lineage[namespace]
+        return None
+
     def interrupt(self):
         self.interrupted = True
         for task in self.running_cells.values():
             task.cancel()
         self.running_cells = {}
+        for queue in self.execution_queues.values():
+            self.aborted_executions.extend(queue)
+            queue.clear()
+        self.ready_sessions.clear()
+        self.dispatch_event.set()
+
+    def begin_activity(self) -> bool:
+        """Count an activity (e.g. a cell execution) starting, and return True if the kernel
+        was idle.
+        """
+        self.activity += 1
+        self.execution_state = "busy"
+        return self.activity == 1
+
+    def end_activity(self) -> bool:
+        """Count an activity ending, and return True if the kernel is now idle."""
+        self.activity -= 1
+        if self.activity == 0:
+            self.execution_state = "idle"
+            return True
+        return False
+
+    def set_session_weight(self, namespace: str, weight: int) -> None:
+        """Set how many cells of a session are dispatched per round, when cells are not
+        chained.
+        """
+        self.session_weights[namespace] = weight
+
+    def session_stats(self) -> Dict[str, Dict[str, int]]:
+        return {
+            namespace: {
+                "execution_count": self.execution_count.get(namespace, 1) - 1,
+                "queue_depth": len(self.execution_queues.get(namespace, ())),
+                "running": self.session_running.get(namespace, 0),
+            }
+            for namespace in self.kernel_initialized | set(self.execution_queues)
+        }
+
+    def redirect_output(self) -> None:
+        """Send what is written to sys.stdout and sys.stderr to the frontend, and optionally
+        what is written to the file descriptors 1 and 2.
+        """
+        self.loop = asyncio.get_running_loop()
+        self.thread_id = threading.get_ident()
+        for name, fd in (("stdout", 1), ("stderr", 2)):
+            original = getattr(sys, name)
+            if self.capture_fd:
+                original.flush()
+                fd_capture = FdCapture(name, self, fd, self.loop)
+                self.fd_captures.append(fd_capture)
+                original = fd_capture.original
+            setattr(sys, name, OutStream(name, self, original))
+
+    def flush_output(self, msg_id: str) -> None:
+        for stream in (sys.stdout, sys.stderr):
+            if isinstance(stream, OutStream):
+                stream.flush_parent(msg_id)
 
     async def start(self) -> None:
+        self.redirect_output()
+        if self.history_file:
+            self.history = open_history(self.history_file)
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self.trace_file:
+            self.tracer = Tracer(self.trace_file, self.trace_format)
         async with create_task_group() as self.task_group:
             msg = self.create_message("status", content={"execution_state": self.execution_state})
             to_send = serialize(msg, self.key)
@@ -182,10 +556,22 @@ class Kernel:
                         break
                 finally:
                     self.task_group.cancel_scope.cancel()
+        if self.history is not None:
+            self.history.close()
+        if self.tracer is not None:
+            self.tracer.close()
 
     async def _start(self) -> None:
+        # don't make the first session pay for the template creation
+        self.get_template()
         self.task_group.start_soon(self.listen_shell)
         self.task_group.start_soon(self.listen_control)
+        self.task_group.start_soon(self.listen_stdin)
+        self.task_group.start_soon(self.dispatch_executions)
+        if self.multi_kernel and (
+            self.session_memory is not None or self.session_idle_timeout is not None
+        ):
+            self.task_group.start_soon(self.evict_idle_sessions)
         while True:
             # run until shutdown request
             await self.stop_event.wait()
@@ -196,6 +582,51 @@ class Kernel:
                 # kernel shutdown
                 break
 
+    def receive_message(
+        self, msg_list: List[bytes], channel: str
+    ) -> Tuple[List[bytes], Dict[str, Any]]:
+        t0 = time.perf_counter()
+        idents, msg_list = feed_identities(msg_list)
+        msg = deserialize(msg_list)
+        t1 = time.perf_counter()
+        self.metrics.deserialize.record(t1 - t0)
+        header = msg["header"]
+        self.metrics.received[header["msg_type"]] += 1
+        if self.tracer is not None:
+            received = self.tracer.received[channel]
+            # from the reception of the message from the frontend, if it is known
+            self.tracer.span("recv", received.popleft() if received else t0, t0, header)
+            self.tracer.span("deserialize", t0, t1, header)
+        return idents, msg
+
+    def get_metrics(self) -> Dict[str, Any]:
+        streams = {
+            name: getattr(self, f"{name}_stream")
+            for name in (
+                "to_shell_receive",
+                "from_shell_send",
+                "to_control_receive",
+                "from_control_send",
+                "to_stdin_receive",
+                "from_stdin_send",
+            )
+        }
+        streams["from_iopub_send"] = self.from_iopub_send_stream.stream
+        return {
+            "received": dict(self.metrics.received),
+            "sent": dict(SENT_MESSAGES),
+            "latencies": self.metrics.get_latencies(),
+            "queue_depths": {
+                name: stream.statistics().current_buffer_used
+                for name, stream in streams.items()
+                if stream is not None
+            },
+            "running_cells": len(self.running_cells),
+            "pending_cells": sum(len(queue) for queue in self.execution_queues.values()),
+            "cache": self.metrics.get_cache(),
+            "iopub_backlog_bytes": self.from_iopub_send_stream.get_backlog(),
+        }
+
     async def listen_shell(self) -> None:
         while True:
             # let a chance to execute a blocking cell
@@ -206,8 +637,7 @@ class Kernel:
             if self.interrupted and self.to_shell_receive_stream.statistics().tasks_waiting_send == 0:
                 self.interrupted = False
             msg_list = await self.to_shell_receive_stream.receive()
-            idents, msg_list = feed_identities(msg_list)
-            msg = deserialize(msg_list)
+            idents, msg = self.receive_message(msg_list, "shell")
             msg_type = msg["header"]["msg_type"]
             parent_header = msg["header"]
             parent = msg
@@ -240,106 +670,116 @@ class Kernel:
                 to_send = serialize(msg, self.key)
                 await self.from_iopub_send_stream.send(to_send)
             elif msg_type == "execute_request":
-                self.execution_state = "busy"
-                code = msg["content"]["code"]
+                # clients wait for the idle status of their request, so it is always sent,
+                # even if the kernel is still busy with other requests
+                self.begin_activity()
                 msg = self.create_message(
                     "status",
                     parent_header=parent_header,
-                    content={"execution_state": self.execution_state},
+                    content={"execution_state": "busy"},
                 )
                 to_send = serialize(msg, self.key)
                 await self.from_iopub_send_stream.send(to_send)
                 if self.interrupted:
                     await self.finish_execution(idents, parent_header, None, no_exec=True)
                     continue
-                msg = self.create_message(
-                    "execute_input",
-                    parent_header=parent_header,
-                    content={"code": code, "execution_count": self.execution_count},
-                )
-                to_send = serialize(msg, self.key)
-                await self.from_iopub_send_stream.send(to_send)
+                self.cell_metrics[parent_header["msg_id"]] = CellMetrics()
+                self.queue_execution(self.get_namespace(parent_header), idents, parent)
+            elif msg_type == "comm_info_request":
+                target_name = msg["content"].get("target_name")
+                content = {"status": "ok", "comms": self.comm_manager.get_comm_info(target_name)}
+                await self.send_reply(idents, parent_header, "comm_info_reply", content)
+            elif msg_type == "complete_request":
                 namespace = self.get_namespace(parent_header)
-                self.init_kernel(namespace)
-                traceback, exception, cache_info = pre_execute(
-                    code,
+                await self.restore_session(namespace)
+                index = self.get_completion_index(namespace)
+                content = index.complete(msg["content"]["code"], msg["content"]["cursor_pos"])
+                await self.send_reply(idents, parent_header, "complete_reply", content)
+            elif msg_type == "inspect_request":
+                namespace = self.get_namespace(parent_header)
+                await self.restore_session(namespace)
+                content = inspect_object(
                     self.globals[namespace],
-                    self.locals[namespace],
-                    self.task_i,
-                    self.execution_count,
-                    react=self.react_kernel,
-                    cache=self.cache,
+                    msg["content"]["code"],
+                    msg["content"]["cursor_pos"],
+                    msg["content"].get("detail_level", 0),
                 )
-                if cache_info["cached"]:
-                    await self.finish_execution(
-                        idents,
-                        parent_header,
-                        self.execution_count,
-                        result=cache_info["result"],
-                    )
-                    self.execution_count += 1
-                elif traceback:
-                    await self.finish_execution(
-                        idents,
-                        parent_header,
-                        self.execution_count,
-                        traceback=traceback,
-                        exception=exception,
-                    )
-                else:
-                    task = asyncio.create_task(
-                        self.execute_and_finish(
-                            idents,
-                            parent,
-                            self.task_i,
-                            self.execution_count,
-                            code,
-                            cache_info,
-                        )
-                    )
-                    self.cell_done[self.task_i] = asyncio.Event()
-                    self.running_cells[self.task_i] = task
-                    self.task_i += 1
-                    self.execution_count += 1
-            elif msg_type == "comm_info_request":
-                self.execution_state = "busy"
-                msg2 = self.create_message(
-                    "status",
-                    parent_header=parent_header,
-                    content={"execution_state": self.execution_state},
-                )
-                to_send = serialize(msg2, self.key)
-                await self.from_iopub_send_stream.send(to_send)
-                if "target_name" in msg["content"]:
-                    target_name = msg["content"]["target_name"]
-                    comms: List[str] = []
-                    msg2 = self.create_message(
-                        "comm_info_reply",
-                        parent_header=parent_header,
-                        content={
-                            "status": "ok",
-                            "comms": {comm_id: {"target_name": target_name} for comm_id in comms},
-                        },
-                        address=idents[0],
-                    )
-                    to_send = serialize(msg2, self.key)
-                    await self.from_shell_send_stream.send(to_send)
-                self.execution_state = "idle"
-                msg2 = self.create_message(
-                    "status",
-                    parent_header=parent_header,
-                    content={"execution_state": self.execution_state},
-                )
-                to_send = serialize(msg2, self.key)
-                await self.from_iopub_send_stream.send(to_send)
+                await self.send_reply(idents, parent_header, "inspect_reply", content)
+            elif msg_type == "history_request":
+                # the database is read in a thread, other requests don't have to wait
+                self.task_group.start_soon(self.reply_history, idents, msg)
             elif msg_type == "comm_msg":
                 self.comm_manager.comm_msg(None, None, msg)  # type: ignore[arg-type]
+            elif msg_type == "comm_open":
+                self.comm_manager.comm_open(None, None, msg)  # type: ignore[arg-type]
+            elif msg_type == "comm_close":
+                self.comm_manager.comm_close(None, None, msg)  # type: ignore[arg-type]
+
+    async def send_reply(
+        self,
+        idents: List[bytes],
+        parent_header: Dict[str, Any],
+        msg_type: str,
+        content: Dict[str, Any],
+    ) -> None:
+        # clients wait for the idle status of their request
+        self.begin_activity()
+        t0 = time.perf_counter()
+        msg = self.create_message(
+            "status",
+            parent_header=parent_header,
+            content={"execution_state": "busy"},
+        )
+        to_send = serialize(msg, self.key)
+        await self.from_iopub_send_stream.send(to_send)
+        msg = self.create_message(
+            msg_type,
+            parent_header=parent_header,
+            content=content,
+            address=idents[0],
+        )
+        to_send = serialize(msg, self.key)
+        await self.from_shell_send_stream.send(to_send)
+        if self.tracer is not None:
+            self.tracer.span("reply", t0, time.perf_counter(), parent_header)
+        self.end_activity()
+        msg = self.create_message(
+            "status",
+            parent_header=parent_header,
+            content={"execution_state": "idle"},
+        )
+        to_send = serialize(msg, self.key)
+        await self.from_iopub_send_stream.send(to_send)
+
+    async def reply_history(self, idents: List[bytes], msg: Dict[str, Any]) -> None:
+        content = msg["content"]
+        history: List[Any] = []
+        if self.history is not None:
+            history = await to_thread.run_sync(
+                partial(
+                    self.history.get_history,
+                    msg["header"]["session"],
+                    content["hist_access_type"],
+                    session_number=content.get("session", 0),
+                    start=content.get("start", 0),
+                    stop=content.get("stop"),
+                    n=content.get("n"),
+                    pattern=content.get("pattern", "*"),
+                    unique=content.get("unique", False),
+                    # the sessions of a multi-kernel are isolated
+                    all_sessions=not self.multi_kernel,
+                )
+            )
+        if content.get("output"):
+            # the outputs are not stored
+            history = [(session, line, (code, None)) for session, line, code in history]
+        content = {"status": "ok", "history": history}
+        await self.send_reply(idents, msg["header"], "history_reply", content)
 
     async def listen_control(self) -> None:
         while True:
             msg_list = await self.to_control_receive_stream.receive()
-            idents, msg_list = feed_identities(msg_list)
-            msg = deserialize(msg_list)
+            idents, msg = self.receive_message(msg_list, "control")
             msg_type = msg["header"]["msg_type"]
             parent_header = msg["header"]
             if msg_type == "shutdown_request":
@@ -353,8 +793,185 @@ class Kernel:
                 to_send = serialize(msg, self.key)
                 await self.from_control_send_stream.send(to_send)
                 if self.restart:
-                    self.execution_count = 1
+                    self.execution_count = {}
                 self.stop_event.set()
+            elif msg_type == "close_session_request":
+                # akernel-specific: drop a session in multi-kernel mode
+                namespace = msg["content"].get("session", parent_header["session"])
+                self.close_session(namespace)
+                msg = self.create_message(
+                    "close_session_reply",
+                    parent_header=parent_header,
+                    content={"status": "ok"},
+                    address=idents[0],
+                )
+                to_send = serialize(msg, self.key)
+                await self.from_control_send_stream.send(to_send)
+            elif msg_type == "metrics_request":
+                # akernel-specific: the counters and latency histograms of the kernel
+                msg = self.create_message(
+                    "metrics_reply",
+                    parent_header=parent_header,
+                    content={"status": "ok", **self.get_metrics()},
+                    address=idents[0],
+                )
+                to_send = serialize(msg, self.key)
+                await self.from_control_send_stream.send(to_send)
+            elif msg_type == "variables_request":
+                # akernel-specific: list the variables of a session, by pages
+                namespace = self.get_namespace(
+                    {"session": msg["content"].get("session", parent_header["session"])}
+                )
+                await self.restore_session(namespace)
+                content = self.get_variables(
+                    namespace, msg["content"].get("start", 0), msg["content"].get("limit", 100)
+                )
+                msg = self.create_message(
+                    "variables_reply",
+                    parent_header=parent_header,
+                    content={"status": "ok", **content},
+                    address=idents[0],
+                )
+                to_send = serialize(msg, self.key)
+                await self.from_control_send_stream.send(to_send)
+
+    def queue_execution(self, namespace: str, idents: List[bytes], parent: Dict[str, Any]) -> None:
+        if namespace not in self.execution_queues:
+            self.execution_queues[namespace] = deque()
+        self.execution_queues[namespace].append((idents, parent))
+        if namespace not in self.ready_sessions:
+            self.ready_sessions.append(namespace)
+        self.dispatch_event.set()
+
+    async def dispatch_executions(self) -> None:
+        """Start the queued cell executions, going round-robin through the sessions, so that a
+        session cannot starve the others. When cells are chained, a session's next cell is only
+        started when its previous cell is done.
+        """
+        while True:
+            await self.dispatch_event.wait()
+            self.dispatch_event.clear()
+            while self.aborted_executions:
+                idents, parent = self.aborted_executions.popleft()
+                await self.finish_execution(idents, parent["header"], None, no_exec=True)
+            # number of sessions in a row that couldn't start a cell
+            blocked = 0
+            while blocked < len(self.ready_sessions):
+                namespace = self.ready_sessions[0]
+                self.ready_sessions.rotate(-1)
+                if self._chain_execution and self.session_running.get(namespace):
+                    blocked += 1
+                    continue
+                blocked = 0
+                queue = self.execution_queues[namespace]
+                weight = 1 if self._chain_execution else self.session_weights.get(namespace, 1)
+                for _ in range(weight):
+                    if not queue:
+                        break
+                    idents, parent = queue.popleft()
+                    await self.start_execution(namespace, idents, parent)
+                if not queue and namespace in self.ready_sessions:
+                    self.ready_sessions.remove(namespace)
+
+    async def start_execution(
+        self, namespace: str, idents: List[bytes], parent: Dict[str, Any]
+    ) -> None:
+        parent_header = parent["header"]
+        execution_count = self.execution_count.get(namespace, 1)
+        metrics = self.cell_metrics.get(parent_header["msg_id"])
+        if metrics is not None:
+            metrics.start()
+            if self.tracer is not None:
+                self.tracer.span("queued", metrics.received_time, metrics.start_time, parent_header)
+        # the messages sent before the cell runs are accounted to its request
+        token = PARENT_VAR.set(parent)
+        try:
+            await self._start_execution(namespace, idents, parent, execution_count, metrics)
+        finally:
+            PARENT_VAR.reset(token)
+
+    async def _start_execution(
+        self,
+        namespace: str,
+        idents: List[bytes],
+        parent: Dict[str, Any],
+        execution_count: int,
+        metrics: CellMetrics | None,
+    ) -> None:
+        parent_header = parent["header"]
+        code = parent["content"]["code"]
+        msg = self.create_message(
+            "execute_input",
+            parent_header=parent_header,
+            content={"code": code, "execution_count": execution_count},
+        )
+        to_send = serialize(msg, self.key)
+        await self.from_iopub_send_stream.send(to_send)
+        await self.restore_session(namespace)
+        cpu_time = time.thread_time()
+        t0 = time.perf_counter()
+        traceback, exception, cache_info = pre_execute(
+            code,
+            self.globals[namespace],
+            self.locals[namespace],
+            self.task_i,
+            execution_count,
+            react=self.react_kernel,
+            cache=self.cache,
+            code_hash=self.code_hash,
+            lineage=self.get_lineage(namespace),
+            trace=None if self.tracer is None else partial(self.tracer.span, header=parent_header),
+        )
+        self.metrics.pre_execute.record(time.perf_counter() - t0)
+        if metrics is not None:
+            metrics.cpu_time += time.thread_time() - cpu_time
+        if self.cache is not None and not traceback:
+            if cache_info["cached"]:
+                self.metrics.cache_hits += 1
+            else:
+                self.metrics.cache_misses += 1
+        if cache_info["cached"]:
+            self.execution_count[namespace] = execution_count + 1
+            self.update_indexes(namespace, cache_info)
+            await self.finish_execution(
+                idents,
+                parent_header,
+                execution_count,
+                result=cache_info["result"],
+                iopub=cache_info["iopub"],
+                code=code,
+            )
+        elif traceback:
+            await self.finish_execution(
+                idents,
+                parent_header,
+                execution_count,
+                traceback=traceback,
+                exception=exception,
+                code=code,
+            )
+        else:
+            # cells of a session are chained together, not with the cells of other sessions
+            prev_done = self.session_done.get(namespace)
+            done = self.session_done[namespace] = asyncio.Event()
+            task = asyncio.create_task(
+                self.execute_and_finish(
+                    idents,
+                    parent,
+                    self.task_i,
+                    execution_count,
+                    code,
+                    cache_info,
+                    prev_done,
+                    done,
+                )
+            )
+            self.running_cells[self.task_i] = task
+            self.cell_namespace[self.task_i] = namespace
+            self.session_running[namespace] = self.session_running.get(namespace, 0) + 1
+            self.session_tasks.setdefault(namespace, []).append(self.task_i)
+            self.task_i += 1
+            self.execution_count[namespace] = execution_count + 1
 
     async def execute_and_finish(
         self,
@@ -364,38 +981,80 @@ class Kernel:
         execution_count: int,
         code: str,
         cache_info: Dict[str, Any],
+        prev_done: asyncio.Event | None,
+        done: asyncio.Event,
     ) -> None:
-        prev_task_i = task_i - 1
-        if self._chain_execution and prev_task_i in self.cell_done:
-            await self.cell_done[prev_task_i].wait()
-            del self.cell_done[prev_task_i]
+        parent_header = parent["header"]
+        metrics = self.cell_metrics.get(parent_header["msg_id"])
+        if self._chain_execution and prev_done is not None:
+            waiting_since = time.perf_counter()
+            await prev_done.wait()
+            if metrics is not None:
+                metrics.waited_time = time.perf_counter() - waiting_since
+            if self.tracer is not None:
+                # behind the previous cell of the session
+                self.tracer.span("queued", waiting_since, time.perf_counter(), parent_header)
         PARENT_VAR.set(parent)
         IDENTS_VAR.set(idents)
-        parent_header = parent["header"]
+        self.last_parent_header = parent_header
         traceback, exception = [], None
         namespace = self.get_namespace(parent_header)
+        cell_outputs = None if self.cache is None else CellOutputs(self.cache_output_size)
+        CELL_OUTPUTS_VAR.set(cell_outputs)
         try:
-            result = await self.locals[namespace][f"__async_cell{task_i}__"]()
+            cell = self.locals[namespace][f"__async_cell{task_i}__"]()
+            t0 = time.perf_counter()
+            try:
+                if metrics is None:
+                    result = await cell
+                else:
+                    metrics.start_memory()
+                    result = await run_metered(cell, metrics)
+            finally:
+                if self.tracer is not None:
+                    self.tracer.span("run", t0, time.perf_counter(), parent_header)
         except KeyboardInterrupt:
             self.interrupt()
         except Exception as e:
             exception = e
             traceback = get_traceback(code, e, execution_count)
+            invalidate_lineage(self.get_lineage(namespace), cache_info)
         else:
-            await self.show_result(result, self.globals[namespace], parent_header)
-            cache_execution(self.cache, cache_info, self.globals[namespace], result)
+            # the result is cached separately from the outputs
+            CELL_OUTPUTS_VAR.set(None)
+            t0 = time.perf_counter()
+            await self.show_result(result, self.globals[namespace], parent_header, execution_count)
+            if self.tracer is not None:
+                self.tracer.span("show_result", t0, time.perf_counter(), parent_header)
+            cache_execution(
+                self.cache,
+                cache_info,
+                self.globals[namespace],
+                result,
+                cell_outputs,
+                self.get_lineage(namespace),
+            )
         finally:
-            self.cell_done[task_i].set()
-            del self.locals[namespace][f"__async_cell{task_i}__"]
+            CELL_OUTPUTS_VAR.set(None)
+            done.set()
+            # the session may have been closed
+            self.locals.get(namespace, {}).pop(f"__async_cell{task_i}__", None)
+            self.update_indexes(namespace, cache_info)
             await self.finish_execution(
                 idents,
                 parent_header,
                 execution_count,
                 exception=exception,
                 traceback=traceback,
+                code=code,
             )
-            if task_i in self.running_cells:
-                del self.running_cells[task_i]
+            self.running_cells.pop(task_i, None)
+            # unless the session was closed
+            if self.cell_namespace.pop(task_i, None) is not None:
+                self.session_running[namespace] -= 1
+                self.last_activity[namespace] = time.monotonic()
+            # the next cell of the session can be started
+            self.dispatch_event.set()
 
     async def finish_execution(
         self,
@@ -406,10 +1065,19 @@ class Kernel:
         no_exec: bool = False,
         traceback: List[str] = [],
         result=None,
+        iopub: List[Tuple[str, Dict[str, Any]]] = [],
+        code: str | None = None,
     ) -> None:
+        t0 = time.perf_counter()
+        for msg_type, content in iopub:
+            # replay the outputs of a cached cell execution
+            display.send(msg_type, content, parent_header)
         if result:
             namespace = self.get_namespace(parent_header)
-            await self.show_result(result, self.globals[namespace], parent_header)
+            await self.show_result(result, self.globals[namespace], parent_header, execution_count)
+        self.flush_output(parent_header["msg_id"])
+        metrics = self.cell_metrics.pop(parent_header["msg_id"], None)
+        cell_metrics = None if metrics is None or no_exec else metrics.get()
         if no_exec:
             status = "aborted"
         else:
@@ -421,7 +1089,7 @@ class Kernel:
                     parent_header=parent_header,
                     content={
                         "ename": type(exception).__name__,
-                        "evalue": exception.args[0],
+                        "evalue": get_evalue(exception),
                         "traceback": traceback,
                     },
                 )
@@ -429,74 +1097,133 @@ class Kernel:
                 await self.from_iopub_send_stream.send(to_send)
             else:
                 status = "ok"
+            if self.history is not None and code is not None:
+                assert execution_count is not None
+                self.history.record(
+                    parent_header["session"],
+                    execution_count,
+                    code,
+                    status,
+                    0 if cell_metrics is None else cell_metrics["wall_time"],
+                )
         msg = self.create_message(
             "execute_reply",
             parent_header=parent_header,
             content={"status": status, "execution_count": execution_count},
             address=idents[0],
+            metadata={} if cell_metrics is None else {"metrics": cell_metrics},
         )
         to_send = serialize(msg, self.key)
         await self.from_shell_send_stream.send(to_send)
-        self.execution_state = "idle"
+        t1 = time.perf_counter()
+        if self.tracer is not None:
+            self.tracer.span("reply", t0, t1, parent_header)
+        if metrics is not None:
+            self.metrics.execute_to_reply.record(t1 - metrics.received_time)
+        if cell_metrics is not None:
+            # akernel-specific: the last message of the cell before its idle status
+            msg = self.create_message(
+                "cell_metrics",
+                parent_header=parent_header,
+                content={"execution_count": execution_count, **cell_metrics},
+            )
+            to_send = serialize(msg, self.key)
+            await self.from_iopub_send_stream.send(to_send)
+        self.end_activity()
         msg = self.create_message(
             "status",
             parent_header=parent_header,
-            content={"execution_state": self.execution_state},
+            content={"execution_state": "idle"},
         )
         to_send = serialize(msg, self.key)
         await self.from_iopub_send_stream.send(to_send)
 
     def task(self, cell_i: int = -1) -> Awaitable:
+        namespace = self.get_namespace(PARENT_VAR.get()["header"])
+        tasks = self.session_tasks.get(namespace, [])
         if cell_i < 0:
-            i = self.task_i - 1 + cell_i
+            i = len(tasks) - 1 + cell_i
         else:
             i = cell_i
-        if i in self.running_cells:
-            return self.running_cells[i]
+        if 0 <= i < len(tasks) and tasks[i] in self.running_cells:
+            return self.running_cells[tasks[i]]
         return asyncio.sleep(0)
 
-    async def ainput(self, prompt: str = "") -> Any:
+    async def listen_stdin(self) -> None:
+        while True:
+            msg_list = await self.to_stdin_receive_stream.receive()
+            idents, msg = self.receive_message(msg_list, "stdin")
+            if msg["header"]["msg_type"] != "input_reply":
+                continue
+            future = self.input_requests.pop(msg["parent_header"].get("msg_id"), None)
+            if future is None and self.input_requests:
+                # the frontend didn't parent the reply, it answers the oldest request
+                future = self.input_requests.pop(next(iter(self.input_requests)))
+            if future is not None and not future.done():
+                future.set_result(msg)
+
+    async def ainput(
+        self, prompt: str = "", password: bool = False, timeout: float | None = None
+    ) -> Any:
+        """Ask the frontend for input. Several cells can wait for input concurrently, each
+        reply being matched to its request. A TimeoutError is raised if no reply is received
+        within timeout seconds.
+        """
         parent = PARENT_VAR.get()
         idents = IDENTS_VAR.get()
         if parent["content"]["allow_stdin"]:
             msg = self.create_message(
                 "input_request",
                 parent_header=parent["header"],
-                content={"prompt": prompt, "password": False},
+                content={"prompt": prompt, "password": password},
                 address=idents[0],
             )
-            to_send = serialize(msg, self.key)
-            await self.from_stdin_send_stream.send(to_send)
-            msg_list = await self.to_stdin_receive_stream.receive()
-            idents, msg_list = feed_identities(msg_list)
-            msg = deserialize(msg_list)
-            idents, msg = res
-            if msg["content"]["status"] == "ok":
-                return msg["content"]["value"]
+            msg_id = msg["header"]["msg_id"]
+            future = asyncio.get_running_loop().create_future()
+            self.input_requests[msg_id] = future
+            try:
+                to_send = serialize(msg, self.key)
+                await self.from_stdin_send_stream.send(to_send)
+                reply = await asyncio.wait_for(future, timeout)
+            finally:
+                # the request was answered, timed out or cancelled (e.g. cell interrupted)
+                self.input_requests.pop(msg_id, None)
+            if reply["content"]["status"] == "ok":
+                return reply["content"]["value"]
 
     def print(
         self,
         *objects,
         sep: str = " ",
         end: str = "\n",
-        file=sys.stdout,
+        file=None,
         flush: bool = False,
     ) -> None:
-        if file is sys.stdout:
+        if file is None or file is sys.stdout:
             name = "stdout"
         elif file is sys.stderr:
             name = "stderr"
         else:
-            print(*objects, sep, end, file, flush)
+            print(*objects, sep=sep, end=end, file=file, flush=flush)
             return
         f = StringIO()
         print(*objects, sep=sep, end=end, file=f, flush=True)
         text = f.getvalue()
         f.close()
+        self.send_stream(name, text, PARENT_VAR.get()["header"])
+
+    def send_stream(self, name: str, text: str, parent_header: Dict[str, Any]) -> None:
+        if self.thread_id is not None and threading.get_ident() != self.thread_id:
+            # memory object streams are not thread-safe
+            assert self.loop is not None
+            self.loop.call_soon_threadsafe(self.send_stream, name, text, parent_header)
+            return
+        content = {"name": name, "text": text}
+        record_output("stream", content)
         msg = self.create_message(
             "stream",
-            parent_header=PARENT_VAR.get()["header"],
-            content={"name": name, "text": text},
+            parent_header=parent_header,
+            content=content,
         )
         to_send = serialize(msg, self.key)
         self.from_iopub_send_stream.send_nowait(to_send)
@@ -507,10 +1234,12 @@ class Kernel:
         content: Dict = {},
         parent_header: Dict[str, Any] = {},
         address: bytes | None = None,
+        metadata: Dict[str, Any] | None = None,
     ) -> Dict[str, Any]:
         msg = create_message(
             msg_type,
             content=content,
+            metadata=metadata,
             parent_header=parent_header,
             msg_cnt=self.msg_cnt,
             address=address,
@@ -518,7 +1247,13 @@ class Kernel:
         self.msg_cnt += 1
         return msg
 
-    async def show_result(self, result, globals_, parent_header):
+    def register_formatter(self, type_: type, formatter: Callable[[Any], Any]) -> None:
+        """Render the results and displayed objects of a type (or of its subclasses) with a
+        function returning a MIME bundle, or its plain text representation.
+        """
+        self.formatters[type_] = formatter
+
+    async def show_result(self, result, globals_, parent_header, execution_count=None):
         if result is not None:
             globals_["_"] = result
             send_stream = True
@@ -536,10 +1271,15 @@ class Kernel:
                 except Exception:
                     pass
             if send_stream:
-                msg = self.create_message(
-                    "stream",
-                    parent_header=parent_header,
-                    content={"name": "stdout", "text": f"{repr(result)}\n"},
-                )
-                to_send = serialize(msg, self.key)
-                await self.from_iopub_send_stream.send(to_send)
+                data = await display.render(result, self.formatters)
+                if list(data) == ["text/plain"]:
+                    msg = self.create_message(
+                        "stream",
+                        parent_header=parent_header,
+                        content={"name": "stdout", "text": f"{data['text/plain']}\n"},
+                    )
+                    to_send = serialize(msg, self.key)
+                    await self.from_iopub_send_stream.send(to_send)
+                else:
+                    content = {"data": data, "metadata": {}, "execution_count": execution_count}
+                    display.send("execute_result", content, parent_header)
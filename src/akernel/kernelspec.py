@@ -5,12 +5,26 @@ import sys
 import json
 
 
-def write_kernelspec(dir_name: str, mode: str, display_name: str, cache_dir: str | None) -> None:
+def write_kernelspec(
+    dir_name: str,
+    mode: str,
+    display_name: str,
+    cache_dir: str | None,
+    code_hash: str = "ast",
+    input_hash: str = "value",
+    extra_args: list[str] | None = None,
+) -> None:
     argv = ["akernel", "launch"]
     if mode:
         argv.append(mode)
     if mode == "cache" and cache_dir:
         argv += ["-c", cache_dir]
+    if "cache" in mode and code_hash != "ast":
+        argv += ["--code-hash", code_hash]
+    if "cache" in mode and input_hash != "value":
+        argv += ["--input-hash", input_hash]
+    if extra_args:
+        argv += extra_args
     argv += ["-f", "{connection_file}"]
     kernelspec = {
         "argv": argv,
@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+import sys
+from itertools import islice
+from typing import Any
+
+
+# number of items of a container that are looked at to estimate its size
+SAMPLE_SIZE = 100
+
+
+def estimate_size(obj: Any, depth: int = 2) -> int:
+    """Estimate the memory size of an object in bounded time, by sampling the items of
+    containers and extrapolating to their length.
+    """
+    try:
+        size = sys.getsizeof(obj)
+    except Exception:
+        return 0
+    if depth == 0 or isinstance(obj, (str, bytes, bytearray, memoryview)):
+        return size
+    nbytes = getattr(obj, "nbytes", None)
+    if isinstance(nbytes, int):
+        # e.g. NumPy arrays, pandas objects
+        return max(size, nbytes)
+    try:
+        if isinstance(obj, dict):
+            length = len(obj)
+            items: Any = islice(obj.items(), SAMPLE_SIZE)
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            length = len(obj)
+            items = islice(obj, SAMPLE_SIZE)
+        else:
+            return size
+        sample = 0
+        sample_len = 0
+        for item in items:
+            if isinstance(obj, dict):
+                sample += estimate_size(item[0], depth - 1) + estimate_size(item[1], depth - 1)
+            else:
+                sample += estimate_size(item, depth - 1)
+            sample_len += 1
+    except Exception:
+        # e.g. the container was mutated by another thread
+        return size
+    if sample_len:
+        size += sample * length // sample_len
+    return size
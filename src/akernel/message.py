@@ -4,6 +4,7 @@ import json
 import uuid
 import hmac
 import hashlib
+from collections import Counter
 from datetime import datetime, timezone
 from typing import Any, cast
 
@@ -15,6 +16,9 @@ protocol_version = "%i.%i" % protocol_version_info
 
 DELIM = b"<IDS|MSG>"
 
+# the number of messages serialized to be sent, by message type
+SENT_MESSAGES: Counter[str] = Counter()
+
 
 def date_to_str(obj: dict[str, Any]):
     if obj is not None and "date" in obj and not isinstance(obj["date"], str):
@@ -82,6 +86,7 @@ def create_message(
 
 
 def serialize(msg: dict[str, Any], key: str) -> list[bytes]:
+    SENT_MESSAGES[msg["header"]["msg_type"]] += 1
     message = [
         pack(date_to_str(msg["header"])),
         pack(date_to_str(msg["parent_header"])),
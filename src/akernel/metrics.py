@@ -0,0 +1,187 @@
+from __future__ import annotations
+
+import time
+import tracemalloc
+import types
+from array import array
+from bisect import bisect_left
+from collections import Counter, deque
+from contextvars import ContextVar
+from itertools import islice
+from typing import Any, Coroutine, Deque, Dict, List, Sequence
+
+
+# upper bounds in seconds of the buckets of the latency histograms, from 10us to about 84s
+LATENCY_BOUNDS = tuple(1e-5 * 2**i for i in range(24))
+# number of the last IOPub message sizes kept to compute the backlog of the IOPub stream
+MAX_BACKLOG_MESSAGES = 100_000
+
+
+class CellMetrics:
+    """The resources used by a cell execution, from the reception of its execute_request:
+    the time it was queued (behind the other cells of its session, if cells are chained), its
+    wall and CPU time, the IOPub messages it produced and, if memory allocations are traced,
+    the peak of memory allocated while it ran.
+    """
+
+    def __init__(self) -> None:
+        self.received_time = time.perf_counter()
+        self.start_time = self.received_time
+        # time spent waiting for the previous cell of the session, once started
+        self.waited_time = 0.0
+        self.cpu_time = 0.0
+        self.iopub_messages = 0
+        self.iopub_bytes = 0
+        self.memory_start: int | None = None
+
+    def start(self) -> None:
+        self.start_time = time.perf_counter()
+
+    def start_memory(self) -> None:
+        if tracemalloc.is_tracing():
+            # the peak is global, it includes the allocations of concurrent cells
+            self.memory_start = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+
+    def count(self, size: int) -> None:
+        self.iopub_messages += 1
+        self.iopub_bytes += size
+
+    def get(self) -> Dict[str, Any]:
+        end_time = time.perf_counter()
+        metrics = {
+            "wall_time": end_time - self.start_time - self.waited_time,
+            "cpu_time": self.cpu_time,
+            "queued_time": self.start_time - self.received_time + self.waited_time,
+            "iopub_messages": self.iopub_messages,
+            "iopub_bytes": self.iopub_bytes,
+        }
+        if self.memory_start is not None and tracemalloc.is_tracing():
+            metrics["memory_peak"] = max(0, tracemalloc.get_traced_memory()[1] - self.memory_start)
+        return metrics
+
+
+@types.coroutine
+def run_metered(coro: Coroutine, metrics: CellMetrics):
+    """Run a coroutine, adding the CPU time of each of its steps to the metrics. The time used
+    by other tasks while the coroutine is suspended is not counted.
+    """
+    value, error = None, None
+    while True:
+        t0 = time.thread_time()
+        try:
+            if error is None:
+                future = coro.send(value)
+            else:
+                future = coro.throw(error)
+        except StopIteration as e:
+            return e.value
+        finally:
+            metrics.cpu_time += time.thread_time() - t0
+        try:
+            value, error = (yield future), None
+        except GeneratorExit:
+            coro.close()
+            raise
+        except BaseException as e:
+            value, error = None, e
+
+
+class Histogram:
+    """A histogram with fixed buckets. Recording a value updates the preallocated buckets in
+    place, with a bisection and a few arithmetic operations, so that it can be done on the hot
+    path (the count and sum are still Python numbers, which can create small objects).
+    """
+
+    def __init__(self, bounds: Sequence[float] = LATENCY_BOUNDS) -> None:
+        self.bounds = bounds
+        # the last bucket is for the values above the last bound
+        self.counts = array("Q", [0] * (len(bounds) + 1))
+        self.count = 0
+        self.sum = 0.0
+
+    def record(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def get(self) -> Dict[str, Any]:
+        return {
+            "bounds": list(self.bounds),
+            "counts": self.counts.tolist(),
+            "count": self.count,
+            "sum": self.sum,
+        }
+
+
+class KernelMetrics:
+    """The counters and latency histograms of a kernel, for a metrics_request."""
+
+    def __init__(self) -> None:
+        # the number of received messages, by message type
+        self.received: Counter[str] = Counter()
+        self.deserialize = Histogram()
+        self.pre_execute = Histogram()
+        # from the reception of an execute_request to the sending of its reply
+        self.execute_to_reply = Histogram()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def get_latencies(self) -> Dict[str, Any]:
+        return {
+            "deserialize": self.deserialize.get(),
+            "pre_execute": self.pre_execute.get(),
+            "execute_to_reply": self.execute_to_reply.get(),
+        }
+
+    def get_cache(self) -> Dict[str, Any]:
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            "hits": self.cache_hits,
+            "misses": self.cache_misses,
+            "hit_ratio": self.cache_hits / lookups if lookups else None,
+        }
+
+
+def get_size(msg: List[Any]) -> int:
+    return sum(frame.nbytes if isinstance(frame, memoryview) else len(frame) for frame in msg)
+
+
+class IOPubStream:
+    """A wrapper of the IOPub stream, counting the messages sent in the context of the
+    requests that are tracked, by message ID. It also keeps the size of the last messages,
+    to know how many bytes are waiting in the stream.
+    """
+
+    def __init__(self, stream, parent_var: ContextVar, tracked: Dict[str, CellMetrics]) -> None:
+        self.stream = stream
+        self.parent_var = parent_var
+        self.tracked = tracked
+        self.sizes: Deque[int] = deque(maxlen=MAX_BACKLOG_MESSAGES)
+
+    def count(self, msg: List[Any]) -> None:
+        size = get_size(msg)
+        self.sizes.append(size)
+        if self.tracked:
+            parent = self.parent_var.get(None)
+            if parent is not None:
+                metrics = self.tracked.get(parent["header"]["msg_id"])
+                if metrics is not None:
+                    metrics.count(size)
+
+    def get_backlog(self) -> int:
+        """Return the size in bytes of the messages that have not been received yet."""
+        backlog = self.stream.statistics().current_buffer_used
+        # the messages in the buffer are the last ones that were sent
+        return sum(islice(reversed(self.sizes), backlog))
+
+    def send_nowait(self, msg: List[Any]) -> None:
+        self.count(msg)
+        self.stream.send_nowait(msg)
+
+    async def send(self, msg: List[Any]) -> None:
+        self.count(msg)
+        await self.stream.send(msg)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.stream, name)
@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import asyncio
+import codecs
+import io
+import os
+import threading
+from typing import TYPE_CHECKING, Any, Dict, List, TextIO
+
+if TYPE_CHECKING:
+    from .kernel import Kernel
+
+
+# time in seconds during which the output written to a file descriptor is batched
+FD_BATCH_INTERVAL = 0.05
+
+
+class OutStream(io.TextIOBase):
+    """A replacement for sys.stdout or sys.stderr, which sends what is written by a cell (or a
+    comm handler) to the frontend, and what is written outside of them to the original stream.
+    Writes are buffered until a new line or a flush.
+    """
+
+    def __init__(self, name: str, kernel: Kernel, original: TextIO) -> None:
+        self.name = name
+        self.kernel = kernel
+        self.original = original
+        # parent header and pending text of each request
+        self.buffers: Dict[str, Any] = {}
+        # threads started from a cell can write too
+        self.lock = threading.Lock()
+
+    @property
+    def encoding(self) -> str:  # type: ignore[override]
+        return "utf-8"
+
+    def writable(self) -> bool:
+        return True
+
+    def isatty(self) -> bool:
+        return False
+
+    def fileno(self) -> int:
+        return self.original.fileno()
+
+    def write(self, text: str) -> int:
+        from .kernel import PARENT_VAR
+
+        parent = PARENT_VAR.get(None)
+        if parent is None:
+            return self.original.write(text)
+
+        parent_header = parent["header"]
+        msg_id = parent_header["msg_id"]
+        with self.lock:
+            if msg_id not in self.buffers:
+                self.buffers[msg_id] = (parent_header, [])
+            self.buffers[msg_id][1].append(text)
+        if "\n" in text:
+            self.flush_parent(msg_id)
+        return len(text)
+
+    def flush(self) -> None:
+        from .kernel import PARENT_VAR
+
+        parent = PARENT_VAR.get(None)
+        if parent is None:
+            self.original.flush()
+        else:
+            self.flush_parent(parent["header"]["msg_id"])
+
+    def flush_parent(self, msg_id: str) -> None:
+        with self.lock:
+            if msg_id not in self.buffers:
+                return
+            parent_header, texts = self.buffers.pop(msg_id)
+        # what was already written to the file descriptors must be sent before
+        for fd_capture in self.kernel.fd_captures:
+            fd_capture.flush()
+        self.kernel.send_stream(self.name, "".join(texts), parent_header)
+
+
+class FdCapture:
+    """Capture what is written to a file descriptor (e.g. by C extensions or subprocesses) with
+    a pipe, and send it to the frontend from a reader thread, in batches. The batch is also sent
+    before the output of an OutStream, so that what was written first arrives first, but what is
+    still in the pipe can arrive after it.
+    """
+
+    def __init__(self, name: str, kernel: Kernel, fd: int, loop: asyncio.AbstractEventLoop) -> None:
+        self.name = name
+        self.kernel = kernel
+        self.loop = loop
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.lock = threading.Lock()
+        self.buffer: List[bytes] = []
+        self.flush_scheduled = False
+        # the original destination of the file descriptor
+        self.original = open(os.dup(fd), "w", buffering=1, closefd=True)
+        read_fd, write_fd = os.pipe()
+        os.dup2(write_fd, fd)
+        os.close(write_fd)
+        self.read_fd = read_fd
+        self.thread = threading.Thread(target=self.read, daemon=True)
+        self.thread.start()
+
+    def read(self) -> None:
+        while True:
+            data = os.read(self.read_fd, 65536)
+            if not data:
+                break
+            with self.lock:
+                self.buffer.append(data)
+                if self.flush_scheduled:
+                    continue
+                self.flush_scheduled = True
+            self.loop.call_soon_threadsafe(self.loop.call_later, FD_BATCH_INTERVAL, self.flush)
+
+    def flush(self) -> None:
+        # can be called from the event loop or from a thread writing to an OutStream, the lock
+        # keeps the batches in order
+        with self.lock:
+            data = b"".join(self.buffer)
+            self.buffer = []
+            self.flush_scheduled = False
+            text = self.decoder.decode(data)
+            if not text:
+                return
+            # the output cannot be attributed to a request, it goes to the last started cell
+            parent_header = self.kernel.last_parent_header
+            if parent_header is None:
+                self.original.write(text)
+            else:
+                self.kernel.send_stream(self.name, text, parent_header)
@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import pickle
+import types
+from typing import Any, Dict
+
+
+# these objects are shared with other namespaces or cannot be pickled by value,
+# there is no point in spilling them
+UNSPILLABLE_TYPES = (types.ModuleType, types.FunctionType, types.BuiltinFunctionType, type)
+
+
+def get_spill_path(spill_dir: str, namespace: str) -> str:
+    name = hashlib.sha256(namespace.encode()).hexdigest()
+    return os.path.join(spill_dir, f"{name}.pickle")
+
+
+def spill_namespace(path: str, globals_: Dict[str, Any]) -> Dict[str, Any]:
+    """Write the picklable variables of a namespace to a file, and return the other ones,
+    which must be kept in memory.
+    """
+    kept = {}
+    to_spill = {}
+    for name, value in globals_.items():
+        if isinstance(value, UNSPILLABLE_TYPES):
+            kept[name] = value
+        else:
+            to_spill[name] = value
+    try:
+        data = pickle.dumps(to_spill)
+    except Exception:
+        for name, value in list(to_spill.items()):
+            try:
+                pickle.dumps(value)
+            except Exception:
+                kept[name] = to_spill.pop(name)
+        # pickle them together, in order to keep the references between them
+        data = pickle.dumps(to_spill)
+    with open(path, "wb") as f:
+        f.write(data)
+    return kept
+
+
+def restore_namespace(path: str) -> Dict[str, Any]:
+    with open(path, "rb") as f:
+        globals_ = pickle.load(f)
+    os.remove(path)
+    return globals_
@@ -0,0 +1,278 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import signal
+import sys
+from bisect import bisect
+from typing import Any, Dict, List, Tuple, cast
+
+import zmq
+from anyio import Event, create_memory_object_stream, create_task_group, open_process, sleep
+from anyio.abc import Process
+from zmq_anyio import Socket
+
+from .connect import connect_channel, context
+from .kernel import Kernel
+from .message import feed_identities, unpack
+
+
+# number of points of each worker on the hash ring
+WORKER_REPLICAS = 100
+# these requests are sent to all the workers, and only the first reply is forwarded
+BROADCAST_MSG_TYPES = {"shutdown_request"}
+# akernel-specific requests which can target another session than their own
+SESSION_MSG_TYPES = {"close_session_request", "metrics_request", "variables_request"}
+# sent by a worker when it is ready to receive messages
+READY = b"ready"
+# how often a worker checks that its supervisor is still alive, in seconds
+SUPERVISOR_CHECK_INTERVAL = 1
+
+
+def get_hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hashing of session IDs to workers: adding or removing a worker only moves
+    the sessions of the ring segments it owns.
+    """
+
+    def __init__(self, nodes: List[int], replicas: int = WORKER_REPLICAS):
+        self.ring = sorted(
+            (get_hash(f"{node}-{replica}"), node) for node in nodes for replica in range(replicas)
+        )
+        self.hashes = [hash_ for hash_, _ in self.ring]
+
+    def get_node(self, key: str) -> int:
+        i = bisect(self.hashes, get_hash(key)) % len(self.ring)
+        return self.ring[i][1]
+
+
+def get_routing_info(msg_list: List[bytes]) -> Tuple[str, str, str]:
+    """Return the message type, message ID and session of a message, by only parsing its
+    header (and its content for akernel-specific messages).
+    """
+    _, msg_list = feed_identities(msg_list)
+    header = unpack(msg_list[1])
+    session = header["session"]
+    if header["msg_type"] in SESSION_MSG_TYPES:
+        session = unpack(msg_list[4]).get("session", session)
+    return header["msg_type"], header["msg_id"], session
+
+
+def get_parent_msg_id(msg_list: List[bytes]) -> str:
+    _, msg_list = feed_identities(msg_list)
+    return unpack(msg_list[2]).get("msg_id", "")
+
+
+class Supervisor:
+    """Front process of a multi-kernel: it owns the ZMQ channels of the connection file, and
+    routes the messages of each session to one of several worker processes running a Kernel.
+    """
+
+    def __init__(self, mode, cache_dir, connection_file, workers, **kernel_options):
+        self.mode = mode
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.kernel_options = kernel_options
+        with open(connection_file) as f:
+            connection_cfg = json.load(f)
+        self.key = cast(str, connection_cfg["key"])
+        self.channels = {
+            channel_name: connect_channel(channel_name, connection_cfg)
+            for channel_name in ("shell", "control", "stdin", "iopub")
+        }
+        self.worker_socket = Socket(context.socket(zmq.ROUTER))
+        # a restarted worker reconnects with the same identity
+        self.worker_socket.router_handover = 1
+        # fail instead of dropping messages to a worker that is gone
+        self.worker_socket.router_mandatory = 1
+        port = self.worker_socket.bind_to_random_port("tcp://127.0.0.1")
+        self.worker_address = f"tcp://127.0.0.1:{port}"
+        self.ring = HashRing(list(range(workers)))
+        self.ready = [False] * workers
+        # messages received while a worker was (re)starting
+        self.pending: List[List[List[bytes]]] = [[] for _ in range(workers)]
+        self.processes: Dict[int, Process] = {}
+        # number of replies to expect for each broadcast request
+        self.broadcasts: Dict[str, int] = {}
+        self.stopping = False
+        self.stopped = Event()
+
+    async def start(self) -> None:
+        signal.signal(signal.SIGINT, self.interrupt_workers)
+        async with (
+            create_task_group() as tg,
+            self.worker_socket,
+            self.channels["shell"],
+            self.channels["control"],
+            self.channels["stdin"],
+            self.channels["iopub"],
+        ):
+            for i in range(self.workers):
+                tg.start_soon(self.run_worker, i)
+            for channel_name in ("shell", "control", "stdin"):
+                tg.start_soon(self.from_frontend, channel_name)
+            tg.start_soon(self.from_workers)
+            await self.stopped.wait()
+            tg.cancel_scope.cancel()
+
+    def interrupt_workers(self, signum, frame) -> None:
+        for process in self.processes.values():
+            process.send_signal(signal.SIGINT)
+
+    async def run_worker(self, i: int) -> None:
+        argv = [
+            sys.executable,
+            "-m",
+            "akernel.akernel",
+            "worker",
+            self.mode,
+            "--address",
+            self.worker_address,
+            "--identity",
+            str(i),
+            "--options",
+            json.dumps(self.kernel_options),
+        ]
+        if self.cache_dir:
+            argv += ["-c", self.cache_dir]
+        # don't leak the key in the process list
+        env = dict(os.environ, AKERNEL_KEY=self.key)
+        while not self.stopping:
+            async with await open_process(
+                argv, env=env, stdin=None, stdout=None, stderr=None
+            ) as process:
+                self.processes[i] = process
+                returncode = await process.wait()
+            del self.processes[i]
+            self.ready[i] = False
+            if not self.stopping:
+                print(
+                    f"akernel worker {i} exited with code {returncode}, restarting", file=sys.stderr
+                )
+        if not self.processes:
+            self.stopped.set()
+
+    async def send_to_worker(self, i: int, msg: List[bytes]) -> None:
+        if self.ready[i]:
+            try:
+                await self.worker_socket.asend_multipart([str(i).encode()] + msg, copy=True).wait()
+            except zmq.ZMQError as e:
+                if e.errno != zmq.EHOSTUNREACH:
+                    raise
+                # the worker crashed, it will get the message when it is restarted
+                self.ready[i] = False
+                self.pending[i].append(msg)
+        else:
+            self.pending[i].append(msg)
+
+    async def from_frontend(self, channel_name: str) -> None:
+        channel = self.channels[channel_name]
+        while True:
+            msg = await channel.arecv_multipart().wait()
+            msg_type, msg_id, session = get_routing_info(msg)
+            msg = [channel_name.encode()] + msg
+            if msg_type in BROADCAST_MSG_TYPES:
+                if msg_type == "shutdown_request":
+                    self.stopping = not unpack(feed_identities(msg)[1][4])["restart"]
+                self.broadcasts[msg_id] = self.workers
+                for i in range(self.workers):
+                    await self.send_to_worker(i, msg)
+            else:
+                await self.send_to_worker(self.ring.get_node(session), msg)
+
+    async def from_workers(self) -> None:
+        # the messages of a worker are received in the order it sent them, in particular
+        # IOPub messages are published in order
+        while True:
+            identity, channel_name, *msg = await self.worker_socket.arecv_multipart().wait()
+            i = int(identity)
+            if channel_name == READY:
+                self.ready[i] = True
+                pending, self.pending[i] = self.pending[i], []
+                for msg in pending:
+                    await self.send_to_worker(i, msg)
+                continue
+            if channel_name == b"control":
+                parent_msg_id = get_parent_msg_id(msg)
+                if parent_msg_id in self.broadcasts:
+                    self.broadcasts[parent_msg_id] -= 1
+                    forward = self.broadcasts[parent_msg_id] == self.workers - 1
+                    if self.broadcasts[parent_msg_id] == 0:
+                        del self.broadcasts[parent_msg_id]
+                    if not forward:
+                        continue
+            await self.channels[channel_name.decode()].asend_multipart(msg, copy=True).wait()
+
+
+class Worker:
+    """A Kernel running in a worker process, which exchanges messages with the supervisor."""
+
+    def __init__(self, mode, cache_dir, address, identity, key, **kernel_options):
+        self.streams: Dict[str, Any] = {}
+        for name in (
+            "to_shell",
+            "from_shell",
+            "to_control",
+            "from_control",
+            "to_stdin",
+            "from_stdin",
+        ):
+            self.streams[name] = create_memory_object_stream[List[bytes]]()
+        self.streams["from_iopub"] = create_memory_object_stream[List[bytes]](
+            max_buffer_size=float("inf")
+        )
+        if kernel_options.get("trace_file"):
+            # each worker writes its own trace
+            root, ext = os.path.splitext(kernel_options["trace_file"])
+            kernel_options["trace_file"] = f"{root}-worker{identity}{ext}"
+        self.kernel = Kernel(
+            self.streams["to_shell"][1],
+            self.streams["from_shell"][0],
+            self.streams["to_control"][1],
+            self.streams["from_control"][0],
+            self.streams["to_stdin"][1],
+            self.streams["from_stdin"][0],
+            self.streams["from_iopub"][0],
+            mode,
+            cache_dir,
+            **kernel_options,
+        )
+        self.kernel.key = key
+        self.socket = Socket(context.socket(zmq.DEALER))
+        self.socket.identity = identity.encode()
+        self.socket.connect(address)
+
+    async def start(self) -> None:
+        async with create_task_group() as tg, self.socket:
+            tg.start_soon(self.watch_supervisor)
+            tg.start_soon(self.to_kernel)
+            await self.socket.asend_multipart([READY]).wait()
+            async with create_task_group() as forwarders:
+                for channel_name in ("shell", "control", "stdin", "iopub"):
+                    forwarders.start_soon(self.from_kernel, channel_name)
+                await self.kernel.start()
+                # let the last messages go out, e.g. the shutdown reply
+                for name, (send_stream, _) in self.streams.items():
+                    if name.startswith("from_"):
+                        await send_stream.aclose()
+            tg.cancel_scope.cancel()
+
+    async def watch_supervisor(self) -> None:
+        # the supervisor can be killed without stopping its workers
+        supervisor_pid = os.getppid()
+        while os.getppid() == supervisor_pid:
+            await sleep(SUPERVISOR_CHECK_INTERVAL)
+        os._exit(1)
+
+    async def to_kernel(self) -> None:
+        while True:
+            channel_name, *msg = await self.socket.arecv_multipart().wait()
+            await self.streams[f"to_{channel_name.decode()}"][0].send(msg)
+
+    async def from_kernel(self, channel_name: str) -> None:
+        async for msg in self.streams[f"from_{channel_name}"][1]:
+            await self.socket.asend_multipart([channel_name.encode()] + msg, copy=True).wait()
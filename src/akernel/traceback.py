@@ -1,47 +1,101 @@
 from __future__ import annotations
 
-import sys
-import types
-from typing import cast
+import itertools
+import linecache
+from collections import OrderedDict
+from types import CodeType
+from typing import List, Tuple
 
 from colorama import Fore, Style  # type: ignore
 
 
-def get_traceback(code: str, exception, execution_count: int = 0):
-    exc_info = sys.exc_info()
-    tb = cast(types.TracebackType, exc_info[2])
-    while True:
-        if tb.tb_next is None:
-            break
+# maximum number of frames in a traceback, the frames in the middle are omitted
+MAX_TRACEBACK_DEPTH = 50
+# maximum number of cell sources kept for tracebacks, the oldest ones are forgotten
+MAX_CELL_SOURCES = 10000
+# execution count of the registered cells, by file name
+_cell_execution_counts: OrderedDict[str, int] = OrderedDict()
+_cell_ids = itertools.count()
+
+
+def get_cell_filename() -> str:
+    """Return a new file name to compile a cell with."""
+    return f"<cell-{next(_cell_ids)}>"
+
+
+def register_cell(filename: str, code: str, execution_count: int) -> None:
+    """Register the source of a cell that runs, so that its frames (including the functions it
+    defines) can be traced back to it. Cells served from the cache don't need it.
+    """
+    # an entry without modification time is never invalidated by linecache.checkcache
+    linecache.cache[filename] = (len(code), None, code.splitlines(True), filename)
+    _cell_execution_counts[filename] = execution_count
+    if len(_cell_execution_counts) > MAX_CELL_SOURCES:
+        old_filename, _ = _cell_execution_counts.popitem(last=False)
+        linecache.cache.pop(old_filename, None)
+
+
+def get_evalue(exception: BaseException) -> str:
+    # the exceptions raised without arguments have no args[0]
+    if len(exception.args) == 1:
+        # unlike str(), doesn't quote the key of a KeyError
+        return str(exception.args[0])
+    return str(exception)
+
+
+def get_frames(exception: BaseException) -> List[Tuple[CodeType, int]]:
+    frames = []
+    tb = exception.__traceback__
+    while tb is not None:
+        frames.append((tb.tb_frame.f_code, tb.tb_lineno))
         tb = tb.tb_next
-    stack = []
-    frame: types.FrameType | None = tb.tb_frame
-    while True:
-        assert frame is not None
-        stack.append(frame)
-        frame = frame.f_back
-        if frame is None:
-            break
-    stack.reverse()
+    # the kernel frames are above the cell
+    for i, (code, _) in enumerate(frames):
+        if code.co_name.startswith("__async_cell"):
+            return frames[i:]
+    return frames
+
+
+def get_traceback(
+    code: str,
+    exception: BaseException,
+    execution_count: int = 0,
+    max_depth: int = MAX_TRACEBACK_DEPTH,
+) -> List[str]:
+    frames = get_frames(exception)
+    omitted = len(frames) - max_depth
+    if omitted > 0:
+        frames = frames[: max_depth // 2] + frames[len(frames) - (max_depth - max_depth // 2) :]
     traceback = ["Traceback (most recent call last):"]
-    for frame in stack:
-        filename = frame.f_code.co_filename
-        if filename == "<string>":
-            filename = f"{Fore.CYAN}Cell{Style.RESET_ALL} {Fore.GREEN}{execution_count}"
-            f"{Style.RESET_ALL}"
+    for i, (frame_code, lineno) in enumerate(frames):
+        if omitted > 0 and i == max_depth // 2:
+            traceback.append(f"... {omitted} frames omitted ...")
+        filename = frame_code.co_filename
+        if filename in _cell_execution_counts:
+            line = linecache.getline(filename, lineno)
+            filename = (
+                f"{Fore.CYAN}Cell{Style.RESET_ALL} {Fore.GREEN}"
+                f"{_cell_execution_counts[filename]}{Style.RESET_ALL}"
+            )
+        elif filename == "<string>":
+            lines = code.splitlines()
+            line = lines[lineno - 1] if 0 < lineno <= len(lines) else ""
+            filename = (
+                f"{Fore.CYAN}Cell{Style.RESET_ALL} {Fore.GREEN}{execution_count}{Style.RESET_ALL}"
+            )
         else:
-            with open(filename) as f:
-                code = f.read()
+            line = linecache.getline(filename, lineno)
             filename = f"{Fore.CYAN}File{Style.RESET_ALL} {Fore.GREEN}{filename}{Style.RESET_ALL}"
-        if frame.f_code.co_name.startswith("__async_cell"):
+        if frame_code.co_name.startswith("__async_cell"):
             name = "<module>"
         else:
-            name = frame.f_code.co_name
-        trace = [
+            name = frame_code.co_name
+        traceback += [
             f"{filename} in {Fore.CYAN}{name}{Style.RESET_ALL}, {Fore.CYAN}line{Style.RESET_ALL} "
-            f"{Fore.GREEN}{frame.f_lineno}{Style.RESET_ALL}:"
+            f"{Fore.GREEN}{lineno}{Style.RESET_ALL}:",
+            line.rstrip("\r\n"),
         ]
-        trace.append(code.splitlines()[frame.f_lineno - 1])
-        traceback += trace
-    traceback += [f"{Fore.RED}{type(exception).__name__}{Style.RESET_ALL}: {exception.args[0]}"]
+    ename = f"{Fore.RED}{type(exception).__name__}{Style.RESET_ALL}"
+    evalue = get_evalue(exception)
+    traceback.append(f"{ename}: {evalue}" if evalue else ename)
     return traceback
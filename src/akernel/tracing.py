@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Tuple
+
+
+# time in seconds between two writes of the recorded spans
+TRACE_FLUSH_INTERVAL = 0.5
+# maximum number of spans waiting to be written, the oldest ones are dropped above it
+TRACE_BUFFER_SIZE = 100_000
+TRACE_FORMATS = ("jsonl", "chrome")
+
+
+class Tracer:
+    """Record the lifecycle of messages as spans (recv, deserialize, transform, compile,
+    queued, run, show_result, reply, iopub_flush), with the ID and type of the request they
+    belong to. Spans are buffered in a ring buffer and written by a background thread, as JSON
+    lines or in the Chrome trace format (which can be opened in Perfetto or chrome://tracing).
+    If the thread cannot keep up, the oldest spans are dropped instead of slowing down the
+    kernel.
+    """
+
+    def __init__(
+        self, path: str, format: str = "jsonl", buffer_size: int = TRACE_BUFFER_SIZE
+    ) -> None:
+        if format not in TRACE_FORMATS:
+            raise ValueError(f"Unknown trace format: {format}")
+        self.path = path
+        self.format = format
+        self.spans: Deque[Tuple[str, float, float, str, str, Dict[str, Any] | None]] = deque(
+            maxlen=buffer_size
+        )
+        # when the messages were received from the frontend, in order, by channel
+        self.received: Dict[str, Deque[float]] = {
+            "shell": deque(),
+            "control": deque(),
+            "stdin": deque(),
+        }
+        # spans are timed with the performance counter, and written with the wall-clock time
+        self.time_offset = time.time() - time.perf_counter()
+        self.pid = os.getpid()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.write, daemon=True)
+        self.thread.start()
+
+    def span(
+        self,
+        name: str,
+        start: float,
+        end: float,
+        header: Dict[str, Any],
+        args: Dict[str, Any] | None = None,
+    ) -> None:
+        self.spans.append((name, start, end, header["msg_id"], header["msg_type"], args))
+
+    def close(self) -> None:
+        self.stop_event.set()
+        self.thread.join()
+
+    def format_span(self, span) -> str:
+        name, start, end, msg_id, msg_type, args = span
+        if self.format == "jsonl":
+            event = {
+                "name": name,
+                "msg_id": msg_id,
+                "msg_type": msg_type,
+                "time": start + self.time_offset,
+                "duration": end - start,
+            }
+            if args:
+                event.update(args)
+            return json.dumps(event) + "\n"
+        # the spans of a request are async events with the same ID, they can overlap the
+        # spans of other requests
+        event = {
+            "name": name,
+            "cat": msg_type,
+            "ph": "b",
+            "id": msg_id,
+            "ts": (start + self.time_offset) * 1e6,
+            "pid": self.pid,
+            "tid": 0,
+            "args": args or {},
+        }
+        begin = json.dumps(event)
+        event.update(ph="e", ts=(end + self.time_offset) * 1e6, args={})
+        return f"{begin},\n{json.dumps(event)}"
+
+    def write(self) -> None:
+        chrome = self.format == "chrome"
+        # a Chrome trace is a JSON array, it cannot be appended to
+        with open(self.path, "w" if chrome else "a") as f:
+            if chrome:
+                f.write("[\n")
+                f.flush()
+            written = False
+            stop = False
+            while not stop:
+                stop = self.stop_event.wait(TRACE_FLUSH_INTERVAL)
+                lines = []
+                while True:
+                    try:
+                        lines.append(self.format_span(self.spans.popleft()))
+                    except IndexError:
+                        break
+                if not lines:
+                    continue
+                if chrome:
+                    f.write((",\n" if written else "") + ",\n".join(lines))
+                else:
+                    f.write("".join(lines))
+                f.flush()
+                written = True
+            if chrome:
+                f.write("\n]\n")
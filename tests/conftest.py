@@ -3,8 +3,11 @@ import shutil
 import sys
 
 import pytest
+from anyio import create_memory_object_stream
 
+from akernel.kernel import Kernel
 from akernel.kernelspec import write_kernelspec
+from akernel.message import deserialize, feed_identities
 
 
 @pytest.fixture(scope="function", params=["", "multi", "react", "cache"])
@@ -21,3 +24,51 @@ def all_modes(request):
         shutil.rmtree(cache_dir, ignore_errors=True)
     display_name = f"Python 3 ({kernel_name})"
     write_kernelspec(kernel_name, mode, display_name, None)
+
+
+class Frontend:
+    """The frontend side of the memory streams of a kernel: messages are sent to the kernel
+    with to_shell, to_control and to_stdin, and received from it with from_shell,
+    from_control, from_stdin and iopub.
+    """
+
+    def __init__(self) -> None:
+        self.to_shell, self.to_shell_receive_stream = create_stream()
+        self.from_shell_send_stream, self.from_shell = create_stream()
+        self.to_control, self.to_control_receive_stream = create_stream()
+        self.from_control_send_stream, self.from_control = create_stream()
+        self.to_stdin, self.to_stdin_receive_stream = create_stream()
+        self.from_stdin_send_stream, self.from_stdin = create_stream()
+        self.from_iopub_send_stream, self.iopub = create_stream()
+
+    def receive(self, channel: str = "iopub"):
+        """Return the next message of a channel, which must have been sent."""
+        stream = getattr(self, channel if channel == "iopub" else f"from_{channel}")
+        return deserialize(feed_identities(stream.receive_nowait())[1])
+
+
+def create_stream():
+    return create_memory_object_stream(max_buffer_size=float("inf"))
+
+
+@pytest.fixture
+def create_kernel():
+    """Return a function creating a kernel with the given options, connected to a frontend
+    through memory streams, and returning both.
+    """
+
+    def create(**kwargs):
+        frontend = Frontend()
+        kernel = Kernel(
+            frontend.to_shell_receive_stream,
+            frontend.from_shell_send_stream,
+            frontend.to_control_receive_stream,
+            frontend.from_control_send_stream,
+            frontend.to_stdin_receive_stream,
+            frontend.from_stdin_send_stream,
+            frontend.from_iopub_send_stream,
+            **kwargs,
+        )
+        return kernel, frontend
+
+    return create
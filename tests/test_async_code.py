@@ -93,3 +93,34 @@ def test_async_last_line_not_expr():
         """
     ).strip()
     assert Transform(code).get_async_code() == expected
+
+
+def test_normalized_code():
+    code0 = dedent(
+        """
+        def foo(a):
+            \"\"\"Foo.\"\"\"
+            return a+1
+        b = foo( 1 )
+        """
+    ).strip()
+    code1 = dedent(
+        """
+        # a comment
+        def foo(a):
+            return a + 1  # another comment
+
+        b = foo(1)
+        """
+    ).strip()
+    code2 = dedent(
+        """
+        def foo(a):
+            return a + 2
+        b = foo(1)
+        """
+    ).strip()
+    assert Transform(code0).get_normalized_code() == Transform(code1).get_normalized_code()
+    assert Transform(code0).get_normalized_code() != Transform(code2).get_normalized_code()
+    # a lone string is not a docstring
+    assert Transform("'a'").get_normalized_code() != Transform("'b'").get_normalized_code()
@@ -0,0 +1,26 @@
+import pytest
+from typer.testing import CliRunner
+
+from akernel.akernel import cli
+
+
+@pytest.mark.parametrize("command", ["install", "launch"])
+@pytest.mark.parametrize("option", ["--code-hash", "--input-hash"])
+def test_cache_hash_options(command, option):
+    # unknown values are rejected before a kernelspec is written or a kernel is launched
+    args = [command, "cache", option, "foo"]
+    if command == "launch":
+        args += ["-f", "connection.json"]
+    result = CliRunner().invoke(cli, args)
+    assert result.exit_code == 2
+    assert "Invalid value" in result.output
+
+
+@pytest.mark.parametrize("command", ["install", "launch"])
+def test_trace_format_option(command):
+    args = [command, "--trace-format", "foo"]
+    if command == "launch":
+        args += ["-f", "connection.json"]
+    result = CliRunner().invoke(cli, args)
+    assert result.exit_code == 2
+    assert "Invalid value" in result.output
@@ -0,0 +1,141 @@
+import asyncio
+
+import pytest
+from anyio import WouldBlock
+
+from akernel.comm import Comm
+from akernel.kernel import PARENT_VAR
+
+
+def comm_msg(comm_id, data):
+    return {
+        "header": {"msg_id": data, "session": "s"},
+        "content": {"comm_id": comm_id, "data": data},
+    }
+
+
+@pytest.mark.asyncio
+async def test_comm_msg_async(create_kernel):
+    kernel, frontend = create_kernel()
+    PARENT_VAR.set(comm_msg("", ""))
+    handled = []
+    slow_comm = Comm(target_name="t")
+    fast_comm = Comm(target_name="t")
+
+    async def slow(msg):
+        await asyncio.sleep(0.1)
+        handled.append(msg["content"]["data"])
+
+    slow_comm.on_msg(slow)
+    fast_comm.on_msg(lambda msg: handled.append(msg["content"]["data"]))
+    kernel.comm_manager.comm_msg(None, None, comm_msg(slow_comm.comm_id, "slow1"))
+    kernel.comm_manager.comm_msg(None, None, comm_msg(slow_comm.comm_id, "slow2"))
+    kernel.comm_manager.comm_msg(None, None, comm_msg(fast_comm.comm_id, "fast"))
+    await asyncio.sleep(0.05)
+    # a slow comm doesn't block the other ones
+    assert handled == ["fast"]
+    # the task handling a message is referenced until it is done
+    assert len(kernel.comm_manager.handlers) == 1
+    await asyncio.sleep(0.2)
+    # messages of a comm are handled in order
+    assert handled == ["fast", "slow1", "slow2"]
+    assert kernel.comm_manager.handlers == set()
+
+
+@pytest.mark.asyncio
+async def test_comm_msg_concurrency(create_kernel):
+    kernel, frontend = create_kernel()
+    PARENT_VAR.set(comm_msg("", ""))
+    running = []
+    max_running = 0
+    comm = Comm(target_name="t")
+
+    async def handler(msg):
+        nonlocal max_running
+        running.append(msg)
+        max_running = max(max_running, len(running))
+        await asyncio.sleep(0.05)
+        running.remove(msg)
+
+    comm.on_msg(handler)
+    kernel.comm_manager.set_max_concurrency(comm.comm_id, 2)
+    for i in range(5):
+        kernel.comm_manager.comm_msg(None, None, comm_msg(comm.comm_id, str(i)))
+    await asyncio.sleep(0.3)
+    assert max_running == 2
+
+
+@pytest.mark.asyncio
+async def test_comm_coalescing(create_kernel):
+    kernel, frontend = create_kernel()
+    PARENT_VAR.set(comm_msg("", ""))
+    comm = Comm(target_name="t")
+    frontend.iopub.receive_nowait()  # comm_open
+    comm.set_coalescing(0.05)
+    comm.send({"method": "update", "state": {"a": 1, "b": 1}, "buffer_paths": []})
+    comm.send({"method": "update", "state": {"a": 2}, "buffer_paths": [["c"]]}, buffers=[b"c1"])
+    comm.send({"method": "update", "state": {"c": 3}, "buffer_paths": [["d"]]}, buffers=[b"d1"])
+    with pytest.raises(WouldBlock):
+        frontend.iopub.receive_nowait()
+    await asyncio.sleep(0.1)
+    msg = frontend.receive()
+    assert msg["content"]["data"] == {
+        "method": "update",
+        "state": {"a": 2, "b": 1, "c": 3},
+        "buffer_paths": [["d"]],
+    }
+    assert msg["buffers"] == [b"d1"]
+    # other messages flush the pending update first
+    comm.send({"method": "update", "state": {"a": 3}, "buffer_paths": []})
+    comm.send({"method": "custom", "content": {}})
+    msgs = [frontend.receive() for _ in range(2)]
+    assert [msg["content"]["data"]["method"] for msg in msgs] == ["update", "custom"]
+
+
+@pytest.mark.asyncio
+async def test_comm_status(create_kernel):
+    kernel, frontend = create_kernel()
+    PARENT_VAR.set(comm_msg("", ""))
+    comm = Comm(target_name="t")
+    frontend.iopub.receive_nowait()  # comm_open
+    comm.on_msg(lambda msg: None)
+    for i in range(3):
+        kernel.comm_manager.comm_msg(None, None, comm_msg(comm.comm_id, str(i)))
+    await asyncio.sleep(0.05)
+    msgs = [frontend.receive() for _ in range(2)]
+    # only the transitions are published
+    assert [msg["content"]["execution_state"] for msg in msgs] == ["busy", "idle"]
+    with pytest.raises(WouldBlock):
+        frontend.iopub.receive_nowait()
+    # a running cell keeps the kernel busy
+    kernel.begin_activity()
+    kernel.comm_manager.comm_msg(None, None, comm_msg(comm.comm_id, "3"))
+    await asyncio.sleep(0.05)
+    assert kernel.execution_state == "busy"
+    with pytest.raises(WouldBlock):
+        frontend.iopub.receive_nowait()
+
+
+@pytest.mark.asyncio
+async def test_comm_info(create_kernel):
+    kernel, frontend = create_kernel()
+    PARENT_VAR.set(comm_msg("", ""))
+    comm1 = Comm(target_name="t1")
+    comm2 = Comm(target_name="t2")
+    opened = []
+    kernel.comm_manager.register_target("t3", lambda comm, msg: opened.append(comm))
+    open_msg = comm_msg("c3", "")
+    open_msg["content"]["target_name"] = "t3"
+    kernel.comm_manager.comm_open(None, None, open_msg)
+    assert [comm.comm_id for comm in opened] == ["c3"]
+    comm_manager = kernel.comm_manager
+    assert comm_manager.get_comm_info("t1") == {comm1.comm_id: {"target_name": "t1"}}
+    assert comm_manager.get_comm_info() == {
+        comm1.comm_id: {"target_name": "t1"},
+        comm2.comm_id: {"target_name": "t2"},
+        "c3": {"target_name": "t3"},
+    }
+    comm1.close()
+    comm_manager.comm_close(None, None, comm_msg("c3", ""))
+    assert comm_manager.get_comm_info() == {comm2.comm_id: {"target_name": "t2"}}
+    assert comm_manager.get_comm_info("t1") == {}
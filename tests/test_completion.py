@@ -0,0 +1,47 @@
+import os
+
+from akernel.completion import CompletionIndex
+from akernel.execution import pre_execute
+
+
+def complete(index, code):
+    reply = index.complete(code, len(code))
+    return reply["matches"], reply["cursor_start"]
+
+
+def test_complete_names():
+    namespace = {"os": os, "value": 1, "values": [], "other": None}
+    index = CompletionIndex(namespace)
+    assert complete(index, "x = val") == (["value", "values"], 4)
+    # keywords and builtins
+    assert complete(index, "whi") == (["while"], 0)
+    assert complete(index, "prin") == (["print"], 0)
+    assert complete(index, "") == ([], 0)
+    # attributes
+    matches, cursor_start = complete(index, "os.path.joi")
+    assert (matches, cursor_start) == (["join"], 8)
+    matches, _ = complete(index, "os.")
+    assert "getcwd" in matches
+    assert not any(match.startswith("_") for match in matches)
+    assert "__name__" in complete(index, "os._")[0]
+    assert complete(index, "unknown.") == ([], 8)
+
+
+def test_complete_update():
+    namespace = {}
+    locals_ = {}
+    index = CompletionIndex(namespace)
+    code = "import os\ndef function(): pass\nvariable = 1\n"
+    _, _, cache_info = pre_execute(code, namespace, locals_)
+    assert {"os", "function", "variable"} <= cache_info["names"]
+    # simulate the cell execution
+    namespace.update(os=os, function=lambda: None, variable=1)
+    index.update(cache_info["names"])
+    assert complete(index, "vari") == (["variable"], 0)
+    assert complete(index, "fun") == (["function"], 0)
+    del namespace["variable"]
+    index.update({"variable"})
+    assert complete(index, "vari") == ([], 0)
+    # names bound without the index knowing
+    namespace["loop_variable"] = 0
+    assert complete(index, "loop") == (["loop_variable"], 0)
@@ -0,0 +1,177 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+import pytest
+from anyio import WouldBlock
+
+from akernel.display.display import (
+    DisplayHandle,
+    clear_output,
+    display,
+    encode_data,
+    get_mimebundle,
+    render,
+)
+from akernel.execution import CellOutputs
+from akernel.kernel import PARENT_VAR
+
+
+@pytest.mark.asyncio
+async def test_display_update(create_kernel):
+    kernel, frontend = create_kernel()
+    PARENT_VAR.set({"header": {"msg_id": "0", "session": "s"}})
+    handle = display(0, display_id=True)
+    assert isinstance(handle, DisplayHandle)
+    msg = frontend.receive()
+    assert (msg["msg_type"], msg["content"]) == (
+        "display_data",
+        {
+            "data": {"text/plain": "0"},
+            "transient": {"display_id": handle.display_id},
+            "metadata": {},
+        },
+    )
+    for i in range(1, 4):
+        handle.update(i)
+    msg = frontend.receive()
+    assert (msg["msg_type"], msg["content"]["data"]) == ("update_display_data", {"text/plain": "1"})
+    # the next updates are coalesced
+    with pytest.raises(WouldBlock):
+        frontend.iopub.receive_nowait()
+    await asyncio.sleep(0.1)
+    msg = frontend.receive()
+    assert (msg["msg_type"], msg["content"]["data"]) == ("update_display_data", {"text/plain": "3"})
+    with pytest.raises(WouldBlock):
+        frontend.iopub.receive_nowait()
+
+
+@pytest.mark.asyncio
+async def test_clear_output(create_kernel):
+    kernel, frontend = create_kernel()
+    PARENT_VAR.set({"header": {"msg_id": "0", "session": "s"}})
+    clear_output(wait=True)
+    msg = frontend.receive()
+    assert (msg["msg_type"], msg["content"]) == ("clear_output", {"wait": True})
+
+
+def test_cell_outputs_clear():
+    cell_outputs = CellOutputs(2**20)
+    cell_outputs.add("stream", {"name": "stdout", "text": "a"})
+    cell_outputs.add("clear_output", {"wait": True})
+    assert len(cell_outputs.get()) == 1
+    cell_outputs.add("stream", {"name": "stdout", "text": "b"})
+    assert cell_outputs.get() == [("stream", {"name": "stdout", "text": "b"})]
+    cell_outputs.add("clear_output", {"wait": False})
+    assert cell_outputs.get() == []
+
+
+class Rich:
+    def __repr__(self):
+        return "Rich()"
+
+    def _repr_html_(self):
+        return "<b>Rich</b>"
+
+    def _repr_png_(self):
+        return b"\x89PNG"
+
+
+class PNG:
+    def __init__(self, size):
+        self.size = size
+
+    def _repr_png_(self):
+        return b"0" * self.size
+
+
+class Broken:
+    def __repr__(self):
+        return "Broken()"
+
+    def _repr_mimebundle_(self):
+        raise RuntimeError
+
+    def _repr_html_(self):
+        raise RuntimeError
+
+
+class SlowRepr:
+    def __repr__(self):
+        time.sleep(0.5)
+        return "SlowRepr()"
+
+
+def test_get_mimebundle():
+    assert get_mimebundle(Rich()) == {
+        "text/plain": "Rich()",
+        "text/html": "<b>Rich</b>",
+        "image/png": b"\x89PNG",
+    }
+    text = get_mimebundle(list(range(10000)))["text/plain"]
+    assert text.startswith("[0, 1, 2") and text.endswith(", ...]")
+    assert len(text) < 10000
+    assert get_mimebundle([[[[[[[[1]]]]]]]])["text/plain"] == "[[[[[[[...]]]]]]]"
+    # the representations that fail are ignored
+    assert get_mimebundle(Broken()) == {"text/plain": "Broken()"}
+    # dictionaries keep their insertion order
+    assert get_mimebundle({"b": 1, "a": {"d": 2, "c": 3}})["text/plain"] == (
+        "{'b': 1, 'a': {'d': 2, 'c': 3}}"
+    )
+    assert get_mimebundle(dict.fromkeys(range(2000)))["text/plain"].endswith(
+        "998: None, 999: None, ...}"
+    )
+    # formatters apply to subclasses
+    formatters = {dict: lambda d: f"dict of {len(d)}"}
+    assert get_mimebundle(OrderedDict(a=1), formatters) == {"text/plain": "dict of 1"}
+
+
+@pytest.mark.asyncio
+async def test_render_timeout():
+    # small objects are rendered inline
+    assert await render(SlowRepr(), timeout=0.1) == {"text/plain": "SlowRepr()"}
+    # then in a thread, once their type is known to be slow
+    data = await render(SlowRepr(), timeout=0.1)
+    assert data == {"text/plain": "<SlowRepr object, rendering timed out>"}
+    # big objects are always rendered in a thread
+    assert await render(list(range(100_000))) == {
+        "text/plain": get_mimebundle(list(range(100_000)))["text/plain"]
+    }
+
+
+@pytest.mark.asyncio
+async def test_show_result(create_kernel):
+    kernel, frontend = create_kernel()
+    PARENT_VAR.set({"header": {"msg_id": "0", "session": "s"}})
+    globals_ = {}
+    parent_header = PARENT_VAR.get()["header"]
+    await kernel.show_result(3, globals_, parent_header, 1)
+    msg = frontend.receive()
+    assert (msg["msg_type"], msg["content"]) == ("stream", {"name": "stdout", "text": "3\n"})
+    await kernel.show_result(Rich(), globals_, parent_header, 2)
+    msg = frontend.receive()
+    assert msg["msg_type"] == "execute_result"
+    assert msg["content"]["execution_count"] == 2
+    assert msg["content"]["data"]["text/html"] == "<b>Rich</b>"
+    kernel.register_formatter(int, lambda i: {"text/plain": str(i), "text/html": f"<i>{i}</i>"})
+    await kernel.show_result(3, globals_, parent_header, 3)
+    msg = frontend.receive()
+    assert msg["content"]["data"] == {"text/plain": "3", "text/html": "<i>3</i>"}
+    assert globals_["_"] == 3
+
+
+def test_encode_data():
+    content = {"data": {"text/plain": "Image", "image/png": b"0" * 2000}}
+    encoded = encode_data(content)
+    assert encoded["data"] == {"text/plain": "Image", "image/png": "MDAw" * 666 + "MDA="}
+    assert content["data"]["image/png"] == b"0" * 2000
+
+
+@pytest.mark.asyncio
+async def test_display_binary(create_kernel):
+    kernel, frontend = create_kernel()
+    PARENT_VAR.set({"header": {"msg_id": "0", "session": "s"}})
+    display(Rich())
+    msg = frontend.receive()
+    assert msg["content"]["data"]["image/png"] == "iVBORw=="
+    assert msg["buffers"] == []
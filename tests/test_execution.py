@@ -1,5 +1,8 @@
 from __future__ import annotations
 
+import json
+import linecache
+import os
 import sys
 import time
 from textwrap import dedent
@@ -9,7 +12,8 @@ from typing import List, Dict, Tuple, Any
 
 import pytest
 
-from akernel.execution import execute
+from akernel.cache import cache as create_cache
+from akernel.execution import CachedOutput, execute, pre_execute, record_output
 
 
 async def run(
@@ -236,3 +240,238 @@ async def test_execute_cache():
     assert t1 - t0 < time_to_sleep
     assert g["y"] == 1
     assert r == 2
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("lineage", [None, {}])
+async def test_execute_cache_mutation(lineage, tmp_path):
+    # values are pickled, they are not shared with the cache
+    cache = create_cache(str(tmp_path))
+    globals_ = {}
+    for _ in range(2):
+        for code in ("x = [1]", "x.append(2)", "n = len(x)"):
+            await execute(code, globals_, {}, cache=cache, lineage=lineage)
+        # the second time, the cells are served from the cache, including the mutation
+        assert globals_["x"] == [1, 2]
+        assert globals_["n"] == 2
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("lineage", [None, {}])
+async def test_execute_cache_function_mutation(lineage, tmp_path):
+    cache = create_cache(str(tmp_path))
+    globals_ = {}
+    cells = ("x = [1]", "def f():\n    x.append(2)", "f()", "y = x.count(1)", "n = len(x)")
+    for _ in range(2):
+        for code in cells:
+            await execute(code, globals_, {}, cache=cache, lineage=lineage)
+        assert globals_["x"] == [1, 2]
+        assert globals_["n"] == 2
+    # only the variables that are actually mutated are stored, not every object a method is
+    # called on
+    names = [k[64:] for k in cache.keys()]
+    assert names.count("x") == 2
+
+
+@pytest.mark.asyncio
+async def test_execute_cache_lazy_outputs():
+    cache = {}
+    globals_ = {}
+    code = dedent(
+        """
+        x = [1, 2]
+        y = 3
+        """
+    ).strip()
+    r, t, i, g, l = await run(code, globals_=globals_, cache=cache)  # noqa
+    assert g["x"] == [1, 2]
+    r, t, i, g, l = await run("w = y + 1", globals_=globals_, cache=cache)  # noqa
+    # cache hit, outputs are only referenced
+    r, t, i, g, l = await run(code, globals_=globals_, cache=cache)  # noqa
+    assert isinstance(g["x"], CachedOutput)
+    assert isinstance(g["y"], CachedOutput)
+    # a cache hit only loads its inputs
+    r, t, i, g, l = await run("w = y + 1", globals_=globals_, cache=cache)  # noqa
+    assert not isinstance(g["y"], CachedOutput)
+    assert isinstance(g["x"], CachedOutput)
+    assert g["w"] == 4
+    # a cell that runs loads the outputs, even those it uses indirectly
+    code = "def f():\n    return type(y), json.dumps(x)\nz = f()"
+    globals_["json"] = json
+    r, t, i, g, l = await run(code, globals_=globals_, cache=cache)  # noqa
+    assert g["z"] == (int, "[1, 2]")
+    assert not isinstance(g["x"], CachedOutput)
+    assert not isinstance(g["y"], CachedOutput)
+
+
+@pytest.mark.asyncio
+async def test_execute_cache_outputs():
+    cache = {}
+
+    def emit(text):
+        record_output("stream", {"name": "stdout", "text": text})
+
+    globals_ = {"emit": emit}
+    code = dedent(
+        """
+        emit("a")
+        emit("b")
+        x = 1
+        """
+    ).strip()
+    r, t, i, g, l = await run(code, globals_=globals_, cache=cache)  # noqa
+    _, _, cache_info = pre_execute(code, globals_, {}, cache=cache)
+    assert cache_info["cached"]
+    assert cache_info["iopub"] == [("stream", {"name": "stdout", "text": "ab"})]
+    # captured outputs are capped in size
+    cache = {}
+    locals_ = {}
+    await execute(code, globals_, locals_, cache=cache, cache_output_size=1)
+    _, _, cache_info = pre_execute(code, globals_, locals_, cache=cache)
+    assert cache_info["iopub"][0] == ("stream", {"name": "stdout", "text": "a"})
+    assert "truncated" in cache_info["iopub"][1][1]["text"]
+
+
+@pytest.mark.asyncio
+async def test_execute_cache_linecache():
+    def get_cell_sources():
+        return {k for k in linecache.cache if k.startswith("<cell-")}
+
+    cache = {}
+    globals_ = {"x": 1}
+    sources = get_cell_sources()
+    await execute("y = x + 1", globals_, {}, cache=cache)
+    assert len(get_cell_sources() - sources) == 1
+    # the source of a cell is only registered if it runs
+    sources = get_cell_sources()
+    await execute("y = x + 1", globals_, {}, cache=cache)
+    assert get_cell_sources() == sources
+
+
+@pytest.mark.asyncio
+async def test_execute_cache_code_hash():
+    cache = {}
+    globals_ = {"x": 1}
+    r, t, i, g, l = await run("y = x + 1", globals_=globals_, cache=cache)  # noqa
+    # reformatting the code doesn't invalidate the cache
+    _, _, cache_info = pre_execute("y = x+1  # comment", globals_, {}, cache=cache)
+    assert cache_info["cached"]
+    # unless the code is hashed strictly
+    _, _, cache_info = pre_execute("y = x+1", globals_, {}, cache=cache, code_hash="source")
+    assert not cache_info["cached"]
+
+
+@pytest.mark.asyncio
+async def test_execute_cache_lineage():
+    cache = {}
+    lineage = {}
+    globals_ = {}
+
+    async def run_lineage(code):
+        # a cell execution that is not served from the cache is stored in the cache
+        cache_size = len(cache)
+        await execute(code, globals_, {}, cache=cache, lineage=lineage)
+        return len(cache) == cache_size
+
+    assert not await run_lineage("x = [1]")
+    assert not await run_lineage("n = len(x)")
+    assert await run_lineage("n = len(x)")
+    assert globals_["n"] == 1
+    # mutated in a cell
+    assert not await run_lineage("x.append(2)")
+    assert not await run_lineage("n = len(x)")
+    assert globals_["n"] == 2
+    # re-bound outside of a cell
+    globals_["x"] = [1, 2, 3]
+    assert not await run_lineage("n = len(x)")
+    assert globals_["n"] == 3
+    # produced by another cell execution
+    assert not await run_lineage("x = [0]")
+    assert not await run_lineage("n = len(x)")
+    assert globals_["n"] == 1
+    # mutated through a function
+    assert not await run_lineage("def f():\n    x.append(1)")
+    assert not await run_lineage("f()")
+    assert not await run_lineage("n = len(x)")
+    assert globals_["n"] == 2
+
+
+@pytest.mark.asyncio
+async def test_execute_cache_import():
+    cache = {}
+    globals_ = {}
+    code = dedent(
+        """
+        import math
+        from os import path as os_path
+        x = math.sqrt(4)
+        """
+    ).strip()
+    r, t, i, g, l = await run(code, globals_=globals_, cache=cache)  # noqa
+    del globals_["math"], globals_["os_path"], globals_["x"]
+    # cached, only the imports are executed
+    _, _, cache_info = pre_execute(code, globals_, {}, cache=cache)
+    assert cache_info["cached"]
+    assert globals_["math"].sqrt(9) == 3
+    assert globals_["os_path"].join("a", "b") == os.path.join("a", "b")
+    assert globals_["x"] == 2
+    # nested imports are never cached
+    code = dedent(
+        """
+        if True:
+            import math
+        """
+    ).strip()
+    r, t, i, g, l = await run(code, globals_=globals_, cache=cache)  # noqa
+    _, _, cache_info = pre_execute(code, globals_, {}, cache=cache)
+    assert not cache_info["cached"]
+
+
+@pytest.mark.asyncio
+async def test_execute_traceback_other_cell():
+    globals_ = {}
+    code = dedent(
+        """
+        def f():
+
+            raise ValueError()
+        """
+    ).strip()
+    await run(code, globals_=globals_)
+    r, t, i, g, l = await run("f()", globals_=globals_)  # noqa
+    # the source of the function comes from the cell that defined it
+    expected = dedent(
+        """
+        Traceback (most recent call last):
+        Cell 0 in <module>, line 1:
+        f()
+        Cell 0 in f, line 3:
+            raise ValueError()
+        ValueError
+        """
+    ).strip()
+    assert tb_str(t) == expected
+
+
+@pytest.mark.asyncio
+async def test_execute_traceback_depth():
+    code = dedent(
+        """
+        def f(n):
+            if n == 0:
+                raise RuntimeError("deep")
+            f(n - 1)
+        f(100)
+        """
+    ).strip()
+    r, t, i, g, l = await run(code)  # noqa
+    lines = tb_str(t).splitlines()
+    # the first and last frames are kept
+    assert lines[1:3] == ["Cell 0 in <module>, line 5:", "f(100)"]
+    assert "... 52 frames omitted ..." in lines
+    assert lines[-3:] == [
+        "Cell 0 in f, line 3:",
+        '        raise RuntimeError("deep")',
+        "RuntimeError: deep",
+    ]
+    assert len(lines) == 1 + 2 * 50 + 1 + 1
@@ -0,0 +1,48 @@
+from akernel.history import HistoryStore, open_history
+
+
+def test_history(tmp_path):
+    history = HistoryStore(str(tmp_path / "history.sqlite"), session_size=3)
+    for i in range(1, 5):
+        history.record("s1", i, f"a = {i}", "ok", 0.1)
+    history.record("s2", 1, "b = 1", "ok", 0.1)
+    history.record("s2", 2, "a = 1", "error", 0.1)
+    # s1 is bounded to its last 3 entries
+    assert history.get_history("s1", "range") == [(1, 2, "a = 2"), (1, 3, "a = 3"), (1, 4, "a = 4")]
+    assert history.get_history("s1", "range", start=3, stop=4) == [(1, 3, "a = 3")]
+    # the previous session
+    assert history.get_history("s2", "range", session_number=-1, start=4) == [(1, 4, "a = 4")]
+    assert history.get_history("s2", "range", session_number=1, start=4) == [(1, 4, "a = 4")]
+    # the other sessions are not visible
+    assert history.get_history("s2", "range", session_number=-1, all_sessions=False) == []
+    assert history.get_history("s2", "range", session_number=1, all_sessions=False) == []
+    assert history.get_history("s2", "range", all_sessions=False) == [
+        (2, 1, "b = 1"),
+        (2, 2, "a = 1"),
+    ]
+    assert history.get_history("s2", "tail", n=2) == [(2, 1, "b = 1"), (2, 2, "a = 1")]
+    assert history.get_history("s1", "tail", n=2, all_sessions=False) == [
+        (1, 3, "a = 3"),
+        (1, 4, "a = 4"),
+    ]
+    assert history.get_history("s1", "search", pattern="a = *", n=3) == [
+        (1, 3, "a = 3"),
+        (1, 4, "a = 4"),
+        (2, 2, "a = 1"),
+    ]
+    assert history.get_history("s1", "search", pattern="b*") == [(2, 1, "b = 1")]
+    # only the last entries are searched
+    assert history.get_history("s1", "search", pattern="a = *", search_size=2) == [(2, 2, "a = 1")]
+    history.record("s2", 3, "b = 1", "ok", 0.1)
+    assert history.get_history("s1", "search", pattern="b*", unique=True) == [(2, 3, "b = 1")]
+    history.close()
+    # persisted
+    history = HistoryStore(str(tmp_path / "history.sqlite"))
+    assert history.get_history("s2", "range") == [(2, 1, "b = 1"), (2, 2, "a = 1"), (2, 3, "b = 1")]
+    history.close()
+
+
+def test_open_history_error(tmp_path):
+    (tmp_path / "file").write_text("")
+    # the database cannot be created, the history is disabled
+    assert open_history(str(tmp_path / "file" / "history.sqlite")) is None
@@ -0,0 +1,72 @@
+import pytest
+
+from akernel.execution import CachedOutput, pre_execute
+from akernel.inspection import VariableSummaries, get_name_at, inspect_object
+from akernel.kernel import Kernel
+from akernel.memory import estimate_size
+
+
+def test_get_name_at():
+    assert get_name_at("x = os.path.join(a)", 14) == "os.path.join"
+    assert get_name_at("x = os.path.join(a)", 17) == "a"
+    assert get_name_at("x = 1", 5) == ""
+
+
+@pytest.mark.asyncio
+async def test_inspect():
+    globals_ = {}
+    locals_ = {}
+    code = 'def add(a, b=1):\n    """Add numbers."""\n    return a + b\n'
+    pre_execute(code, globals_, locals_)
+    await locals_["__async_cell__"]()
+    reply = inspect_object(globals_, "add", 3)
+    assert reply["found"]
+    text = reply["data"]["text/plain"]
+    assert "Signature: add(a, b=1)" in text
+    assert "Type: function" in text
+    assert "Docstring: Add numbers." in text
+    assert "Source" not in text
+    # the source of a function defined in a cell
+    text = inspect_object(globals_, "add", 3, detail_level=1)["data"]["text/plain"]
+    assert f"Source: {code}" in text
+    text = inspect_object({"x": list(range(10000))}, "x", 1)["data"]["text/plain"]
+    assert "Type: list\nString form: [0, 1, 2" in text
+    assert inspect_object(globals_, "unknown", 7) == {
+        "status": "ok",
+        "found": False,
+        "data": {},
+        "metadata": {},
+    }
+
+
+def test_variable_summaries():
+    namespace = {"a": [1, 2, 3], "b": 1}
+    summaries = VariableSummaries(namespace)
+    assert summaries.get("a") == {
+        "name": "a",
+        "type": "list",
+        "size": estimate_size(namespace["a"]),
+        "len": 3,
+    }
+    assert summaries.get("b")["type"] == "int"
+    namespace["a"].append(4)
+    # cached until the variable changes
+    assert summaries.get("a")["len"] == 3
+    summaries.invalidate({"a"})
+    assert summaries.get("a")["len"] == 4
+    namespace["b"] = "b"
+    assert summaries.get("b") == {"name": "b", "type": "str", "size": estimate_size("b"), "len": 1}
+
+    # the type of a cached output is the type of its value
+    namespace["c"] = CachedOutput({"key": (1, 2)}, "key")
+    assert summaries.get("c")["type"] == "tuple"
+    assert summaries.get("c")["len"] == 2
+
+
+def test_get_variables():
+    kernel = Kernel(None, None, None, None, None, None, None)
+    kernel.init_kernel("namespace")
+    kernel.globals["namespace"].update({f"x{i}": i for i in range(10)}, _private=0)
+    page = kernel.get_variables("namespace", start=8, limit=5)
+    assert page["total"] == 10
+    assert [variable["name"] for variable in page["variables"]] == ["x8", "x9"]
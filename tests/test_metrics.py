@@ -0,0 +1,144 @@
+import asyncio
+import time
+
+import pytest
+from anyio import create_memory_object_stream
+
+from akernel.kernel import Kernel
+from akernel.message import create_message, deserialize, feed_identities, serialize
+from akernel.metrics import CellMetrics, Histogram, run_metered
+
+
+def create_stream():
+    return create_memory_object_stream(max_buffer_size=float("inf"))
+
+
+def use_cpu(duration):
+    t0 = time.thread_time()
+    while time.thread_time() - t0 < duration:
+        pass
+
+
+async def cell(cpu_duration):
+    use_cpu(cpu_duration)
+    await asyncio.sleep(0.1)
+    return 1
+
+
+async def other_cell():
+    await asyncio.sleep(0)
+    use_cpu(0.05)
+
+
+@pytest.mark.asyncio
+async def test_run_metered():
+    metrics = CellMetrics()
+    assert await run_metered(cell(0.05), metrics) == 1
+    assert metrics.cpu_time >= 0.05
+    metrics = CellMetrics()
+    task = asyncio.create_task(other_cell())
+    # the CPU used by the other cell while this one is suspended is not counted
+    assert await run_metered(cell(0), metrics) == 1
+    await task
+    assert metrics.cpu_time < 0.05
+
+
+@pytest.mark.asyncio
+async def test_cell_metrics():
+    to_shell_send_stream, to_shell_receive_stream = create_stream()
+    from_shell_send_stream, from_shell_receive_stream = create_stream()
+    from_iopub_send_stream, from_iopub_receive_stream = create_stream()
+    kernel = Kernel(
+        to_shell_receive_stream,
+        from_shell_send_stream,
+        None,
+        None,
+        None,
+        None,
+        from_iopub_send_stream,
+    )
+    tasks = [
+        asyncio.create_task(kernel.listen_shell()),
+        asyncio.create_task(kernel.dispatch_executions()),
+    ]
+    codes = ["await asyncio.sleep(0.2)\nprint('a' * 1000)", "1 + 1"]
+    msg_ids = []
+    for i, code in enumerate(codes):
+        msg = create_message("execute_request", content={"code": code}, session_id="s", msg_cnt=i)
+        msg_ids.append(msg["header"]["msg_id"])
+        await to_shell_send_stream.send(serialize(msg, kernel.key))
+    replies = []
+    for _ in codes:
+        msg = deserialize(feed_identities(await from_shell_receive_stream.receive())[1])
+        replies.append(msg["metadata"]["metrics"])
+    # the second cell was queued behind the first one
+    assert replies[0]["wall_time"] >= 0.2
+    assert replies[0]["cpu_time"] < replies[0]["wall_time"]
+    assert replies[1]["queued_time"] >= 0.2
+    assert replies[1]["wall_time"] < 0.2
+    # execute_input, stream
+    assert replies[0]["iopub_messages"] == 2
+    assert replies[0]["iopub_bytes"] > 1000
+    assert replies[1]["iopub_messages"] == 2
+    assert "memory_peak" not in replies[0]
+    iopub = []
+    while True:
+        msg = deserialize(feed_identities(await from_iopub_receive_stream.receive())[1])
+        if msg["parent_header"]["msg_id"] != msg_ids[0]:
+            continue
+        iopub.append(msg["msg_type"])
+        if msg["msg_type"] == "cell_metrics":
+            assert msg["content"]["execution_count"] == 1
+            assert msg["content"]["iopub_bytes"] == replies[0]["iopub_bytes"]
+        if msg["msg_type"] == "status" and msg["content"]["execution_state"] == "idle":
+            break
+    assert iopub == ["status", "execute_input", "stream", "cell_metrics", "status"]
+    assert kernel.cell_metrics == {}
+    for task in tasks:
+        task.cancel()
+
+
+def test_histogram():
+    histogram = Histogram((0.1, 1))
+    for value in (0.05, 0.1, 0.5, 2):
+        histogram.record(value)
+    assert histogram.get() == {
+        "bounds": [0.1, 1],
+        "counts": [2, 1, 1],
+        "count": 4,
+        "sum": 2.65,
+    }
+
+
+@pytest.mark.asyncio
+async def test_metrics_request():
+    to_control_send_stream, to_control_receive_stream = create_stream()
+    from_control_send_stream, from_control_receive_stream = create_stream()
+    from_iopub_send_stream, from_iopub_receive_stream = create_stream()
+    kernel = Kernel(
+        None,
+        None,
+        to_control_receive_stream,
+        from_control_send_stream,
+        None,
+        None,
+        from_iopub_send_stream,
+    )
+    listener = asyncio.create_task(kernel.listen_control())
+    kernel.send_stream("stdout", "a" * 1000, {"msg_id": "0", "session": "s"})
+    msg = create_message("metrics_request", session_id="s")
+    await to_control_send_stream.send(serialize(msg, kernel.key))
+    msg = deserialize(feed_identities(await from_control_receive_stream.receive())[1])
+    content = msg["content"]
+    assert msg["header"]["msg_type"] == "metrics_reply"
+    assert content["received"] == {"metrics_request": 1}
+    assert content["sent"]["stream"] >= 1
+    assert content["latencies"]["deserialize"]["count"] == 1
+    assert content["latencies"]["pre_execute"]["count"] == 0
+    assert content["queue_depths"]["from_iopub_send"] == 1
+    assert content["running_cells"] == content["pending_cells"] == 0
+    assert content["cache"] == {"hits": 0, "misses": 0, "hit_ratio": None}
+    assert content["iopub_backlog_bytes"] > 1000
+    from_iopub_receive_stream.receive_nowait()
+    assert kernel.get_metrics()["iopub_backlog_bytes"] == 0
+    listener.cancel()
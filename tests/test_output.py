@@ -0,0 +1,102 @@
+import asyncio
+import io
+import os
+import threading
+
+import pytest
+from anyio import WouldBlock
+
+from akernel.kernel import PARENT_VAR
+from akernel.output import FdCapture, OutStream
+
+
+def test_out_stream(create_kernel):
+    kernel, frontend = create_kernel()
+    original = io.StringIO()
+    stdout = OutStream("stdout", kernel, original)
+    stdout.write("outside of a request\n")
+    assert original.getvalue() == "outside of a request\n"
+    PARENT_VAR.set({"header": {"msg_id": "0", "session": "s"}})
+    stdout.write("a")
+    stdout.write("b")
+    # buffered until a new line
+    with pytest.raises(WouldBlock):
+        frontend.iopub.receive_nowait()
+    stdout.write("c\n")
+    msg = frontend.receive()
+    assert (msg["msg_type"], msg["parent_header"]["msg_id"], msg["content"]) == (
+        "stream",
+        "0",
+        {"name": "stdout", "text": "abc\n"},
+    )
+    stdout.write("d")
+    kernel.flush_output("1")
+    with pytest.raises(WouldBlock):
+        frontend.iopub.receive_nowait()
+    stdout.flush()
+    msg = frontend.receive()
+    assert (msg["msg_type"], msg["parent_header"]["msg_id"], msg["content"]) == (
+        "stream",
+        "0",
+        {"name": "stdout", "text": "d"},
+    )
+
+
+@pytest.mark.asyncio
+async def test_out_stream_thread(create_kernel):
+    kernel, frontend = create_kernel()
+    kernel.loop = asyncio.get_running_loop()
+    kernel.thread_id = threading.get_ident()
+    stdout = OutStream("stdout", kernel, io.StringIO())
+    PARENT_VAR.set({"header": {"msg_id": "0", "session": "s"}})
+    # the context, and thus the parent, is copied to the thread
+    await asyncio.to_thread(stdout.write, "from a thread\n")
+    await asyncio.sleep(0)
+    msg = frontend.receive()
+    assert (msg["msg_type"], msg["parent_header"]["msg_id"], msg["content"]) == (
+        "stream",
+        "0",
+        {"name": "stdout", "text": "from a thread\n"},
+    )
+
+
+@pytest.mark.asyncio
+async def test_fd_capture(create_kernel):
+    kernel, frontend = create_kernel()
+    fd = os.open(os.devnull, os.O_WRONLY)
+    capture = FdCapture("stdout", kernel, fd, asyncio.get_running_loop())
+    kernel.last_parent_header = {"msg_id": "0", "session": "s"}
+    os.write(fd, "é".encode()[:1])
+    os.write(fd, "é".encode()[1:] + b"\n")
+    await asyncio.sleep(0.2)
+    # batched
+    msg = frontend.receive()
+    assert (msg["msg_type"], msg["parent_header"]["msg_id"], msg["content"]) == (
+        "stream",
+        "0",
+        {"name": "stdout", "text": "é\n"},
+    )
+    with pytest.raises(WouldBlock):
+        frontend.iopub.receive_nowait()
+    os.close(fd)
+    capture.original.close()
+
+
+@pytest.mark.asyncio
+async def test_fd_capture_order(create_kernel):
+    kernel, frontend = create_kernel()
+    fd = os.open(os.devnull, os.O_WRONLY)
+    capture = FdCapture("stdout", kernel, fd, asyncio.get_running_loop())
+    kernel.fd_captures.append(capture)
+    kernel.last_parent_header = {"msg_id": "0", "session": "s"}
+    stdout = OutStream("stdout", kernel, io.StringIO())
+    PARENT_VAR.set({"header": kernel.last_parent_header})
+    os.write(fd, b"from fd\n")
+    while not capture.buffer:
+        await asyncio.sleep(0.001)
+    stdout.write("from print\n")
+    # what was written to the file descriptor first is sent first, before its batch is due
+    texts = [frontend.receive()["content"]["text"] for _ in range(2)]
+    assert texts == ["from fd\n", "from print\n"]
+    os.close(fd)
+    capture.original.close()
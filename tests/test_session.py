@@ -0,0 +1,197 @@
+import asyncio
+import gc
+import weakref
+
+import pytest
+
+from akernel.message import create_message, deserialize, feed_identities, serialize
+
+
+@pytest.mark.asyncio
+async def test_spill_idle_session(create_kernel, tmp_path):
+    kernel, _ = create_kernel(kernel_mode="multi", session_idle_timeout=0, spill_dir=str(tmp_path))
+    kernel.init_kernel("s1")
+    kernel.globals["s1"]["a"] = [1, 2]
+    kernel.globals["s1"]["b"] = kernel.globals["s1"]["a"]
+    kernel.globals["s1"]["f"] = lambda: 3
+    await kernel.evict_sessions()
+    assert "s1" not in kernel.globals
+    assert len(list(tmp_path.iterdir())) == 1
+    # restored on the next request
+    await kernel.restore_session("s1")
+    assert kernel.globals["s1"]["a"] == [1, 2]
+    assert kernel.globals["s1"]["b"] is kernel.globals["s1"]["a"]
+    assert kernel.globals["s1"]["f"]() == 3
+    assert kernel.globals["s1"]["print"] == kernel.print
+    assert list(tmp_path.iterdir()) == []
+
+
+class Value:
+    pass
+
+
+@pytest.mark.asyncio
+async def test_spill_function_globals(create_kernel, tmp_path):
+    kernel, _ = create_kernel(kernel_mode="multi", session_idle_timeout=0, spill_dir=str(tmp_path))
+    kernel.init_kernel("s1")
+    globals_ = kernel.globals["s1"]
+    exec("a = [1]\ndef f():\n    return a\n", globals_)
+    globals_["v"] = Value()
+    ref = weakref.ref(globals_["v"])
+    await kernel.evict_sessions()
+    gc.collect()
+    # the spilled values are released, even if a function is kept in memory
+    assert ref() is None
+    kernel.init_kernel("s1")
+    assert kernel.globals["s1"] is globals_
+    assert globals_["f"]() == [1]
+    globals_["a"] = [2]
+    assert globals_["f"]() == [2]
+
+
+@pytest.mark.asyncio
+async def test_spill_session_over_memory(create_kernel, tmp_path):
+    kernel, _ = create_kernel(kernel_mode="multi", session_memory=10**12, spill_dir=str(tmp_path))
+    for i, namespace in enumerate(("s1", "s2")):
+        kernel.init_kernel(namespace)
+        kernel.globals[namespace]["a"] = list(range(100_000))
+        kernel.last_activity[namespace] = i
+    await kernel.evict_sessions()
+    assert kernel.kernel_initialized == {"s1", "s2"}
+    # only the least recently active session is spilled
+    kernel.session_memory = kernel.session_size["s2"][0] * 3 // 2
+    await kernel.evict_sessions()
+    assert kernel.kernel_initialized == {"s2"}
+    assert set(kernel.spilled) == {"s1"}
+
+
+@pytest.mark.asyncio
+async def test_spill_session_concurrently(create_kernel, tmp_path):
+    kernel, _ = create_kernel(kernel_mode="multi", session_idle_timeout=0, spill_dir=str(tmp_path))
+    kernel.init_kernel("s1")
+    kernel.globals["s1"]["a"] = [1]
+
+    async def start_spilling():
+        task = asyncio.create_task(kernel.evict_sessions())
+        while "s1" not in kernel.spilled:
+            await asyncio.sleep(0)
+        return task
+
+    # the session is spilled in a thread, a request restores it once it is written
+    task = await start_spilling()
+    await kernel.restore_session("s1")
+    assert task.done()
+    assert kernel.globals["s1"]["a"] == [1]
+    assert list(tmp_path.iterdir()) == []
+    # closed while it is spilled
+    task = await start_spilling()
+    kernel.close_session("s1")
+    await task
+    assert kernel.spilled == {}
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.asyncio
+async def test_close_session(create_kernel, tmp_path):
+    kernel, _ = create_kernel(kernel_mode="multi", session_idle_timeout=0, spill_dir=str(tmp_path))
+    kernel.init_kernel("s1")
+    kernel.init_kernel("s2")
+    await kernel.evict_sessions()
+    kernel.init_kernel("s2")
+    kernel.close_session("s1")
+    kernel.close_session("s2")
+    assert kernel.globals == {}
+    assert kernel.spilled == {}
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.asyncio
+async def test_close_running_session(create_kernel):
+    kernel, frontend = create_kernel(kernel_mode="multi")
+    tasks = [
+        asyncio.create_task(kernel.listen_shell()),
+        asyncio.create_task(kernel.dispatch_executions()),
+    ]
+    msg = create_message(
+        "execute_request", content={"code": "await asyncio.sleep(10)"}, session_id="s1"
+    )
+    await frontend.to_shell.send(serialize(msg, kernel.key))
+    while not kernel.running_cells:
+        await asyncio.sleep(0.01)
+    kernel.close_session("s1")
+    msg = deserialize(feed_identities(await frontend.from_shell.receive())[1])
+    assert msg["header"]["msg_type"] == "execute_reply"
+    # the cell that finished doesn't bring back the closed session
+    assert kernel.running_cells == kernel.cell_namespace == {}
+    assert "s1" not in kernel.session_running
+    assert "s1" not in kernel.last_activity
+    for task in tasks:
+        task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_fair_dispatch(create_kernel):
+    kernel, _ = create_kernel(kernel_mode="multi")
+    started = []
+
+    async def start_execution(namespace, idents, parent):
+        started.append((namespace, parent))
+        kernel.session_running[namespace] = 1
+
+    kernel.start_execution = start_execution
+    for i in range(3):
+        kernel.queue_execution("s1", [], i)
+    kernel.queue_execution("s2", [], 0)
+    assert kernel.session_stats()["s1"]["queue_depth"] == 3
+    dispatcher = asyncio.create_task(kernel.dispatch_executions())
+    await asyncio.sleep(0)
+    # cells are chained in each session, but not across sessions
+    assert started == [("s1", 0), ("s2", 0)]
+    kernel.session_running["s1"] = 0
+    kernel.dispatch_event.set()
+    await asyncio.sleep(0)
+    assert started[2:] == [("s1", 1)]
+    assert kernel.session_stats()["s1"]["queue_depth"] == 1
+    dispatcher.cancel()
+
+
+@pytest.mark.asyncio
+async def test_weighted_dispatch(create_kernel):
+    kernel, _ = create_kernel(kernel_mode="multi")
+    kernel.unchain_execution()
+    started = []
+
+    async def start_execution(namespace, idents, parent):
+        started.append(namespace)
+
+    kernel.start_execution = start_execution
+    kernel.set_session_weight("s1", 2)
+    for i in range(4):
+        kernel.queue_execution("s1", [], i)
+        kernel.queue_execution("s2", [], i)
+    dispatcher = asyncio.create_task(kernel.dispatch_executions())
+    await asyncio.sleep(0)
+    assert started == ["s1", "s1", "s2", "s1", "s1", "s2", "s2", "s2"]
+    dispatcher.cancel()
+
+
+@pytest.mark.asyncio
+async def test_startup_template(create_kernel, tmp_path):
+    startup = tmp_path / "startup.py"
+    startup.write_text("import json\nconstants = {'a': 1}\n")
+    kernel, _ = create_kernel(
+        kernel_mode="multi", startup=str(startup), session_idle_timeout=0, spill_dir=str(tmp_path)
+    )
+    kernel.init_kernel("s1")
+    kernel.init_kernel("s2")
+    assert kernel.globals["s1"]["json"] is kernel.globals["s2"]["json"]
+    assert kernel.globals["s1"]["constants"] is kernel.globals["s2"]["constants"]
+    kernel.globals["s1"]["json"] = None
+    assert kernel.globals["s2"]["json"] is not None
+    await kernel.evict_sessions()
+    # template objects are not spilled
+    assert kernel.spilled == {"s1": {}, "s2": {}}
+    kernel.init_kernel("s1")
+    kernel.init_kernel("s2")
+    assert kernel.globals["s1"]["json"] is None
+    assert kernel.globals["s2"]["constants"] is kernel.template["constants"]
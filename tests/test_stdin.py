@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+
+from akernel.kernel import IDENTS_VAR, PARENT_VAR
+from akernel.message import create_message, deserialize, feed_identities, serialize
+
+
+def set_parent(msg_id):
+    PARENT_VAR.set({"header": {"msg_id": msg_id, "session": "s"}, "content": {"allow_stdin": True}})
+    IDENTS_VAR.set([b"frontend"])
+
+
+async def receive_input_request(from_stdin):
+    msg = deserialize(feed_identities(await from_stdin.receive())[1])
+    assert msg["header"]["msg_type"] == "input_request"
+    return msg
+
+
+async def send_input_reply(to_stdin, kernel, input_request, value):
+    msg = create_message(
+        "input_reply",
+        parent_header=input_request["header"],
+        content={"status": "ok", "value": value},
+    )
+    await to_stdin.send(serialize(msg, kernel.key))
+
+
+async def cell_input(kernel, msg_id, **kwargs):
+    set_parent(msg_id)
+    return await kernel.ainput(msg_id, **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_input(create_kernel):
+    kernel, frontend = create_kernel()
+    listener = asyncio.create_task(kernel.listen_stdin())
+    task1 = asyncio.create_task(cell_input(kernel, "cell1"))
+    task2 = asyncio.create_task(cell_input(kernel, "cell2"))
+    request1 = await receive_input_request(frontend.from_stdin)
+    request2 = await receive_input_request(frontend.from_stdin)
+    assert request1["parent_header"]["msg_id"] == "cell1"
+    assert request2["parent_header"]["msg_id"] == "cell2"
+    # replies in reverse order
+    await send_input_reply(frontend.to_stdin, kernel, request2, "value2")
+    assert await task2 == "value2"
+    assert not task1.done()
+    await send_input_reply(frontend.to_stdin, kernel, request1, "value1")
+    assert await task1 == "value1"
+    assert kernel.input_requests == {}
+    listener.cancel()
+
+
+@pytest.mark.asyncio
+async def test_input_timeout_and_cancel(create_kernel):
+    kernel, frontend = create_kernel()
+    listener = asyncio.create_task(kernel.listen_stdin())
+    with pytest.raises(asyncio.TimeoutError):
+        await cell_input(kernel, "cell1", timeout=0.01)
+    await receive_input_request(frontend.from_stdin)
+    task = asyncio.create_task(cell_input(kernel, "cell2"))
+    request = await receive_input_request(frontend.from_stdin)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert kernel.input_requests == {}
+    # a late reply is ignored
+    await send_input_reply(frontend.to_stdin, kernel, request, "value")
+    await asyncio.sleep(0)
+    listener.cancel()
@@ -0,0 +1,57 @@
+import asyncio
+import json
+import sys
+
+import pytest
+from kernel_driver import KernelDriver  # type: ignore
+
+from akernel.supervisor import HashRing
+
+
+TIMEOUT = 10
+
+
+def test_hash_ring():
+    sessions = [f"session{i}" for i in range(1000)]
+    ring = HashRing(list(range(4)))
+    nodes = [ring.get_node(session) for session in sessions]
+    assert set(nodes) == {0, 1, 2, 3}
+    # adding a worker only moves sessions to it
+    ring = HashRing(list(range(5)))
+    for session, node in zip(sessions, nodes):
+        assert ring.get_node(session) in (node, 4)
+
+
+@pytest.mark.asyncio
+async def test_workers(capfd, tmp_path):
+    kernelspec_path = tmp_path / "kernel.json"
+    argv = [sys.executable, "-m", "akernel.akernel", "launch", "multi", "--workers", "2"]
+    kernelspec = {
+        "argv": argv + ["-f", "{connection_file}"],
+        "display_name": "akernel",
+        "language": "python",
+    }
+    kernelspec_path.write_text(json.dumps(kernelspec))
+    kd = KernelDriver(kernelspec_path=str(kernelspec_path), log=False)
+    await kd.start(startup_timeout=TIMEOUT)
+    pids = set()
+    for session in ("s1", "s2", "s3", "s4"):
+        kd.session_id = session
+        await kd.execute(f"import os\na = '{session}'", timeout=TIMEOUT)
+    for session in ("s1", "s2", "s3", "s4"):
+        kd.session_id = session
+        await kd.execute("print(a, os.getpid())", timeout=TIMEOUT)
+    out, err = capfd.readouterr()
+    for line, session in zip(out.splitlines(), ("s1", "s2", "s3", "s4")):
+        name, pid = line.split()
+        assert name == session
+        pids.add(pid)
+    assert len(pids) == 2
+    # a crashed worker is restarted
+    kd.session_id = "s1"
+    await kd.execute("os._exit(1)", timeout=TIMEOUT, wait_for_executed=False)
+    await asyncio.sleep(1)
+    await kd.execute("print('restarted')", timeout=TIMEOUT)
+    await kd.stop()
+    out, err = capfd.readouterr()
+    assert out == "restarted\n"
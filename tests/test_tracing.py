@@ -0,0 +1,96 @@
+import asyncio
+import json
+
+import pytest
+from anyio import create_memory_object_stream
+
+from akernel.kernel import Kernel
+from akernel.message import create_message, serialize
+from akernel.tracing import Tracer
+
+
+HEADER = {"msg_id": "0", "msg_type": "execute_request"}
+
+
+def test_tracer_jsonl(tmp_path):
+    path = tmp_path / "trace.jsonl"
+    tracer = Tracer(str(path))
+    tracer.span("run", 1.0, 1.5, HEADER)
+    tracer.span("iopub_flush", 1.5, 1.75, HEADER, {"iopub_msg_type": "stream"})
+    tracer.close()
+    spans = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [(span["name"], span["msg_id"], span["duration"]) for span in spans] == [
+        ("run", "0", 0.5),
+        ("iopub_flush", "0", 0.25),
+    ]
+    assert spans[1]["iopub_msg_type"] == "stream"
+    assert spans[1]["time"] - spans[0]["time"] == pytest.approx(0.5)
+
+
+def test_tracer_chrome(tmp_path):
+    path = tmp_path / "trace.json"
+    tracer = Tracer(str(path), "chrome")
+    tracer.span("run", 1.0, 1.5, HEADER)
+    tracer.close()
+    begin, end = json.loads(path.read_text())
+    assert (begin["name"], begin["ph"], begin["id"], begin["cat"]) == (
+        "run",
+        "b",
+        "0",
+        "execute_request",
+    )
+    assert end["ph"] == "e"
+    assert end["ts"] - begin["ts"] == pytest.approx(5e5)
+
+
+def test_tracer_ring_buffer(tmp_path):
+    tracer = Tracer(str(tmp_path / "trace.jsonl"), buffer_size=2)
+    for i in range(3):
+        tracer.span(str(i), 0, 1, HEADER)
+    # the oldest span is dropped
+    assert [span[0] for span in tracer.spans] == ["1", "2"]
+    tracer.close()
+
+
+@pytest.mark.asyncio
+async def test_kernel_tracing(tmp_path):
+    to_shell_send_stream, to_shell_receive_stream = create_memory_object_stream(
+        max_buffer_size=float("inf")
+    )
+    from_shell_send_stream, from_shell_receive_stream = create_memory_object_stream(
+        max_buffer_size=float("inf")
+    )
+    from_iopub_send_stream, _ = create_memory_object_stream(max_buffer_size=float("inf"))
+    kernel = Kernel(
+        to_shell_receive_stream,
+        from_shell_send_stream,
+        None,
+        None,
+        None,
+        None,
+        from_iopub_send_stream,
+    )
+    path = tmp_path / "trace.jsonl"
+    kernel.tracer = Tracer(str(path))
+    tasks = [
+        asyncio.create_task(kernel.listen_shell()),
+        asyncio.create_task(kernel.dispatch_executions()),
+    ]
+    msg = create_message("execute_request", content={"code": "1 + 1"}, session_id="s")
+    await to_shell_send_stream.send(serialize(msg, kernel.key))
+    await from_shell_receive_stream.receive()
+    kernel.tracer.close()
+    for task in tasks:
+        task.cancel()
+    spans = [json.loads(line) for line in path.read_text().splitlines()]
+    assert {span["msg_id"] for span in spans} == {msg["header"]["msg_id"]}
+    assert [span["name"] for span in spans] == [
+        "recv",
+        "deserialize",
+        "queued",
+        "transform",
+        "compile",
+        "run",
+        "show_result",
+        "reply",
+    ]